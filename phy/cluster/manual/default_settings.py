@@ -9,12 +9,33 @@ manual_clustering.correlograms_binsize = 20
 # Number of bins (odd number).
 manual_clustering.correlograms_winsize_bins = 2 * 25 + 1
 
+# Base resolution of the CCGs: the CCGs are computed once with this bin
+# size and window, and the CCGs with a bin size multiple of the base bin
+# size and a smaller window are obtained by rebinning. If None, this is
+# the displayed resolution: the CCGs with coarser bins or a smaller window
+# are rebinned, the others are computed again.
+# The bin size and the window can be changed in the correlogram view with
+# Control + Left/Right and Control + Down/Up.
+manual_clustering.correlograms_base_binsize = None
+manual_clustering.correlograms_base_winsize_bins = None
+
 # Maximum number of spikes for the correlograms.
 manual_clustering.correlograms_n_spikes_max = 1000000
 
 # Contiguous chunks of spikes for computing the CCGs.
 manual_clustering.correlograms_excerpt_size = 100000
 
+# Maximum size (in bytes) of the cache of the CCGs between pairs of
+# clusters. The cache is disabled by default. When it is enabled, the CCGs
+# are computed on all spikes of the selected clusters: the
+# correlograms_n_spikes_max and correlograms_excerpt_size settings are
+# ignored.
+manual_clustering.correlograms_cache_size = 0
+
+# Number of processes used to compute the CCGs on all spikes of the
+# selected clusters. If None, the CCGs are computed in the current process.
+manual_clustering.correlograms_n_processes = None
+
 
 # -----------------------------------------------------------------------------
 # Views
@@ -27,6 +48,17 @@ manual_clustering.waveforms_n_spikes_max = 100
 # Higher value = faster loading of waveforms.
 manual_clustering.waveforms_excerpt_size = 20
 
+# Maximum size (in bytes) of the cache of loaded waveforms.
+# Set to 0 to disable the cache.
+manual_clustering.waveforms_cache_size = 100 * 1024 ** 2
+
+# Data type of the loaded waveforms. With 'int16', the waveforms take half
+# the memory and are only scaled when they are sent to the view.
+manual_clustering.waveforms_dtype = 'float32'
+
+# Number of threads extracting and filtering the waveforms.
+manual_clustering.waveforms_n_workers = 1
+
 # Maximum number of spikes to display in the feature view.
 manual_clustering.features_n_spikes_max = 10000
 
@@ -38,3 +70,25 @@ manual_clustering.features_n_spikes_max = 10000
 # Number of spikes to load at once from the features_masks array
 # during the cluster store generation.
 manual_clustering.store_chunk_size = 100000
+
+# Maximum size in bytes of the features and masks gathered in memory
+# during the cluster store generation, before being written to disk.
+manual_clustering.store_write_buffer_size = 256 * 1024 ** 2
+
+# Maximum size in bytes of the cluster statistics kept in memory. The
+# statistics of the least-recently used clusters are saved to disk beyond
+# this size. Use None for no limit.
+manual_clustering.store_memory_size = 512 * 1024 ** 2
+
+# Backend of the cluster store on disk: 'files' for one file per cluster
+# and field, or 'packed' for a single append-only file per field.
+manual_clustering.store_backend = 'files'
+
+# Maximum number of spikes per cluster used to compute the mean and
+# standard deviation waveforms in the cluster store.
+manual_clustering.store_waveforms_n_spikes_max = 100
+
+# Parameters of the cluster quality metrics in the cluster store, in seconds.
+manual_clustering.metrics_refractory_period = .002
+manual_clustering.metrics_isi_binsize = .001
+manual_clustering.metrics_isi_n_bins = 50
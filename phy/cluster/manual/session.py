@@ -7,7 +7,6 @@ from __future__ import print_function
 # Imports
 #------------------------------------------------------------------------------
 
-import os
 import os.path as op
 import shutil
 from functools import partial
@@ -16,19 +15,24 @@ import numpy as np
 
 from ...ext.six import string_types
 from ...utils._misc import _ensure_path_exists
-from ...utils.array import _index_of, _is_array_like
+from ...utils.array import _index_of, _is_array_like, regular_subset
+from ...utils.background import BackgroundWorker, iter_prefetch
+from ...utils.cache import LRUCache
 from ...utils.event import EventEmitter, ProgressReporter
-from ...utils.logging import info
+from ...utils.logging import debug, info
 from ...utils.settings import SettingsManager, declare_namespace
 from ...io.kwik_model import KwikModel
+from ...stats.ccg import correlograms, _can_rebin, _rebin
+from ...stats.metrics import cluster_metrics
 from ._history import GlobalHistory
 from .clustering import Clustering
 from ._utils import _spikes_per_cluster, _concatenate_per_cluster_arrays
 from .selector import Selector
-from .store import ClusterStore, StoreItem
+from .store import ClusterStore, DiskStoreBuffer, StoreItem
 from .view_model import (WaveformViewModel,
                          FeatureViewModel,
                          CorrelogramViewModel,
+                         _change_bins,
                          )
 from .wizard import Wizard, _best_clusters
 
@@ -97,6 +101,13 @@ class FeatureMasks(StoreItem):
     # Size of the chunk used when reading features and masks from the HDF5
     # .kwx file.
     chunk_size = None
+    # Maximum number of chunks read ahead in the background.
+    n_prefetch = 2
+    # Maximum number of per-cluster appends waiting to be written to disk.
+    n_pending_writes = 1024
+    # Maximum size in bytes of the per-cluster data gathered in memory
+    # before being written to disk.
+    write_buffer_size = None
 
     def __init__(self, *args, **kwargs):
         self._pr_disk = kwargs.pop('progress_reporter_disk')
@@ -114,49 +125,87 @@ class FeatureMasks(StoreItem):
         self.fields[1] = ('masks', 'disk',
                           np.float32, (-1, self.n_channels))
 
-    def _store_extra_fields(self, clusters):
-        """Store all extra mask fields."""
-
-        self._pr_memory.value_max = len(clusters)
-
-        for cluster in clusters:
-
-            # Load the masks.
+    def _mask_statistics(self, sum_masks, n_spikes):
+        """Compute the extra mask fields of several clusters from their
+        `(n_clusters, n_channels)` sums of masks and their numbers of
+        spikes."""
+        sum_masks = np.asarray(sum_masks, dtype=np.float32)
+        n_spikes = np.maximum(np.asarray(n_spikes, dtype=np.float32), 1)
+        mean_masks = sum_masks / n_spikes[:, np.newaxis]
+        n_unmasked_channels = (mean_masks > .1).sum(axis=1)
+        # Weighted mean of the channels, weighted by the mean masks.
+        mean_probe_position = (np.dot(mean_masks, self.model.probe.positions) /
+                               float(self.n_channels))
+        # The unmasked channels come first when sorting the channels by
+        # decreasing mean mask.
+        main_channels = np.argsort(mean_masks, axis=1)[:, ::-1]
+        return {'mean_masks': mean_masks,
+                'sum_masks': sum_masks,
+                'n_unmasked_channels': n_unmasked_channels,
+                'mean_probe_position': mean_probe_position,
+                'main_channels': [channels[:n] for channels, n in
+                                  zip(main_channels, n_unmasked_channels)],
+                }
+
+    def _sum_masks(self, clusters):
+        """Load the masks of some clusters and return their sums."""
+        sum_masks = np.zeros((len(clusters), self.n_channels),
+                             dtype=np.float32)
+        for i, cluster in enumerate(clusters):
             masks = self.disk_store.load(cluster, 'masks',
                                          dtype=np.float32,
                                          shape=(-1, self.n_channels))
             assert isinstance(masks, np.ndarray)
+            sum_masks[i] = masks.sum(axis=0)
+        return sum_masks
 
-            # Extra fields.
-            sum_masks = masks.sum(axis=0)
-            mean_masks = sum_masks / float(masks.shape[0])
-            unmasked_channels = np.nonzero(mean_masks > .1)[0]
-            n_unmasked_channels = len(unmasked_channels)
-            # Weighted mean of the channels, weighted by the mean masks.
-            mean_probe_position = (self.model.probe.positions *
-                                   mean_masks[:, np.newaxis]).mean(axis=0)
-            main_channels = np.argsort(mean_masks)[::-1]
-            main_channels = np.array([c for c in main_channels
-                                      if c in unmasked_channels])
-            self.memory_store.store(cluster,
-                                    mean_masks=mean_masks,
-                                    sum_masks=sum_masks,
-                                    n_unmasked_channels=n_unmasked_channels,
-                                    mean_probe_position=mean_probe_position,
-                                    main_channels=main_channels,
-                                    )
+    def _store_extra_fields(self, clusters, sum_masks=None):
+        """Store all extra mask fields.
+
+        The sums of masks are loaded from the disk store if they are not
+        specified.
 
+        """
+        self._pr_memory.value_max = len(clusters)
+
+        if sum_masks is None:
+            sum_masks = self._sum_masks(clusters)
+        n_spikes = [len(self.spikes_per_cluster[cluster])
+                    for cluster in clusters]
+        stats = self._mask_statistics(sum_masks, n_spikes)
+
+        for i, cluster in enumerate(clusters):
+            self.memory_store.store(cluster,
+                                    **{name: values[i]
+                                       for name, values in stats.items()})
             # Update the progress reporter.
             self._pr_memory.value += 1
 
         self._pr_memory.set_complete()
 
-    def _store_cluster(self,
-                       cluster,
-                       chunk_spikes,
-                       chunk_spikes_per_cluster,
-                       chunk_features_masks,
-                       ):
+    def _accumulate_masks(self, chunk, clusters, sum_masks):
+        """Add the masks of a chunk to the `(n_clusters, n_channels)` sums
+        of masks of all clusters."""
+        _, chunk_spike_clusters, chunk_features_masks = chunk
+        nc = self.n_channels
+        nf = self.n_features
+        masks = chunk_features_masks[:, :nc * nf, 1][:, ::nf]
+        # Index of every (spike, channel) pair in the raveled sums.
+        idx = _index_of(chunk_spike_clusters, np.asarray(clusters))
+        idx = (idx[:, np.newaxis] * nc + np.arange(nc)).ravel()
+        sum_masks += np.bincount(idx,
+                                 weights=masks.astype(np.float32).ravel(),
+                                 minlength=sum_masks.size,
+                                 ).reshape(sum_masks.shape)
+
+    def _extract_cluster(self,
+                         cluster,
+                         chunk_spikes,
+                         chunk_spikes_per_cluster,
+                         chunk_features_masks,
+                         ):
+        """Return the raveled features and masks of a cluster in a
+        chunk."""
 
         nc = self.n_channels
         nf = self.n_features
@@ -188,12 +237,52 @@ class FeatureMasks(StoreItem):
         assert m.shape == (ns, nc)
         m = m.ravel().astype(np.float32)
 
-        # Save the data to disk.
-        self.disk_store.store(cluster,
-                              features=f,
-                              masks=m,
-                              append=True,
-                              )
+        return f, m
+
+    def _append_cluster(self, buffer, cluster, features, masks):
+        """Append the features and masks of a cluster to the disk store
+        buffer."""
+        buffer.store(cluster,
+                     features=features,
+                     masks=masks,
+                     )
+
+    def _iter_chunks(self):
+        """Yield the chunks `(spikes, spike_clusters, features_masks)` read
+        from the model."""
+        fm = self.model.features_masks
+        assert fm.shape[0] == self.n_spikes
+        for i in range(self.n_chunks):
+            a, b = i * self.chunk_size, (i + 1) * self.chunk_size
+
+            # Load a chunk from HDF5.
+            chunk_features_masks = fm[a:b]
+            assert isinstance(chunk_features_masks, np.ndarray)
+            if chunk_features_masks.shape[0] == 0:
+                break
+            chunk_spike_clusters = self.model.spike_clusters[a:b]
+            chunk_spikes = np.arange(a, a + chunk_features_masks.shape[0])
+            yield chunk_spikes, chunk_spike_clusters, chunk_features_masks
+
+    def _split_chunk(self, chunk, clusters_to_generate, append):
+        """Split a chunk per cluster, and call `append(cluster, features,
+        masks)` for all clusters that need to be re-generated."""
+        chunk_spikes, chunk_spike_clusters, chunk_features_masks = chunk
+
+        # Split the spikes.
+        chunk_spc = _spikes_per_cluster(chunk_spikes, chunk_spike_clusters)
+
+        # Go through the clusters appearing in the chunk and that
+        # need to be re-generated.
+        clusters = (set(chunk_spc.keys()).
+                    intersection(set(clusters_to_generate)))
+        for cluster in sorted(clusters):
+            f, m = self._extract_cluster(cluster,
+                                         chunk_spikes,
+                                         chunk_spc,
+                                         chunk_features_masks,
+                                         )
+            append(cluster, f, m)
 
     def is_consistent(self, cluster, spikes):
         """Return whether the filesizes of the two cluster store files
@@ -207,10 +296,7 @@ class FeatureMasks(StoreItem):
                                              self.n_features *
                                              4))]
         for name, expected_file_size in expected_file_sizes:
-            path = self.disk_store._cluster_path(cluster, name)
-            if not op.exists(path):
-                return False
-            actual_file_size = os.stat(path).st_size
+            actual_file_size = self.disk_store.size(cluster, name)
             if expected_file_size != actual_file_size:
                 return False
         return True
@@ -236,48 +322,48 @@ class FeatureMasks(StoreItem):
         # No need to regenerate the cluster store if it exists and is valid.
         clusters_to_generate = self.to_generate(mode=mode)
         need_generate = len(clusters_to_generate) > 0
+        clusters = self.cluster_ids
+        sum_masks = None
 
         if need_generate:
 
             self._pr_disk.value_max = self.n_chunks
 
-            fm = self.model.features_masks
-            assert fm.shape[0] == self.n_spikes
-
-            for i in range(self.n_chunks):
-                a, b = i * self.chunk_size, (i + 1) * self.chunk_size
-
-                # Load a chunk from HDF5.
-                chunk_features_masks = fm[a:b]
-                assert isinstance(chunk_features_masks, np.ndarray)
-                if chunk_features_masks.shape[0] == 0:
-                    break
-
-                chunk_spike_clusters = self.model.spike_clusters[a:b]
-                chunk_spikes = np.arange(a, b)
-
-                # Split the spikes.
-                chunk_spc = _spikes_per_cluster(chunk_spikes,
-                                                chunk_spike_clusters)
-
-                # Go through the clusters appearing in the chunk and that
-                # need to be re-generated.
-                clusters = (set(chunk_spc.keys()).
-                            intersection(set(clusters_to_generate)))
-                for cluster in sorted(clusters):
-                    self._store_cluster(cluster,
-                                        chunk_spikes,
-                                        chunk_spc,
-                                        chunk_features_masks,
-                                        )
-
-                # Update the progress reporter.
-                self._pr_disk.value += 1
+            # The data is appended to the files, which should not contain
+            # any data beforehand.
+            self.disk_store.erase(clusters_to_generate)
+
+            # Pipeline: a background thread reads the next chunks from HDF5
+            # while the current chunk is split per cluster, and another
+            # background thread appends the data to the disk store.
+            # The appends are gathered in memory and written per cluster.
+            chunks = iter_prefetch(self._iter_chunks(),
+                                   max_size=self.n_prefetch)
+            buffer = DiskStoreBuffer(self.disk_store,
+                                     max_size=self.write_buffer_size)
+            # The sums of masks of all clusters are computed on the fly.
+            sum_masks = np.zeros((len(clusters), self.n_channels))
+            writer = BackgroundWorker(partial(self._append_cluster, buffer),
+                                      max_size=self.n_pending_writes)
+            try:
+                with writer:
+                    for chunk in chunks:
+                        self._split_chunk(chunk, clusters_to_generate,
+                                          writer.put)
+                        self._accumulate_masks(chunk, clusters, sum_masks)
+                        # Update the progress reporter.
+                        self._pr_disk.value += 1
+            finally:
+                # Stop the reader thread if the loop was interrupted.
+                chunks.close()
+            buffer.flush()
+            debug("{0:d} appends written in {1:d} writes.".format(
+                  buffer.n_appends, buffer.n_writes))
 
         self._pr_disk.set_complete()
 
         # Store extra fields from the masks.
-        self._store_extra_fields(self.cluster_ids)
+        self._store_extra_fields(clusters, sum_masks=sum_masks)
 
     def _merge(self, up):
         """Create the cluster store files of the merged cluster
@@ -373,12 +459,371 @@ class FeatureMasks(StoreItem):
         # a redo.
         if up is None or up.history is not None:
             return
+        sum_masks = None
         if up.description == 'merge':
             self._merge(up)
+            # The sums of masks of the merged cluster are the sums of the
+            # old clusters.
+            sum_masks = [np.sum([self.memory_store.load(cluster, 'sum_masks')
+                                 for cluster in up.deleted], axis=0)]
         elif up.description == 'assign':
             self._assign(up)
         # Compute the extra fields for the new clusters.
-        self._store_extra_fields(up.added)
+        self._store_extra_fields(up.added, sum_masks=sum_masks)
+
+
+class WaveformStatistics(StoreItem):
+    """A cluster store item that manages the mean and standard deviation
+    waveforms of all clusters.
+
+    The statistics are computed on a regular subset of at most
+    `n_spikes_max` spikes per cluster, the first time they are loaded from
+    the cluster store. They are combined without loading any waveform when
+    clusters are merged.
+
+    """
+    name = 'waveform statistics'
+    fields = [('mean_waveforms', 'memory'),
+              ('std_waveforms', 'memory'),
+              ('n_waveforms', 'memory'),
+              ]
+
+    # Maximum number of spikes per cluster used to compute the statistics.
+    n_spikes_max = None
+
+    def is_consistent(self, cluster, spikes):
+        """The statistics are computed on demand."""
+        return True
+
+    def store_all_clusters(self, mode=None):
+        """Nothing to do: the statistics are computed on demand."""
+        pass
+
+    def store_cluster(self, cluster, spikes, mode=None):
+        # Nothing to do if there are no traces in the dataset.
+        if self.model.traces is None:
+            return
+        spikes = regular_subset(spikes, n_spikes_max=self.n_spikes_max)
+        loader = self.model.waveforms
+        # These waveforms should not evict the waveforms of the views from
+        # the waveforms cache.
+        loader = getattr(loader, 'uncached', loader)
+        waveforms = np.asarray(loader[spikes], dtype=np.float64)
+        assert waveforms.ndim == 3
+        # Integer waveforms are not scaled yet.
+        sf = getattr(loader, 'deferred_scale_factor', None)
+        if sf is not None:
+            waveforms *= sf
+        self.memory_store.store(cluster,
+                                mean_waveforms=waveforms.mean(axis=0),
+                                std_waveforms=waveforms.std(axis=0),
+                                n_waveforms=len(spikes),
+                                )
+
+    def _merge(self, up):
+        """Combine the statistics of the merged clusters, weighted by their
+        number of spikes."""
+        clusters = up.deleted
+        # The statistics of the merged cluster are computed on demand if
+        # some statistics are missing.
+        if not all(self.memory_store.has(cluster, 'mean_waveforms')
+                   for cluster in clusters):
+            return
+        stats = [self.memory_store.load(cluster, ['mean_waveforms',
+                                                  'std_waveforms',
+                                                  'n_waveforms'])
+                 for cluster in clusters]
+        weights = np.array([len(up.old_spikes_per_cluster[cluster])
+                            for cluster in clusters], dtype=np.float64)
+        weights /= weights.sum()
+        means = np.array([s['mean_waveforms'] for s in stats])
+        stds = np.array([s['std_waveforms'] for s in stats])
+        w = weights[:, np.newaxis, np.newaxis]
+        mean = (w * means).sum(axis=0)
+        # Law of total variance.
+        var = (w * (stds ** 2 + means ** 2)).sum(axis=0) - mean ** 2
+        std = np.sqrt(np.clip(var, 0, None))
+        n = sum(s['n_waveforms'] for s in stats)
+        self.memory_store.store(up.added[0],
+                                mean_waveforms=mean,
+                                std_waveforms=std,
+                                n_waveforms=n,
+                                )
+
+    def on_cluster(self, up=None):
+        """Combine the waveform statistics of merged clusters. The
+        statistics of the other new clusters are computed on demand.
+
+        Old statistics are kept in memory, which is useful for undo and
+        redo.
+
+        """
+        # No need to change anything in the store if this is an undo or
+        # a redo.
+        if up is None or up.history is not None:
+            return
+        if up.description == 'merge':
+            self._merge(up)
+
+
+class ClusterMetrics(StoreItem):
+    """A cluster store item that manages the quality metrics of all
+    clusters: firing rate, refractory period violations, and ISI histogram.
+
+    The metrics of all clusters are computed in a single pass over the
+    spikes. After a clustering change, only the spikes of the new clusters
+    are processed.
+
+    """
+    name = 'cluster metrics'
+    fields = [('firing_rate', 'memory'),
+              ('refractory_violations', 'memory'),
+              ('isi_histogram', 'memory'),
+              ]
+
+    # Parameters of the metrics, in seconds.
+    refractory_period = .002
+    isi_binsize = .001
+    isi_n_bins = 50
+
+    @property
+    def sample_rate(self):
+        return self.model.metadata.get('sample_rate', None)
+
+    def is_consistent(self, cluster, spikes):
+        """Return whether the metrics of a cluster are in the store."""
+        return (self.sample_rate is None or
+                self.memory_store.has(cluster, 'firing_rate'))
+
+    def _duration(self):
+        """Duration of the recording in seconds, or None to use the time of
+        the last spike."""
+        spike_samples = self.model.spike_samples
+        n_samples = int(spike_samples.max()) + 1 if len(spike_samples) else 1
+        if self.model.traces is not None:
+            n_samples = max(n_samples, self.model.traces.shape[0])
+        return n_samples / float(self.sample_rate)
+
+    def _store_metrics(self, clusters, spikes=None):
+        """Compute and store the metrics of some clusters, using some spikes
+        or all spikes."""
+        if spikes is None:
+            spike_samples = self.model.spike_samples
+            spike_clusters = self.model.spike_clusters
+        else:
+            spike_samples = self.model.spike_samples[spikes]
+            spike_clusters = self.model.spike_clusters[spikes]
+        metrics = cluster_metrics(spike_samples, spike_clusters,
+                                  self.sample_rate,
+                                  duration=self._duration(),
+                                  refractory_period=self.refractory_period,
+                                  isi_binsize=self.isi_binsize,
+                                  isi_n_bins=self.isi_n_bins,
+                                  )
+        rates = metrics['firing_rates']
+        violations = metrics['refractory_violations']
+        isi = metrics['isi_histograms']
+        idx = _index_of(np.asarray(clusters), metrics['clusters'])
+        for cluster, i in zip(clusters, idx):
+            self.memory_store.store(cluster,
+                                    firing_rate=rates[i],
+                                    refractory_violations=violations[i],
+                                    isi_histogram=isi[i],
+                                    )
+
+    def store_all_clusters(self, mode=None):
+        # Nothing to do if the sample rate is unknown.
+        if self.sample_rate is None:
+            return
+        clusters = self.to_generate(mode)
+        if not len(clusters):
+            return
+        debug("Computing the metrics of {0:d} clusters...".format(
+              len(clusters)))
+        self._store_metrics(clusters)
+
+    def on_cluster(self, up=None):
+        """Compute the metrics of the newly-created clusters.
+
+        Old metrics are kept in memory, which is useful for undo and redo.
+
+        """
+        # No need to change anything in the store if this is an undo or
+        # a redo.
+        if up is None or up.history is not None:
+            return
+        if self.sample_rate is None or not up.added:
+            return
+        spikes = np.sort(np.concatenate([up.new_spikes_per_cluster[cluster]
+                                         for cluster in up.added]))
+        self._store_metrics(up.added, spikes)
+
+
+class CorrelogramCache(StoreItem):
+    """A cluster store item that caches the correlograms between pairs of
+    clusters, computed on all spikes of the clusters.
+
+    The CCGs are computed on demand, and kept in a memory-bounded LRU cache
+    with keys `(cluster_a, cluster_b, binsize, winsize_bins)`. Since a
+    cluster id always refers to the same spikes, the cached CCGs never
+    become stale: the CCGs of the deleted clusters are only removed to
+    free memory.
+
+    The CCGs can be requested with a base resolution: they are then
+    computed and cached with the base bin size and window, and the
+    requested CCGs are derived by rebinning.
+
+    """
+    name = 'correlograms'
+    fields = []
+    # Number of processes used to compute the CCGs.
+    n_processes = None
+
+    def __init__(self, *args, **kwargs):
+        max_size = kwargs.pop('max_size', None)
+        super(CorrelogramCache, self).__init__(*args, **kwargs)
+        self.cache = LRUCache(max_size=max_size)
+
+    def is_consistent(self, cluster, spikes):
+        """The CCGs are computed on demand."""
+        return True
+
+    def store_all_clusters(self, mode=None):
+        """Nothing to do: the CCGs are computed on demand."""
+        pass
+
+    def _compute(self, pairs, binsize, winsize_bins):
+        """Compute the `(n_pairs, 2, n_bins)` array with the CCGs `c[a, b]`
+        and `c[b, a]` of some pairs of clusters `(a, b)`."""
+        clusters = np.unique(pairs)
+        spikes = np.sort(np.concatenate([self.spikes_per_cluster[cluster]
+                                         for cluster in clusters]))
+        # Both orientations of every pair are needed.
+        n = len(pairs)
+        ccgs = correlograms(self.model.spike_samples[spikes],
+                            self.model.spike_clusters[spikes],
+                            binsize=binsize,
+                            winsize_bins=winsize_bins,
+                            pairs=np.r_[pairs, pairs[:, ::-1]],
+                            n_processes=self.n_processes,
+                            )
+        return np.concatenate((ccgs[:n, np.newaxis], ccgs[n:, np.newaxis]),
+                              axis=1)
+
+    def _pair_correlograms(self, clusters, binsize, winsize_bins):
+        """Return the list of the `(2, n_bins)` cached or computed CCGs of
+        all pairs `(clusters[i], clusters[j])` with `i <= j`, where the
+        first cluster of every pair is the smaller one."""
+        pairs = [(min(clusters[i], clusters[j]),
+                  max(clusters[i], clusters[j]))
+                 for i in range(len(clusters))
+                 for j in range(i, len(clusters))]
+        ccgs = [self.cache.get((a, b, binsize, winsize_bins))
+                for (a, b) in pairs]
+        missing = [k for k, ccg in enumerate(ccgs) if ccg is None]
+        if missing:
+            computed = self._compute(np.array([pairs[k] for k in missing]),
+                                     binsize, winsize_bins)
+            for k, ccg in zip(missing, computed):
+                a, b = pairs[k]
+                self.cache[a, b, binsize, winsize_bins] = ccg
+                ccgs[k] = ccg
+        return pairs, ccgs
+
+    def correlograms(self, clusters, binsize, winsize_bins,
+                     base_binsize=None, base_winsize_bins=None):
+        """Return the (n_clusters, n_clusters, winsize_bins) array of the
+        symmetrized CCGs of some clusters.
+
+        Only the CCGs that are not in the cache are computed. If the base
+        resolution is specified and compatible with the requested one,
+        the CCGs are computed and cached at the base resolution, and
+        rebinned.
+
+        """
+        if (base_binsize is None or
+                not _can_rebin(base_binsize, base_winsize_bins,
+                               binsize, winsize_bins)):
+            base_binsize, base_winsize_bins = binsize, winsize_bins
+        pairs, ccgs = self._pair_correlograms(clusters, base_binsize,
+                                              base_winsize_bins)
+        factor = binsize // base_binsize
+        n_bins = winsize_bins // 2 + 1
+
+        n = len(clusters)
+        out = np.zeros((n, n, 2 * n_bins - 1), dtype=np.int32)
+        k = 0
+        for i in range(n):
+            for j in range(i, n):
+                (a, b), ccg = pairs[k], ccgs[k]
+                k += 1
+                ab, ba = _rebin(ccg, factor, n_bins)
+                if a == b:
+                    # Remove the ACG peak.
+                    ab[0] = ba[0] = 0
+                # Same symmetrization as _symmetrize_correlograms().
+                sym = np.r_[ba[1:][::-1], max(ab[0], ba[0]), ab[1:]]
+                if clusters[i] > clusters[j]:
+                    sym = sym[::-1]
+                out[i, j] = sym
+                out[j, i] = sym[::-1]
+        return out
+
+    def _merge(self, up):
+        """Derive the CCGs of a merged cluster from the cached CCGs of the
+        merged clusters, without going back to the spikes."""
+        merged = sorted(up.deleted)
+        new = up.added[0]
+        # Cached CCGs by resolution.
+        cached = {}
+        for key in self.cache.keys():
+            a, b, binsize, winsize_bins = key
+            cached.setdefault((binsize, winsize_bins), {})[a, b] = \
+                self.cache.peek(key)
+        for (binsize, winsize_bins), ccgs in cached.items():
+
+            def _get(a, b):
+                """Return the CCGs `c[a, b]` and `c[b, a]`, or None."""
+                ccg = ccgs.get((min(a, b), max(a, b)), None)
+                if ccg is None or a <= b:
+                    return ccg
+                return ccg[::-1]
+
+            # The ACG of the merged cluster includes all CCGs between the
+            # merged clusters.
+            pairs = [(a, b) for i, a in enumerate(merged) for b in merged[i:]]
+            parts = [_get(a, b) for (a, b) in pairs]
+            if all(part is not None for part in parts):
+                # The ACGs are stored twice.
+                acg = sum(part[0] if a == b else part[0] + part[1]
+                          for (a, b), part in zip(pairs, parts))
+                # Remove the ACG peak.
+                acg[0] = 0
+                self.cache[new, new, binsize, winsize_bins] = \
+                    np.vstack((acg, acg))
+            # The CCGs with the other clusters are sums of CCGs.
+            others = set(c for pair in ccgs for c in pair) - set(merged)
+            for other in others:
+                parts = [_get(cluster, other) for cluster in merged]
+                if any(part is None for part in parts):
+                    continue
+                ccg = sum(parts)
+                if new > other:
+                    ccg = ccg[::-1]
+                self.cache[min(new, other), max(new, other),
+                           binsize, winsize_bins] = ccg
+
+    def on_cluster(self, up=None):
+        """Derive the CCGs of a merged cluster from the cache, and remove
+        the CCGs of the deleted clusters from the cache."""
+        if up is None:
+            return
+        if up.description == 'merge':
+            self._merge(up)
+        deleted = set(up.deleted)
+        for key in self.cache.keys():
+            if key[0] in deleted or key[1] in deleted:
+                self.cache.pop(key)
 
 
 #------------------------------------------------------------------------------
@@ -524,6 +969,8 @@ class Session(BaseSession):
                   for cluster in self.clustering.cluster_ids}
         self.model.save(self.clustering.spike_clusters,
                         groups)
+        # The cluster store manifest refers to the saved kwik file.
+        self.cluster_store.save_manifest(self.clustering.spikes_per_cluster)
         info("Saved {0:s}.".format(self.model.kwik_path))
 
     def close(self):
@@ -606,6 +1053,20 @@ class Session(BaseSession):
     def _create_cluster_metadata(self):
         self.cluster_metadata = self.model.cluster_metadata
 
+    def _create_waveforms_cache(self):
+        # Only Kwik models have a waveforms cache.
+        if not hasattr(self.model, 'waveforms_cache_size'):
+            return
+        dtype = self.get_user_settings('manual_clustering.'
+                                       'waveforms_dtype')
+        self.model.waveforms_dtype = dtype
+        n_workers = self.get_user_settings('manual_clustering.'
+                                           'waveforms_n_workers')
+        self.model.waveforms_n_workers = n_workers
+        size = self.get_user_settings('manual_clustering.'
+                                      'waveforms_cache_size')
+        self.model.waveforms_cache_size = size
+
     def _create_cluster_store(self):
 
         # Kwik store in experiment_dir/name.phy/1/main/cluster_store.
@@ -617,8 +1078,13 @@ class Session(BaseSession):
         _ensure_path_exists(store_path)
 
         # Instantiate the store.
+        backend = self.get_user_settings('manual_clustering.store_backend')
+        memory_size = self.get_user_settings('manual_clustering.'
+                                             'store_memory_size')
         self.cluster_store = ClusterStore(model=self.model,
                                           path=store_path,
+                                          backend=backend,
+                                          memory_size=memory_size,
                                           )
 
         # chunk_size is the number of spikes to load at once from
@@ -626,6 +1092,8 @@ class Session(BaseSession):
         cs = self.get_user_settings('manual_clustering.'
                                     'store_chunk_size') or 100000
         FeatureMasks.chunk_size = cs
+        FeatureMasks.write_buffer_size = self.get_user_settings(
+            'manual_clustering.store_write_buffer_size')
 
         # Initialize the progress reporter.
         pr_disk = ProgressReporter()
@@ -635,6 +1103,28 @@ class Session(BaseSession):
                                          progress_reporter_memory=pr_memory,
                                          )
 
+        # Mean and std waveforms computed on a subset of spikes.
+        n = self.get_user_settings('manual_clustering.'
+                                   'store_waveforms_n_spikes_max')
+        WaveformStatistics.n_spikes_max = n
+        self.cluster_store.register_item(WaveformStatistics)
+
+        # Quality metrics.
+        for name in ('refractory_period', 'isi_binsize', 'isi_n_bins'):
+            setattr(ClusterMetrics, name,
+                    self.get_user_settings('manual_clustering.metrics_' +
+                                           name))
+        self.cluster_store.register_item(ClusterMetrics)
+
+        # Cache of the CCGs between pairs of clusters.
+        size = self.get_user_settings('manual_clustering.'
+                                      'correlograms_cache_size')
+        n = self.get_user_settings('manual_clustering.'
+                                   'correlograms_n_processes')
+        CorrelogramCache.n_processes = n
+        self.correlogram_cache = self.cluster_store.register_item(
+            CorrelogramCache, max_size=size)
+
         @pr_disk.connect
         def on_progress(value, value_max):
             if value_max == 0:
@@ -658,6 +1148,11 @@ class Session(BaseSession):
 
         @self.connect
         def on_cluster(up=None, add_to_stack=None):
+            # The clustering creates a new spikes_per_cluster structure
+            # after an undo or a redo.
+            spc = self.clustering.spikes_per_cluster
+            if self.cluster_store.spikes_per_cluster is not spc:
+                self.cluster_store.spikes_per_cluster = spc
             self.cluster_store.on_cluster(up)
 
     def _create_clustering(self):
@@ -716,6 +1211,7 @@ class Session(BaseSession):
         self._create_clustering()
         self._create_selector()
         self._create_cluster_metadata()
+        self._create_waveforms_cache()
         self._create_cluster_store()
         self._create_wizard()
 
@@ -917,12 +1413,29 @@ class Session(BaseSession):
 
     def _create_correlograms_view(self):
         """Create a CorrelogramView and return a ViewModel instance."""
-        args = 'binsize', 'winsize_bins'
+        args = ('binsize', 'winsize_bins',
+                'base_binsize', 'base_winsize_bins')
         kwargs = {k: self.get_user_settings('manual_clustering.'
                                             'correlograms_' + k)
                   for k in args}
+        # Use the CCG cache of the cluster store if it is enabled. The CCGs
+        # are then computed on all spikes of the selected clusters.
+        if self.correlogram_cache.cache.max_size != 0:
+            kwargs['ccg_cache'] = self.correlogram_cache
         vm = self._create_view_model('correlograms', **kwargs)
         self._create_view(vm)
+
+        @vm.view.connect
+        def on_key_press(event):
+            # Change the bin size and the window with Control + arrows.
+            if 'Control' not in event.modifiers:
+                return
+            bins = _change_bins(vm.binsize, vm.winsize_bins, event.key)
+            if bins is None:
+                return
+            vm.set_bins(*bins)
+            vm.view.update()
+
         return vm
 
     def create_view(self, name):
@@ -6,15 +6,20 @@
 # Imports
 #------------------------------------------------------------------------------
 
+import hashlib
+import json
 import os
 import os.path as op
 import re
 
 import numpy as np
 
-from ...utils.array import _is_array_like, _index_of
+from ...utils._misc import _ensure_path_exists
+from ...utils.array import _is_array_like
+from ...utils.cache import LRUCache
 from ...utils.logging import debug, info
 from ...ext.six import string_types, integer_types
+from ...ext.six.moves import cPickle
 
 
 #------------------------------------------------------------------------------
@@ -32,13 +37,21 @@ def _directory_size(path):
 
 
 def _load_ndarray(f, dtype=None, shape=None):
+    """Return a read-only memory map on an open binary file, without
+    reading the data."""
     if dtype is None:
         return f
+    dtype = np.dtype(dtype)
+    n = os.fstat(f.fileno()).st_size // dtype.itemsize
+    if n == 0:
+        # Empty files cannot be memory-mapped.
+        arr = np.zeros(0, dtype=dtype)
+        arr.flags.writeable = False
     else:
-        arr = np.fromfile(f, dtype=dtype)
-        if shape is not None:
-            arr = arr.reshape(shape)
-        return arr
+        arr = np.memmap(f, dtype=dtype, mode='r', shape=(n,))
+    if shape is not None:
+        arr = arr.reshape(shape)
+    return arr
 
 
 def _as_int(x):
@@ -48,6 +61,34 @@ def _as_int(x):
     return x
 
 
+def _spikes_digest(spikes):
+    """Return a hexadecimal digest of an array of spike ids."""
+    spikes = np.ascontiguousarray(spikes, dtype=np.int64)
+    return hashlib.sha1(spikes).hexdigest()
+
+
+def _spike_clusters_digest(spikes_per_cluster):
+    """Return a hexadecimal digest of the spike-cluster assignments."""
+    spike_clusters = np.zeros(0, dtype=np.int64)
+    clusters = sorted(spikes_per_cluster)
+    if clusters:
+        spikes = np.concatenate([spikes_per_cluster[cluster]
+                                 for cluster in clusters]).astype(np.int64)
+        n_spikes = [len(spikes_per_cluster[cluster]) for cluster in clusters]
+        if len(spikes):
+            spike_clusters = -np.ones(spikes.max() + 1, dtype=np.int64)
+            spike_clusters[spikes] = np.repeat(clusters, n_spikes)
+    return _spikes_digest(spike_clusters)
+
+
+def _kwik_mtime(model):
+    """Return the modification time of the model's kwik file, if any."""
+    path = getattr(model, 'kwik_path', None)
+    if path is None or not op.exists(path):
+        return None
+    return op.getmtime(path)
+
+
 def _file_cluster_id(path):
     return int(op.splitext(op.basename(path))[0])
 
@@ -57,38 +98,121 @@ def _file_cluster_id(path):
 #------------------------------------------------------------------------------
 
 class MemoryStore(object):
-    """Store cluster-related data in memory."""
-    def __init__(self):
-        self._ds = {}
+    """Store cluster-related data in memory.
+
+    Parameters
+    ----------
+
+    max_size : int or None
+        Maximum size in bytes of the data in memory. When it is exceeded,
+        the data of the least-recently used clusters is evicted. If None,
+        the store is unbounded.
+    spill_dir : str or None
+        Directory where the evicted data is saved, to be loaded again when
+        it is needed. If None, the evicted data is discarded. The data of a
+        cluster larger than `max_size` is saved there once and then always
+        read from disk, without evicting the other clusters.
+
+    """
+    def __init__(self, max_size=None, spill_dir=None):
+        self._ds = LRUCache(max_size=max_size, on_evict=self._on_evict)
+        self._spill_dir = spill_dir
+        # cluster => keys of the data spilled to disk
+        self._spilled = {}
+        self.n_reloads = 0
+        # Remove the data spilled by a previous session.
+        if spill_dir is not None:
+            _ensure_path_exists(spill_dir)
+            for filename in os.listdir(spill_dir):
+                if re.match(r'^[0-9]+\.pkl$', filename):
+                    os.remove(op.join(spill_dir, filename))
+
+    def _spill_path(self, cluster):
+        return op.join(self._spill_dir, '{0:d}.pkl'.format(_as_int(cluster)))
+
+    def _on_evict(self, cluster, data):
+        if self._spill_dir is None:
+            return
+        with open(self._spill_path(cluster), 'wb') as f:
+            cPickle.dump(data, f, protocol=cPickle.HIGHEST_PROTOCOL)
+        self._spilled[cluster] = set(data)
+
+    def _get(self, cluster):
+        """Return the data of a cluster, loading it again if it was
+        spilled to disk, or None."""
+        data = self._ds.get(cluster)
+        if data is None and cluster in self._spilled:
+            path = self._spill_path(cluster)
+            with open(path, 'rb') as f:
+                data = cPickle.load(f)
+            self.n_reloads += 1
+            # The data larger than the memory store stays on disk.
+            if not self._ds.fits(data):
+                return data
+            os.remove(path)
+            del self._spilled[cluster]
+            self._ds[cluster] = data
+        return data
+
+    @property
+    def max_size(self):
+        """Maximum size in bytes of the data in memory."""
+        return self._ds.max_size
+
+    @property
+    def size(self):
+        """Size in bytes of the data in memory."""
+        return self._ds.size
+
+    @property
+    def n_evictions(self):
+        """Number of clusters evicted from memory."""
+        return self._ds.n_evictions
+
+    @property
+    def n_spilled(self):
+        """Number of clusters whose data is currently on disk."""
+        return len(self._spilled)
 
     def store(self, cluster, **data):
         """Store cluster-related data."""
-        if cluster not in self._ds:
-            self._ds[cluster] = {}
-        self._ds[cluster].update(data)
+        # The data is stored again to update its size.
+        cluster_data = self._get(cluster) or {}
+        cluster_data.update(data)
+        self._ds[cluster] = cluster_data
+
+    def has(self, cluster, key):
+        """Return whether some cluster-related data is in the store, without
+        loading it from disk if it has been spilled."""
+        data = self._ds.peek(cluster)
+        if data is not None:
+            return data.get(key, None) is not None
+        return key in self._spilled.get(cluster, ())
 
     def load(self, cluster, keys=None):
         """Load cluster-related data."""
+        data = self._get(cluster) or {}
         if keys is None:
-            return self._ds.get(cluster, {})
+            return data
         else:
             if isinstance(keys, string_types):
-                return self._ds.get(cluster, {}).get(keys, None)
+                return data.get(keys, None)
             assert isinstance(keys, (list, tuple))
-            return {key: self._ds.get(cluster, {}).get(key, None)
-                    for key in keys}
+            return {key: data.get(key, None) for key in keys}
 
     @property
     def cluster_ids(self):
         """List of cluster ids in the store."""
-        return sorted(self._ds.keys())
+        return sorted(set(self._ds.keys()) | set(self._spilled))
 
     def erase(self, clusters):
         """Delete some clusters from the store."""
         assert isinstance(clusters, list)
         for cluster in clusters:
-            if cluster in self._ds:
-                del self._ds[cluster]
+            self._ds.pop(cluster)
+            if cluster in self._spilled:
+                os.remove(self._spill_path(cluster))
+                del self._spilled[cluster]
 
     def clear(self):
         """Clear the store completely by deleting all clusters."""
@@ -107,6 +231,8 @@ class DiskStore(object):
         # the wrong files.
         self._allowed_extensions = set()
         self._directory = op.realpath(op.expanduser(directory))
+        # (cluster, key) => file size known without calling stat().
+        self._known_sizes = {}
 
     @property
     def path(self):
@@ -168,6 +294,7 @@ class DiskStore(object):
             path = self._cluster_path(cluster, key)
             self._check_extension(path)
             assert self._is_cluster_file(path)
+            self._known_sizes.pop((int(cluster), key), None)
             with open(path, mode) as f:
                 value.tofile(f)
 
@@ -191,6 +318,32 @@ class DiskStore(object):
             out[key] = self._get(cluster, key, dtype=dtype, shape=shape)
         return out
 
+    def size(self, cluster, key):
+        """Return the size in bytes of some cluster data, or None if it
+        doesn't exist."""
+        known = self._known_sizes.get((int(cluster), key), None)
+        if known is not None:
+            return known
+        if not self._cluster_file_exists(cluster, key):
+            return None
+        return os.stat(self._cluster_path(cluster, key)).st_size
+
+    def assume_sizes(self, sizes):
+        """Use known file sizes instead of calling `stat()` in `size()`.
+
+        `sizes` is a dictionary `{cluster: {key: size}}`, typically read
+        from the cluster store manifest. Only the sizes of existing files
+        are used, and a size is forgotten as soon as the file is modified
+        or deleted.
+
+        """
+        # A single directory listing instead of one stat() per file.
+        files = set(self.files)
+        for cluster, cluster_sizes in sizes.items():
+            for key, size in cluster_sizes.items():
+                if '{0:d}.{1:s}'.format(int(cluster), key) in files:
+                    self._known_sizes[int(cluster), key] = size
+
     @property
     def files(self):
         """List of files present in the directory."""
@@ -209,6 +362,7 @@ class DiskStore(object):
         """Delete some clusters from the store."""
         for cluster in clusters:
             for key in self._allowed_extensions:
+                self._known_sizes.pop((int(cluster), key), None)
                 path = self._cluster_path(cluster, key)
                 if not op.exists(path):
                     continue
@@ -225,11 +379,293 @@ class DiskStore(object):
         """Clear the store completely by deleting all clusters."""
         self.erase(self.cluster_ids)
 
+    def compact(self):
+        """Nothing to do: there is one file per cluster and key."""
+        pass
+
+
+class PackedDiskStore(object):
+    """Store cluster-related data in a single append-only file per key.
+
+    The data of a given key is stored in a `key.data` file. A `key.index`
+    file holds the extents `(cluster, offset, n_bytes)` of all clusters in
+    the data file. The data of a cluster may be spread over several
+    extents if it was appended in several times. The data of new clusters
+    is appended to the files, and the data of old clusters is only removed
+    from the files by `compact()`.
+
+    Loaded arrays are read-only memory-mapped views on the data file when
+    the cluster data is contiguous.
+
+    """
+    # An extent with this size marks the deletion of all previous extents
+    # of a cluster.
+    _deleted = -1
+
+    def __init__(self, directory):
+        assert directory is not None
+        self._allowed_extensions = set()
+        self._directory = op.realpath(op.expanduser(directory))
+        # key => {cluster: [(offset, n_bytes), ...]}
+        self._extents = {}
+        # key => size of the data file
+        self._sizes = {}
+        # key => memory-mapped data file
+        self._maps = {}
+
+    @property
+    def path(self):
+        return self._directory
+
+    # Internal methods
+    # -------------------------------------------------------------------------
+
+    def _check_extension(self, key):
+        if key not in self._allowed_extensions:
+            raise RuntimeError("The extension '{0}' ".format(key) +
+                               "hasn't been registered.")
+
+    def _data_path(self, key):
+        return op.join(self._directory, '{0:s}.data'.format(key))
+
+    def _index_path(self, key):
+        return op.join(self._directory, '{0:s}.index'.format(key))
+
+    def _read_index(self, key):
+        """Load the index of a key from disk."""
+        extents = {}
+        path = self._index_path(key)
+        if op.exists(path):
+            records = np.fromfile(path, dtype=np.int64).reshape((-1, 3))
+            for cluster, offset, n_bytes in records.tolist():
+                if n_bytes == self._deleted:
+                    extents.pop(cluster, None)
+                else:
+                    extents.setdefault(cluster, []).append((offset, n_bytes))
+        data_path = self._data_path(key)
+        self._sizes[key] = (os.stat(data_path).st_size
+                            if op.exists(data_path) else 0)
+        self._extents[key] = extents
+        self._maps.pop(key, None)
+
+    def _append_index(self, key, records):
+        with open(self._index_path(key), 'ab') as f:
+            np.array(records, dtype=np.int64).tofile(f)
+
+    def _map(self, key, end):
+        """Return the memory-mapped data file of a key, containing at least
+        `end` bytes."""
+        m = self._maps.get(key, None)
+        if m is None or len(m) < end:
+            m = np.memmap(self._data_path(key), dtype=np.uint8, mode='r')
+            self._maps[key] = m
+        return m
+
+    def _get(self, cluster, key, dtype=None, shape=None):
+        extents = self._extents.get(key, {}).get(_as_int(cluster), None)
+        if extents is None:
+            return None
+        dtype = np.dtype(dtype) if dtype is not None else np.dtype(np.uint8)
+        end = max([offset + n_bytes for offset, n_bytes in extents] + [0])
+        if end == 0:
+            # Empty arrays cannot be memory-mapped.
+            arr = np.zeros(0, dtype=dtype)
+        else:
+            m = self._map(key, end)
+            parts = [m[offset:offset + n_bytes].view(dtype)
+                     for offset, n_bytes in extents]
+            arr = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        if shape is not None:
+            arr = arr.reshape(shape)
+        return arr
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    def register_file_extensions(self, extensions):
+        """Register the keys that can be stored."""
+        if isinstance(extensions, string_types):
+            extensions = [extensions]
+        assert isinstance(extensions, list)
+        for extension in extensions:
+            self._allowed_extensions.add(extension)
+            if extension not in self._extents:
+                self._read_index(extension)
+
+    def store(self, cluster, append=False, **data):
+        """Append a NumPy array to the data file of every key."""
+        cluster = _as_int(cluster)
+        for key, value in data.items():
+            assert isinstance(value, np.ndarray)
+            self._check_extension(key)
+            records = []
+            if not append and cluster in self._extents[key]:
+                del self._extents[key][cluster]
+                records.append((cluster, 0, self._deleted))
+            offset = self._sizes[key]
+            with open(self._data_path(key), 'ab') as f:
+                value.tofile(f)
+            n_bytes = value.nbytes
+            self._sizes[key] = offset + n_bytes
+            extents = self._extents[key].setdefault(cluster, [])
+            extents.append((offset, n_bytes))
+            records.append((cluster, offset, n_bytes))
+            self._append_index(key, records)
+
+    def load(self, cluster, keys, dtype=None, shape=None):
+        """Load cluster-related data. Without dtype, return the raw
+        bytes."""
+        assert keys is not None
+        if isinstance(keys, string_types):
+            return self._get(cluster, keys, dtype=dtype, shape=shape)
+        assert isinstance(keys, list)
+        return {key: self._get(cluster, key, dtype=dtype, shape=shape)
+                for key in keys}
+
+    def size(self, cluster, key):
+        """Return the size in bytes of some cluster data, or None if it
+        doesn't exist."""
+        extents = self._extents.get(key, {}).get(_as_int(cluster), None)
+        if extents is None:
+            return None
+        return sum(n_bytes for _, n_bytes in extents)
+
+    def assume_sizes(self, sizes):
+        """Nothing to do: the sizes are known from the index files."""
+        pass
+
+    @property
+    def files(self):
+        """List of files present in the directory."""
+        if not op.exists(self._directory):
+            return []
+        files = []
+        for key in sorted(self._allowed_extensions):
+            for path in (self._data_path(key), self._index_path(key)):
+                if op.exists(path):
+                    files.append(op.basename(path))
+        return files
+
+    @property
+    def cluster_ids(self):
+        """List of cluster ids in the store."""
+        clusters = set()
+        for extents in self._extents.values():
+            clusters.update(extents)
+        return sorted(clusters)
+
+    def erase(self, clusters):
+        """Delete some clusters from the store.
+
+        The data remains in the data files until the next compaction.
+
+        """
+        for key, extents in self._extents.items():
+            records = [(cluster, 0, self._deleted) for cluster in clusters
+                       if extents.pop(_as_int(cluster), None) is not None]
+            if records:
+                self._append_index(key, records)
+
+    def clear(self):
+        """Clear the store completely by deleting all files."""
+        for key in list(self._extents):
+            for path in (self._data_path(key), self._index_path(key)):
+                if op.exists(path):
+                    os.remove(path)
+            self._read_index(key)
+
+    def compact(self):
+        """Rewrite the files so that the data of every cluster is contiguous,
+        and the data of erased clusters is removed."""
+        for key, extents in self._extents.items():
+            path = self._data_path(key)
+            if not op.exists(path):
+                continue
+            # Nothing to do if the data file has no hole and every cluster
+            # has a single extent.
+            n_bytes = sum(n for e in extents.values() for _, n in e)
+            if (n_bytes == self._sizes[key] and
+                    all(len(e) == 1 for e in extents.values())):
+                continue
+            records = []
+            offset = 0
+            with open(path + '.tmp', 'wb') as f:
+                for cluster in sorted(extents):
+                    data = self._get(cluster, key)
+                    data.tofile(f)
+                    records.append((cluster, offset, data.nbytes))
+                    offset += data.nbytes
+            with open(self._index_path(key) + '.tmp', 'wb') as f:
+                np.array(records, dtype=np.int64).reshape((-1, 3)).tofile(f)
+            self._maps.pop(key, None)
+            # Existing memory maps remain valid on the old files.
+            for p in (path, self._index_path(key)):
+                if op.exists(p):
+                    os.remove(p)
+                os.rename(p + '.tmp', p)
+            self._read_index(key)
+            debug("Compacted the cluster store file {0}.".format(path))
+
+
+class DiskStoreBuffer(object):
+    """Gather the appends to a disk store in memory, and write them in
+    larger appends.
+
+    The buffered arrays of all clusters are written when their total size
+    exceeds `max_size` bytes, and when `flush()` is called. The data on
+    disk is identical to what individual appends would produce.
+
+    This class is not thread-safe.
+
+    """
+    def __init__(self, disk_store, max_size=None):
+        self._disk_store = disk_store
+        self.max_size = max_size
+        # cluster => {key: [arrays]}
+        self._buffers = {}
+        self.size = 0
+        # Number of buffered appends, and number of arrays actually
+        # written to the disk store.
+        self.n_appends = 0
+        self.n_writes = 0
+
+    def store(self, cluster, **data):
+        """Append some arrays to a cluster in the buffer."""
+        buffers = self._buffers.setdefault(cluster, {})
+        for key, value in data.items():
+            assert isinstance(value, np.ndarray)
+            buffers.setdefault(key, []).append(value)
+            self.size += value.nbytes
+            self.n_appends += 1
+        if self.max_size is not None and self.size > self.max_size:
+            self.flush()
+
+    def flush(self):
+        """Write all buffered data to the disk store."""
+        for cluster in sorted(self._buffers):
+            data = {key: np.concatenate(arrays) if len(arrays) > 1
+                    else arrays[0]
+                    for key, arrays in self._buffers[cluster].items()}
+            self._disk_store.store(cluster, append=True, **data)
+            self.n_writes += len(data)
+        self._buffers = {}
+        self.size = 0
+
 
 #------------------------------------------------------------------------------
 # Cluster store
 #------------------------------------------------------------------------------
 
+def _disk_store(path, backend=None):
+    """Create a disk store with a given backend: 'files' (default) for one
+    file per cluster and key, or 'packed' for one file per key."""
+    if backend in (None, 'files'):
+        return DiskStore(path)
+    elif backend == 'packed':
+        return PackedDiskStore(path)
+    raise ValueError("The backend should be 'files' or 'packed'.")
+
+
 class ClusterStore(object):
     """Hold per-cluster information on disk and in memory.
 
@@ -242,14 +678,28 @@ class ClusterStore(object):
     and are kept in memory afterwards. All data is dynamically updated
     when clustering changes occur.
 
+    The memory store can be bounded with `memory_size` (in bytes). The data
+    of the least-recently used clusters is then spilled to the disk store
+    directory, or recomputed by the store items when there is no disk
+    store.
+
     """
-    def __init__(self, model=None, path=None):
+    def __init__(self, model=None, path=None, backend=None,
+                 memory_size=None):
         self._model = model
         self._spikes_per_cluster = {}
-        self._memory = MemoryStore()
-        self._disk = DiskStore(path) if path is not None else None
+        spill_dir = (op.join(path, 'memory')
+                     if path is not None and memory_size is not None
+                     else None)
+        self._memory = MemoryStore(max_size=memory_size, spill_dir=spill_dir)
+        self._disk = (_disk_store(path, backend=backend)
+                      if path is not None else None)
         self._items = []
         self._locations = {}
+        # field name => store item
+        self._field_items = {}
+        # Last manifest read from or written to the disk store.
+        self._manifest = None
 
     def _store(self, location):
         if location == 'memory':
@@ -325,8 +775,9 @@ class ClusterStore(object):
         # functions are closed over names, not values. Here we
         # want 'name' to refer to the 'name' local variable.
         def _make_func(name, location):
-            kwargs = {} if location == 'memory' else {'dtype': dtype,
-                                                      'shape': shape}
+            if location == 'memory':
+                return lambda cluster: self._load_memory(cluster, name)
+            kwargs = {'dtype': dtype, 'shape': shape}
             return lambda cluster: self._store(location).load(cluster,
                                                               name,
                                                               **kwargs)
@@ -351,6 +802,8 @@ class ClusterStore(object):
         A StoreItem class is responsible for storing some data to disk
         and memory. It must register one or several pieces of data.
 
+        Return the StoreItem instance.
+
         """
 
         # Instantiate the item.
@@ -368,25 +821,57 @@ class ClusterStore(object):
             shape = field[3] if len(field) == 4 else None
 
             self.register_field(name, location, dtype=dtype, shape=shape)
+            self._field_items[name] = item
 
         # Register the StoreItem instance.
         self._items.append(item)
+        return item
+
+    def _load_memory(self, cluster, name):
+        """Load a field from the memory store. Data that has been discarded
+        from memory is computed again by the store item."""
+        value = self._memory.load(cluster, name)
+        item = self._field_items.get(name, None)
+        if (value is None and item is not None and
+                cluster in self._spikes_per_cluster):
+            item.store_cluster(cluster, self._spikes_per_cluster[cluster])
+            value = self._memory.load(cluster, name)
+        return value
 
     def load(self, name, clusters, spikes):
-        """Load some data for a number of clusters and spikes."""
-        # TODO: remove spikes as a parameter here, as it can be
-        # obtained from self.spikes_per_cluster.
+        """Load some data for a number of clusters and spikes.
+
+        The rows of the requested spikes are found in the sorted spikes of
+        every cluster, and only these rows are read from the (possibly
+        memory-mapped) data of the clusters. The output is a new array with
+        the rows in the order of `spikes`.
+
+        """
         assert _is_array_like(clusters)
         load = getattr(self, name)
+        spikes = np.asarray(spikes)
 
-        # Concatenation of arrays for all clusters.
-        arrays = np.concatenate([load(cluster) for cluster in clusters])
-        # Concatenation of spike indices for all clusters.
-        spike_clusters = np.concatenate([self._spikes_per_cluster[cluster]
-                                         for cluster in clusters])
-        assert np.all(np.in1d(spikes, spike_clusters))
-        idx = _index_of(spikes, spike_clusters)
-        return arrays[idx, ...]
+        out = None
+        found = np.zeros(len(spikes), dtype=np.bool)
+        for cluster in clusters:
+            cluster_spikes = self._spikes_per_cluster[cluster]
+            # Relative row of every requested spike in the cluster.
+            rows = np.searchsorted(cluster_spikes, spikes)
+            rows[rows == len(cluster_spikes)] = 0
+            if len(cluster_spikes):
+                in_cluster = cluster_spikes[rows] == spikes
+            else:
+                in_cluster = np.zeros(len(spikes), dtype=np.bool)
+            if out is not None and not np.any(in_cluster):
+                continue
+            data = load(cluster)
+            if out is None:
+                out = np.empty((len(spikes),) + data.shape[1:],
+                               dtype=data.dtype)
+            out[in_cluster] = data[rows[in_cluster]]
+            found |= in_cluster
+        assert out is not None and np.all(found)
+        return out
 
     def on_cluster(self, up):
         """Update the cluster store when clustering changes occur.
@@ -398,6 +883,9 @@ class ClusterStore(object):
         # them for possible undo, and regularly clean up the store.
         for item in self._items:
             item.on_cluster(up)
+        # The files of the new clusters may have been overwritten.
+        if up is not None and up.history is None:
+            self._forget_manifest_clusters(up.added)
 
     # Files
     #--------------------------------------------------------------------------
@@ -419,6 +907,165 @@ class ClusterStore(object):
         """List of files present in the disk store."""
         return self.disk_store.files
 
+    # Manifest
+    #--------------------------------------------------------------------------
+
+    @property
+    def manifest_path(self):
+        """Path to the manifest of the disk store."""
+        return op.join(self.path, 'manifest.json')
+
+    def _disk_fields(self):
+        return sorted(name for name, location in self._locations.items()
+                      if location == 'disk')
+
+    def _read_manifest(self):
+        """Read the manifest, or return None if it is missing, invalid,
+        or stale."""
+        path = self.manifest_path
+        if not op.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                manifest = json.load(f)
+        except ValueError:
+            debug("The cluster store manifest is invalid.")
+            return None
+        if (manifest.get('kwik_mtime') != _kwik_mtime(self._model) or
+                manifest.get('fields') != self._disk_fields()):
+            debug("The cluster store manifest is stale.")
+            return None
+        return manifest
+
+    def _write_manifest(self, manifest):
+        with open(self.manifest_path, 'w') as f:
+            json.dump(manifest, f)
+        self._manifest = manifest
+
+    def _remove_manifest(self):
+        """Remove the manifest file. The manifest is kept in memory, so that
+        the digests of the spikes do not need to be computed again when it
+        is saved."""
+        if op.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    def _invalidate_manifest(self, mode):
+        """Remove the manifest file before some files of the disk store are
+        regenerated.
+
+        An interrupted generation leaves missing or partial files: the
+        manifest should not vouch for them at the next opening. It is
+        written again at the end of the generation.
+
+        """
+        if self._disk is None or not op.exists(self.manifest_path):
+            return
+        disk_fields = set(self._disk_fields())
+        for item in self._items:
+            if not any(field[0] in disk_fields for field in item.fields):
+                continue
+            if item.to_generate(mode):
+                self._remove_manifest()
+                return
+
+    def _load_manifest(self):
+        """Pass the file sizes recorded in the manifest to the disk store.
+
+        The sizes are used for the clusters with the same spikes as in the
+        manifest. The files of the clusters with different spikes are
+        deleted.
+
+        """
+        manifest = self._read_manifest()
+        self._manifest = manifest
+        if manifest is None:
+            return
+        # If the clustering has not changed, there is no need to check
+        # the spikes of every cluster.
+        unchanged = (manifest.get('spike_clusters') ==
+                     _spike_clusters_digest(self._spikes_per_cluster))
+        entries = manifest.get('clusters', {})
+        sizes = {}
+        stale = []
+        for cluster, spikes in self._spikes_per_cluster.items():
+            entry = entries.get(str(cluster), None)
+            if entry is None:
+                continue
+            if (entry['n_spikes'] == len(spikes) and
+                    (unchanged or entry['spikes'] == _spikes_digest(spikes))):
+                sizes[cluster] = entry['sizes']
+            else:
+                stale.append(cluster)
+        self.disk_store.assume_sizes(sizes)
+        self.disk_store.erase(stale)
+        debug("{0:d}/{1:d} clusters found in the cluster store "
+              "manifest.".format(len(sizes), len(self._spikes_per_cluster)))
+
+    def save_manifest(self, spikes_per_cluster=None):
+        """Write the manifest of the disk store.
+
+        The manifest contains the number of spikes, a digest of the spikes,
+        and the file sizes of every cluster, along with the modification
+        time of the kwik file and a digest of the spike clusters. When
+        the store is opened again, the manifest replaces the file size
+        checks of all unchanged clusters.
+
+        This should be called when the current clustering is saved to the
+        kwik file.
+
+        Parameters
+        ----------
+
+        spikes_per_cluster : dict
+            The current clustering. By default, this is the clustering
+            used to generate the store.
+
+        """
+        if self._disk is None:
+            return
+        spc = (spikes_per_cluster if spikes_per_cluster is not None
+               else self._spikes_per_cluster)
+        fields = self._disk_fields()
+        digest = _spike_clusters_digest(spc)
+        # The digests of the spikes are known if the clustering is the same.
+        old = {}
+        if (self._manifest is not None and
+                self._manifest.get('spike_clusters') == digest):
+            old = self._manifest.get('clusters', {})
+        entries = {}
+        for cluster, spikes in spc.items():
+            entry = old.get(str(cluster), None)
+            # The sizes of unchanged files are known by the disk store.
+            sizes = {name: self.disk_store.size(cluster, name)
+                     for name in fields}
+            entries[str(cluster)] = {'n_spikes': len(spikes),
+                                     'spikes': (entry['spikes'] if entry
+                                                else _spikes_digest(spikes)),
+                                     'sizes': sizes,
+                                     }
+        manifest = {'kwik_mtime': _kwik_mtime(self._model),
+                    'spike_clusters': digest,
+                    'fields': fields,
+                    'clusters': entries,
+                    }
+        # Do not write the same manifest again.
+        if (manifest != self._manifest or
+                not op.exists(self.manifest_path)):
+            self._write_manifest(manifest)
+
+    def _forget_manifest_clusters(self, clusters):
+        """Remove clusters from the manifest file."""
+        if self._manifest is None:
+            return
+        entries = self._manifest['clusters']
+        keys = [str(cluster) for cluster in clusters
+                if str(cluster) in entries]
+        if not keys:
+            return
+        for key in keys:
+            del entries[key]
+        self._write_manifest(self._manifest)
+
     # Status
     #--------------------------------------------------------------------------
 
@@ -449,6 +1096,10 @@ class ClusterStore(object):
         n_old = len(invalid)
         size = self.total_size / (1024. ** 2)
         consistent = str(self.is_consistent()).rjust(5)
+        memory = self._memory
+        memory_size = memory.size / (1024. ** 2)
+        memory_max = ('{0:.0f}'.format(memory.max_size / (1024. ** 2))
+                      if memory.max_size is not None else 'unbounded')
 
         status = ''
         header = "Cluster store status ({0})".format(self.path)
@@ -458,6 +1109,14 @@ class ClusterStore(object):
         status += "Number of old clusters            {0: 4d}\n".format(n_old)
         status += "Total size (MB)                {0: 7.0f}\n".format(size)
         status += "Consistent                       {0}\n".format(consistent)
+        status += "Memory size (MB)               {0: 7.0f} / {1}\n".format(
+            memory_size, memory_max)
+        status += "Memory evictions                 {0: 5d}\n".format(
+            memory.n_evictions)
+        status += "Clusters spilled to disk         {0: 5d}\n".format(
+            memory.n_spilled)
+        status += "Clusters reloaded from disk      {0: 5d}\n".format(
+            memory.n_reloads)
         return status
 
     def display_status(self):
@@ -469,6 +1128,8 @@ class ClusterStore(object):
 
     def clear(self):
         """Erase all files in the store."""
+        self._remove_manifest()
+        self._manifest = None
         self.memory_store.clear()
         self.disk_store.clear()
         info("Cluster store cleared.")
@@ -478,6 +1139,8 @@ class ClusterStore(object):
         to_delete = self.old_clusters
         self.memory_store.erase(to_delete)
         self.disk_store.erase(to_delete)
+        self._forget_manifest_clusters(to_delete)
+        self.disk_store.compact()
         n = len(to_delete)
         info("{0} clusters deleted from the cluster store.".format(n))
 
@@ -511,8 +1174,16 @@ class ClusterStore(object):
         else:
             name = 'the current model'
         debug("Initializing the cluster store for {0:s}...".format(name))
+        # The manifest avoids checking the files of every cluster.
+        if self._disk is not None and mode in (None, 'default'):
+            self._load_manifest()
+        self._invalidate_manifest(mode)
         for item in self._items:
             item.store_all_clusters(mode)
+        if self._disk is not None and mode != 'read-only':
+            # Make the data of every cluster contiguous on disk.
+            self._disk.compact()
+            self.save_manifest()
         debug("Done!")
 
 
@@ -16,6 +16,8 @@ from pytest import raises
 from .._utils import _spikes_in_clusters
 from ..session import BaseSession, Session, FeatureMasks
 from ....utils.testing import show_test
+from ....stats.ccg import correlograms, _symmetrize_correlograms
+from ....stats.metrics import cluster_metrics
 from ....utils.tempdir import TemporaryDirectory
 from ....utils.logging import set_level
 from ....io.mock.artificial import MockModel
@@ -197,6 +199,210 @@ def test_session_store():
     FeatureMasks.chunk_size = cs
 
 
+def test_session_store_interrupted():
+    """Reopen a session after an interrupted regeneration of the cluster
+    store."""
+
+    def _interrupted(self):
+        raise RuntimeError("Interrupted.")
+        yield
+
+    with TemporaryDirectory() as tempdir:
+        model = MockModel(n_spikes=50, n_clusters=3)
+        s0 = np.nonzero(model.spike_clusters == 0)[0]
+
+        session = _start_manual_clustering(model=model,
+                                           tempdir=tempdir)
+        cs = session.cluster_store
+        assert op.exists(cs.manifest_path)
+
+        # The generation is interrupted after the files have been erased.
+        iter_chunks = FeatureMasks._iter_chunks
+        FeatureMasks._iter_chunks = _interrupted
+        try:
+            with raises(RuntimeError):
+                cs.generate(mode='force')
+        finally:
+            FeatureMasks._iter_chunks = iter_chunks
+        assert not op.exists(cs.manifest_path)
+
+        # The missing files are regenerated at the next opening.
+        session = _start_manual_clustering(model=model,
+                                           tempdir=tempdir)
+        cs = session.cluster_store
+        assert cs.is_consistent()
+        assert op.exists(cs.manifest_path)
+        ac(cs.features(0), model.features[s0].reshape((len(s0), -1, 2)),
+           1e-3)
+        ac(cs.sum_masks(0), model.masks[s0].sum(axis=0), rtol=1e-5)
+
+
+def test_session_store_waveforms():
+    """Check the mean and std waveforms in the cluster store."""
+
+    with TemporaryDirectory() as tempdir:
+        model = MockModel(n_spikes=50, n_clusters=3)
+        session = _start_manual_clustering(model=model,
+                                           tempdir=tempdir)
+        cs = session.cluster_store
+
+        # The store is consistent right after it has been generated, and
+        # the statistics are only computed on demand.
+        assert cs.is_consistent()
+        assert not cs.memory_store.has(0, 'mean_waveforms')
+
+        def _check_stats(cluster):
+            spikes = session.clustering.spikes_per_cluster[cluster]
+            waveforms = model.waveforms[spikes]
+            ac(cs.mean_waveforms(cluster), waveforms.mean(axis=0))
+            ac(cs.std_waveforms(cluster), waveforms.std(axis=0))
+            assert cs.n_waveforms(cluster) == len(spikes)
+
+        _check_stats(0)
+        _check_stats(1)
+
+        # The statistics of the merged cluster are combined, not reloaded.
+        session.merge([0, 1])
+        _check_stats(3)
+
+        # Only the new clusters are sampled after a split.
+        session.split([2, 3, 5, 7])
+        for cluster in session.clustering.cluster_ids:
+            _check_stats(cluster)
+
+        # The old statistics are kept for undo.
+        session.undo()
+        _check_stats(3)
+        session.redo()
+        for cluster in session.clustering.cluster_ids:
+            _check_stats(cluster)
+
+
+def test_session_store_metrics():
+    """Check the cluster metrics in the cluster store."""
+
+    with TemporaryDirectory() as tempdir:
+        model = MockModel(n_spikes=200, n_clusters=4)
+        session = _start_manual_clustering(model=model,
+                                           tempdir=tempdir)
+        cs = session.cluster_store
+
+        def _check_metrics():
+            m = cluster_metrics(model.spike_samples, model.spike_clusters,
+                                20000.,
+                                duration=model.traces.shape[0] / 20000.)
+            for i, cluster in enumerate(m['clusters']):
+                ac(cs.firing_rate(cluster), m['firing_rates'][i])
+                ae(cs.refractory_violations(cluster),
+                   m['refractory_violations'][i])
+                ae(cs.isi_histogram(cluster), m['isi_histograms'][i])
+
+        _check_metrics()
+        session.merge([0, 1])
+        _check_metrics()
+        session.split([2, 3, 5, 7])
+        _check_metrics()
+
+
+def test_session_store_masks():
+    """Check the mask statistics in the cluster store."""
+
+    with TemporaryDirectory() as tempdir:
+        model = MockModel(n_spikes=200, n_clusters=4)
+        session = _start_manual_clustering(model=model,
+                                           tempdir=tempdir)
+        cs = session.cluster_store
+        positions = model.probe.positions
+
+        def _check_masks():
+            for cluster in session.clustering.cluster_ids:
+                masks = cs.masks(cluster)
+                mean_masks = masks.mean(axis=0)
+                unmasked = np.nonzero(mean_masks > .1)[0]
+                ac(cs.sum_masks(cluster), masks.sum(axis=0), rtol=1e-5)
+                ac(cs.mean_masks(cluster), mean_masks, rtol=1e-5)
+                assert cs.n_unmasked_channels(cluster) == len(unmasked)
+                ae(sorted(cs.main_channels(cluster)), unmasked)
+                ae(np.argsort(mean_masks[cs.main_channels(cluster)]),
+                   np.arange(len(unmasked))[::-1])
+                ac(cs.mean_probe_position(cluster),
+                   (positions * mean_masks[:, np.newaxis]).mean(axis=0),
+                   rtol=1e-5)
+
+        _check_masks()
+        session.merge([0, 1])
+        _check_masks()
+        session.split([2, 3, 5, 7])
+        _check_masks()
+        session.undo()
+        _check_masks()
+
+
+def test_session_correlogram_cache():
+    """Check the CCG cache in the cluster store."""
+
+    with TemporaryDirectory() as tempdir:
+        model = MockModel(n_spikes=200, n_clusters=4)
+        session = _start_manual_clustering(model=model,
+                                           tempdir=tempdir)
+        cache = session.correlogram_cache
+        # The cache is disabled by default.
+        assert cache.cache.max_size == 0
+        cache.cache.max_size = None
+
+        def _check_ccgs(clusters, binsize=5, winsize_bins=11, **kwargs):
+            spikes = _spikes_in_clusters(model.spike_clusters, clusters)
+            expected = correlograms(model.spike_samples[spikes],
+                                    model.spike_clusters[spikes],
+                                    binsize=binsize,
+                                    winsize_bins=winsize_bins)
+            expected = _symmetrize_correlograms(expected)
+            # The expected CCGs are in the order of the sorted clusters.
+            idx = np.argsort(np.argsort(clusters))
+            ccgs = cache.correlograms(clusters, binsize, winsize_bins,
+                                      **kwargs)
+            ae(ccgs, expected[idx][:, idx])
+
+        _check_ccgs([0, 1, 2])
+        assert cache.cache.n_hits == 0
+        assert len(cache.cache) == 6
+
+        # The cached pairs are not recomputed, in any order.
+        _check_ccgs([2, 0])
+        assert cache.cache.n_hits == 3
+        _check_ccgs([3, 1])
+        assert len(cache.cache) == 8
+
+        # The CCGs of the merged cluster are derived from the cached CCGs,
+        # and the CCGs of the deleted clusters are removed from the cache.
+        session.merge([0, 1])
+        # (0, 3) is not in the cache, so (3, 4) cannot be derived.
+        assert sorted(key[:2] for key in cache.cache.keys()) == \
+            [(2, 2), (2, 4), (3, 3), (4, 4)]
+        n_misses = cache.cache.n_misses
+        _check_ccgs([4, 2, 3])
+        assert cache.cache.n_misses == n_misses + 2
+
+        # CCGs rebinned from a base resolution.
+        n = len(cache.cache)
+        _check_ccgs([2, 4], base_binsize=1, base_winsize_bins=61)
+        assert len(cache.cache) == n + 3
+        _check_ccgs([4, 2], binsize=3, winsize_bins=19,
+                    base_binsize=1, base_winsize_bins=61)
+        _check_ccgs([2], binsize=10, winsize_bins=3,
+                    base_binsize=1, base_winsize_bins=61)
+        assert len(cache.cache) == n + 3
+
+        # Merge clusters whose CCGs are all in the cache.
+        _check_ccgs([2, 3, 4])
+        session.merge([2, 3, 4])
+        n_misses = cache.cache.n_misses
+        _check_ccgs([5])
+        _check_ccgs([5], binsize=3, winsize_bins=19,
+                    base_binsize=1, base_winsize_bins=61)
+        assert cache.cache.n_misses == n_misses + 1
+
+
 def test_session_mock():
     with TemporaryDirectory() as tempdir:
         session = _start_manual_clustering(model=MockModel(),
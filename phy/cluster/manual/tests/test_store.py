@@ -16,7 +16,10 @@ from numpy.testing import assert_allclose as ac
 from ....utils._misc import Bunch
 from ....utils.tempdir import TemporaryDirectory
 from ....utils.logging import set_level
-from ..store import MemoryStore, DiskStore, ClusterStore, StoreItem
+from ....utils.testing import benchmark
+from ..store import (MemoryStore, DiskStore, DiskStoreBuffer,
+                     PackedDiskStore,
+                     ClusterStore, StoreItem)
 from .._utils import _spikes_per_cluster, UpdateInfo
 
 
@@ -58,6 +61,71 @@ def test_memory_store():
     assert ms.cluster_ids == []
 
 
+def test_memory_store_bounded():
+    with TemporaryDirectory() as tempdir:
+        # 80 bytes per cluster, and at most 3 clusters in memory.
+        ms = MemoryStore(max_size=250, spill_dir=tempdir)
+        for cluster in range(5):
+            ms.store(cluster, a=np.zeros(5) + cluster, b=np.zeros(5))
+        assert ms.size == 240
+        assert ms.n_evictions == 2
+        assert ms.n_spilled == 2
+        assert sorted(os.listdir(tempdir)) == ['0.pkl', '1.pkl']
+        assert ms.cluster_ids == [0, 1, 2, 3, 4]
+
+        # Load a spilled cluster: the least-recently used one is spilled.
+        ae(ms.load(0, 'a'), np.zeros(5))
+        assert ms.n_reloads == 1
+        assert sorted(os.listdir(tempdir)) == ['1.pkl', '2.pkl']
+
+        # Update a spilled cluster.
+        ms.store(1, c=3)
+        ae(ms.load(1, 'a'), np.ones(5))
+        assert ms.load(1, 'c') == 3
+        assert ms.n_reloads == 2
+
+        # Check the presence of some data without reloading it.
+        n_reloads = ms.n_reloads
+        spilled = sorted(os.listdir(tempdir))
+        assert all(ms.has(cluster, 'a') for cluster in range(5))
+        assert not ms.has(0, 'c')
+        assert not ms.has(5, 'a')
+        assert ms.n_reloads == n_reloads
+        assert sorted(os.listdir(tempdir)) == spilled
+
+        # A cluster larger than the store is spilled once, and read from
+        # disk without evicting the other clusters.
+        in_memory = ms._ds.keys()
+        ms.store(5, a=np.zeros(50))
+        assert ms._ds.keys() == in_memory
+        assert '5.pkl' in os.listdir(tempdir)
+        n_reloads = ms.n_reloads
+        for _ in range(3):
+            ae(ms.load(5, 'a'), np.zeros(50))
+        assert ms.n_reloads == n_reloads + 3
+        assert ms._ds.keys() == in_memory
+        assert '5.pkl' in os.listdir(tempdir)
+        ms.store(5, b=1)
+        ae(ms.load(5, 'a'), np.zeros(50))
+        assert ms.load(5, 'b') == 1
+        ms.erase([5])
+        assert '5.pkl' not in os.listdir(tempdir)
+
+        ms.erase([2, 3])
+        assert ms.cluster_ids == [0, 1, 4]
+        assert ms.load(2) == {}
+        ms.clear()
+        assert ms.cluster_ids == []
+        assert os.listdir(tempdir) == []
+
+    # Without spill directory, the evicted data is discarded.
+    ms = MemoryStore(max_size=100)
+    ms.store(0, a=np.zeros(10))
+    ms.store(1, a=np.zeros(10))
+    assert ms.cluster_ids == [1]
+    assert ms.load(0, 'a') is None
+
+
 def test_disk_store():
 
     dtype = np.float32
@@ -88,6 +156,10 @@ def test_disk_store():
         loaded = ds.load(3, 'key', dtype=dtype, shape=sha)
         ac(loaded, a)
 
+        # The data is memory-mapped and read-only.
+        assert isinstance(loaded, np.memmap)
+        assert not loaded.flags.writeable
+
         # Loading a non-existing key returns None.
         assert ds.load(3, 'key_bis') is None
         assert ds.cluster_ids == [3]
@@ -107,11 +179,175 @@ def test_disk_store():
         ac(ds.load(3, 'key_bis', dtype=dtype, shape=shb), b)
         assert ds.cluster_ids == [3]
 
-        ds.erase([2, 3])
+        # Empty files.
+        ds.store(4, key=np.zeros((0, 4), dtype=dtype))
+        loaded = ds.load(4, 'key', dtype=dtype, shape=(-1, 4))
+        assert loaded.shape == (0, 4)
+        assert not loaded.flags.writeable
+
+        ds.erase([2, 3, 4])
         assert ds.load(3, ['key']) == {'key': None}
         assert ds.cluster_ids == []
 
 
+def test_packed_disk_store():
+    dtype = np.float32
+    a = np.random.rand(2, 4).astype(dtype)
+    b = np.random.rand(3, 4).astype(dtype)
+
+    with TemporaryDirectory() as tempdir:
+        ds = PackedDiskStore(tempdir)
+        ds.register_file_extensions(['key', 'key_bis'])
+        assert ds.cluster_ids == []
+        assert ds.files == []
+
+        ds.store(3, key=a)
+        ds.store(5, key=b, key_bis=a)
+        ds.store(3, key=b, append=True)
+        ds.store(7, key=np.zeros((0, 4), dtype=dtype))
+        assert ds.cluster_ids == [3, 5, 7]
+        assert ds.files == ['key.data', 'key.index',
+                            'key_bis.data', 'key_bis.index']
+
+        def _check(ds):
+            ac(ds.load(3, 'key', dtype=dtype, shape=(-1, 4)), np.r_[a, b])
+            ac(ds.load(5, 'key', dtype=dtype, shape=(-1, 4)), b)
+            assert ds.load(7, 'key', dtype=dtype, shape=(-1, 4)).shape == \
+                (0, 4)
+            d = ds.load(5, ['key_bis', 'key'], dtype=dtype)
+            ac(d['key_bis'], a.ravel())
+            assert ds.load(3, 'key_bis') is None
+            assert ds.size(3, 'key') == a.nbytes + b.nbytes
+            assert ds.size(3, 'key_bis') is None
+
+        _check(ds)
+
+        # Contiguous data is a read-only memory map.
+        loaded = ds.load(5, 'key', dtype=dtype)
+        assert isinstance(loaded, np.memmap)
+        assert not loaded.flags.writeable
+
+        # Replace some data.
+        ds.store(5, key_bis=b)
+        ac(ds.load(5, 'key_bis', dtype=dtype, shape=(-1, 4)), b)
+        ds.store(5, key_bis=a)
+
+        # Reopen the store.
+        ds = PackedDiskStore(tempdir)
+        ds.register_file_extensions(['key', 'key_bis'])
+        _check(ds)
+
+        # Erase and compact.
+        size = os.stat(op.join(tempdir, 'key.data')).st_size
+        ds.erase([5, 11])
+        assert ds.cluster_ids == [3, 7]
+        assert ds.load(5, 'key') is None
+        ds.compact()
+        assert os.stat(op.join(tempdir, 'key.data')).st_size == \
+            size - b.nbytes
+        assert isinstance(ds.load(3, 'key', dtype=dtype), np.memmap)
+        ac(ds.load(3, 'key', dtype=dtype, shape=(-1, 4)), np.r_[a, b])
+
+        ds = PackedDiskStore(tempdir)
+        ds.register_file_extensions(['key', 'key_bis'])
+        assert ds.cluster_ids == [3, 7]
+        ac(ds.load(3, 'key', dtype=dtype, shape=(-1, 4)), np.r_[a, b])
+
+        ds.clear()
+        assert ds.cluster_ids == []
+        assert ds.files == []
+
+
+def test_disk_store_benchmark():
+    n_clusters = 2000
+    data = [np.random.rand(np.random.randint(10, 100), 32).astype(np.float32)
+            for _ in range(n_clusters)]
+
+    for cls in (DiskStore, PackedDiskStore):
+        with TemporaryDirectory() as tempdir:
+            ds = cls(tempdir)
+            ds.register_file_extensions(['features', 'masks'])
+            for cluster, arr in enumerate(data):
+                ds.store(cluster, features=arr, masks=arr[:, ::4].copy())
+            ds.compact()
+
+            name = cls.__name__
+            with benchmark('Open {0}'.format(name)):
+                ds = cls(tempdir)
+                ds.register_file_extensions(['features', 'masks'])
+                clusters = ds.cluster_ids
+            assert len(clusters) == n_clusters
+            with benchmark('Load {0} clusters from {1}'.format(
+                           n_clusters, name)):
+                for cluster in clusters:
+                    ds.load(cluster, ['features', 'masks'],
+                            dtype=np.float32)
+            # Two files per cluster, or a data and an index file per
+            # extension.
+            n_files = 2 * n_clusters if cls is DiskStore else 4
+            assert len(os.listdir(tempdir)) == n_files
+
+
+def _read_files(path):
+    return {name: open(op.join(path, name), 'rb').read()
+            for name in os.listdir(path)}
+
+
+def test_disk_store_buffer():
+    n_clusters, n_chunks = 20, 10
+    data = [(i % n_clusters,
+             np.random.rand(np.random.randint(0, 10), 4).astype(np.float32))
+            for i in range(n_clusters * n_chunks)]
+
+    files = []
+    for max_size in (0, 5000, None):
+        with TemporaryDirectory() as tempdir:
+            ds = DiskStore(tempdir)
+            ds.register_file_extensions(['features', 'masks'])
+            buffer = DiskStoreBuffer(ds, max_size=max_size)
+            for cluster, arr in data:
+                buffer.store(cluster, features=arr, masks=arr[:, 0].copy())
+            assert buffer.n_appends == 2 * len(data)
+            buffer.flush()
+            assert buffer.size == 0
+            if max_size == 0:
+                assert buffer.n_writes == 2 * len(data)
+            elif max_size is None:
+                assert buffer.n_writes == 2 * n_clusters
+            else:
+                assert 2 * n_clusters < buffer.n_writes < 2 * len(data)
+            files.append(_read_files(tempdir))
+
+    # The data on disk does not depend on the buffer.
+    assert files[0] == files[1] == files[2]
+    assert len(files[0]) == 2 * n_clusters
+
+
+def test_disk_store_buffer_benchmark():
+    n_clusters, n_chunks = 100, 50
+    data = [np.random.rand(2, 32).astype(np.float32)
+            for _ in range(n_chunks)]
+
+    for max_size in (0, 64 * 1024 ** 2):
+        with TemporaryDirectory() as tempdir:
+            ds = DiskStore(tempdir)
+            ds.register_file_extensions(['features', 'masks'])
+            buffer = DiskStoreBuffer(ds, max_size=max_size)
+            with benchmark('Store {0:d} chunks of {1:d} clusters, '
+                           'buffer of {2:d} bytes'.format(n_chunks,
+                                                          n_clusters,
+                                                          max_size)):
+                for arr in data:
+                    for cluster in range(n_clusters):
+                        buffer.store(cluster, features=arr, masks=arr[:, 0])
+                buffer.flush()
+            n_appends = 2 * n_chunks * n_clusters
+            assert buffer.n_appends == n_appends
+            # With a large enough buffer, every file is written once.
+            assert buffer.n_writes == (n_appends if max_size == 0
+                                       else 2 * n_clusters)
+
+
 def test_cluster_store_1():
     with TemporaryDirectory() as tempdir:
 
@@ -183,6 +419,150 @@ def test_cluster_store_1():
         ae(cs.disk_store.cluster_ids, [])
 
 
+def test_cluster_store_manifest():
+    with TemporaryDirectory() as tempdir:
+        n_spikes = 100
+        n_clusters = 10
+        spike_clusters = np.random.randint(size=n_spikes,
+                                           low=0, high=n_clusters)
+        spc = _spikes_per_cluster(np.arange(n_spikes), spike_clusters)
+
+        kwik_path = op.join(tempdir, 'test.kwik')
+        open(kwik_path, 'w').close()
+        model = Bunch(kwik_path=kwik_path)
+        path = op.join(tempdir, 'store')
+        os.mkdir(path)
+
+        stored = []
+
+        class MyItem(StoreItem):
+            name = 'my item'
+            fields = [('spikes', 'disk', np.int64)]
+
+            def is_consistent(self, cluster, spikes):
+                size = self.disk_store.size(cluster, 'spikes')
+                return size == 8 * len(spikes)
+
+            def store_cluster(self, cluster, spikes, mode=None):
+                stored.append(cluster)
+                self.disk_store.store(cluster,
+                                      spikes=np.asarray(spikes, np.int64))
+
+        def _generate(spc, mode=None):
+            del stored[:]
+            cs = ClusterStore(model=model, path=path)
+            cs.register_item(MyItem)
+            cs.generate(spc, mode=mode)
+            for cluster in spc:
+                ae(cs.spikes(cluster), spc[cluster])
+            return cs
+
+        # The manifest is created with the store.
+        cs = _generate(spc)
+        assert stored == sorted(spc)
+        assert op.exists(cs.manifest_path)
+        assert cs.disk_store._known_sizes == {}
+
+        # The file sizes are read from the manifest.
+        cs = _generate(spc)
+        assert stored == []
+        assert len(cs.disk_store._known_sizes) == n_clusters
+
+        # Exchange two spikes between two clusters: the file sizes do not
+        # change, but the files are regenerated.
+        spc = spc.copy()
+        spc[0], spc[1] = (np.sort(np.r_[spc[0][1:], spc[1][0]]),
+                          np.sort(np.r_[spc[1][1:], spc[0][0]]))
+        cs = _generate(spc)
+        assert stored == [0, 1]
+
+        # The manifest is stale when the kwik file is modified.
+        mtime = op.getmtime(kwik_path) + 10
+        os.utime(kwik_path, (mtime, mtime))
+        cs = _generate(spc)
+        assert stored == []
+        assert cs.disk_store._known_sizes == {}
+        cs = _generate(spc)
+        assert len(cs.disk_store._known_sizes) == n_clusters
+
+        # The files of the new clusters are removed from the manifest.
+        up = UpdateInfo(description='assign',
+                        added=[2],
+                        deleted=[],
+                        new_spikes_per_cluster={2: spc[2][:1]},
+                        )
+        cs.on_cluster(up)
+        cs = _generate(spc)
+        assert stored == [2]
+
+        # The sizes of the missing files are not trusted.
+        os.remove(op.join(path, '3.spikes'))
+        cs = _generate(spc)
+        assert stored == [3]
+
+        # The manifest is removed before the files are regenerated.
+        cs = ClusterStore(model=model, path=path)
+        cs.register_item(MyItem)
+        cs.spikes_per_cluster = spc
+        cs._invalidate_manifest('read-only')
+        assert op.exists(cs.manifest_path)
+        cs._invalidate_manifest('force')
+        assert not op.exists(cs.manifest_path)
+        cs = _generate(spc)
+        assert stored == []
+        assert op.exists(cs.manifest_path)
+
+        # Clear the store.
+        cs.clear()
+        assert not op.exists(cs.manifest_path)
+        cs = _generate(spc, mode='force')
+        assert stored == sorted(spc)
+
+
+def test_cluster_store_memory_size():
+    n_spikes = 100
+    n_clusters = 10
+    spike_clusters = np.random.randint(size=n_spikes,
+                                       low=0, high=n_clusters)
+    spc = _spikes_per_cluster(np.arange(n_spikes), spike_clusters)
+
+    computed = []
+
+    class MyItem(StoreItem):
+        name = 'my item'
+        fields = [('spikes', 'memory')]
+
+        def store_cluster(self, cluster, spikes, mode=None):
+            computed.append(cluster)
+            self.memory_store.store(cluster,
+                                    spikes=np.asarray(spikes, np.int64))
+
+    # The evicted data is computed again when there is no disk store.
+    cs = ClusterStore(memory_size=200)
+    cs.register_item(MyItem)
+    cs.generate(spc)
+    assert computed == sorted(spc)
+    del computed[:]
+    assert cs.memory_store.size <= 200
+    assert cs.memory_store.n_evictions > 0
+    for cluster in sorted(spc):
+        ae(cs.spikes(cluster), spc[cluster])
+    assert computed
+
+    # The evicted data is spilled to disk.
+    with TemporaryDirectory() as tempdir:
+        cs = ClusterStore(path=tempdir, memory_size=200)
+        cs.register_item(MyItem)
+        cs.generate(spc)
+        del computed[:]
+        for cluster in sorted(spc):
+            ae(cs.spikes(cluster), spc[cluster])
+        assert computed == []
+        assert cs.memory_store.n_reloads > 0
+        assert 'Clusters spilled to disk' in cs.status
+        assert cs.files == []
+
+
 def test_cluster_store_multi():
     """This tests the cluster store when a store item has several fields."""
 
@@ -263,6 +643,11 @@ def test_cluster_store_load():
                                  for cl in clusters])
         ae(cs.load('spikes_square', clusters, spikes), spikes ** 2)
 
+        # Shuffled spikes, and a cluster without requested spikes.
+        np.random.shuffle(spikes)
+        ae(cs.load('spikes_square', clusters + [7], spikes), spikes ** 2)
+        assert cs.load('spikes_square', clusters, []).shape == (0,)
+
 
 def test_cluster_store_management():
     with TemporaryDirectory() as tempdir:
@@ -374,3 +759,63 @@ def test_cluster_store_management():
         ae(cs.cluster_ids, np.arange(n_clusters, n_clusters + 5))
         ae(cs.old_clusters, [])
         ae(item.to_generate(), [])
+
+
+def test_cluster_store_packed():
+    with TemporaryDirectory() as tempdir:
+        n_spikes = 100
+        n_clusters = 10
+
+        spike_ids = np.arange(n_spikes)
+        spike_clusters = np.random.randint(size=n_spikes,
+                                           low=0, high=n_clusters)
+        spikes_per_cluster = _spikes_per_cluster(spike_ids, spike_clusters)
+        model = Bunch({'spike_clusters': spike_clusters})
+
+        class MyItem(StoreItem):
+            name = 'my item'
+            fields = [('spikes_square', 'disk', np.int32)]
+
+            def store_cluster(self, cluster, spikes, mode=None):
+                # Store the data in two parts.
+                data = (spikes ** 2).astype(np.int32)
+                self.disk_store.store(cluster, spikes_square=data[:2])
+                self.disk_store.store(cluster, spikes_square=data[2:],
+                                      append=True)
+
+            def is_consistent(self, cluster, spikes):
+                return (self.disk_store.size(cluster, 'spikes_square') ==
+                        4 * len(spikes))
+
+        cs = ClusterStore(model=model, path=tempdir, backend='packed')
+        cs.register_item(MyItem)
+        cs.generate(spikes_per_cluster)
+        assert cs.is_consistent()
+        assert cs.files == ['spikes_square.data', 'spikes_square.index']
+
+        def _check():
+            for cluster, spikes in cs.spikes_per_cluster.items():
+                data = cs.spikes_square(cluster)
+                # The data is contiguous after compaction.
+                assert isinstance(data, np.memmap)
+                ae(data, spikes ** 2)
+
+        _check()
+
+        # Reopen the store.
+        cs = ClusterStore(model=model, path=tempdir, backend='packed')
+        cs.register_item(MyItem)
+        cs.spikes_per_cluster = spikes_per_cluster
+        assert cs.store_items[0].to_generate() == []
+
+        # New clusters.
+        spike_clusters = np.random.randint(size=n_spikes,
+                                           low=n_clusters, high=n_clusters + 5)
+        cs.generate(_spikes_per_cluster(spike_ids, spike_clusters))
+        ae(cs.old_clusters, np.arange(n_clusters))
+        cs.clean()
+        ae(cs.old_clusters, [])
+        # Data and index of the 5 new clusters, and manifest.
+        assert cs.total_size == (4 * n_spikes + 3 * 8 * 5 +
+                                 op.getsize(cs.manifest_path))
+        _check()
@@ -7,6 +7,7 @@
 #------------------------------------------------------------------------------
 
 import numpy as np
+from numpy.testing import assert_array_equal as ae
 
 from ....utils.testing import (show_test_start,
                                show_test_stop,
@@ -17,6 +18,8 @@ from ..clustering import Clustering
 from ..view_model import (WaveformViewModel,
                           FeatureViewModel,
                           CorrelogramViewModel,
+                          _scale_waveforms,
+                          _change_bins,
                           )
 
 
@@ -59,6 +62,24 @@ def _test_view_model(view_model_class, **kwargs):
     return vm
 
 
+def test_scale_waveforms():
+    waveforms = np.random.randn(10, 20, 4).astype(np.float32)
+    copy = waveforms.copy()
+
+    # Float waveforms: same result as an in-place scaling.
+    scaled = _scale_waveforms(waveforms, .01)
+    ae(waveforms, copy)
+    copy *= .01
+    ae(scaled, copy)
+
+    # Integer waveforms: the deferred scale factor is applied.
+    waveforms = np.arange(-10, 10, dtype=np.int16)
+    scaled = _scale_waveforms(waveforms, .5, 4.)
+    assert scaled.dtype == np.float32
+    ae(scaled, 2. * np.arange(-10, 10))
+    ae(_scale_waveforms(waveforms, 1.), np.arange(-10, 10))
+
+
 def test_waveforms():
     _test_view_model(WaveformViewModel)
 
@@ -74,3 +95,67 @@ def test_ccg():
                      n_excerpts=100,
                      excerpt_size=100,
                      )
+
+
+def test_ccg_merge():
+    model = MockModel()
+    clustering = Clustering(model.spike_clusters)
+
+    clusters = [3, 4]
+    spikes = clustering.spikes_in_clusters(clusters)
+
+    # Default configuration, without CCG cache.
+    vm = CorrelogramViewModel(model, binsize=20, winsize_bins=51)
+    vm.on_open()
+    vm.on_select(clusters, spikes)
+
+    # The CCGs of the merged cluster are derived from the displayed CCGs,
+    # and are identical to the recomputed CCGs.
+    up = clustering.merge(clusters)
+    vm.on_cluster(up)
+    ae(vm.view.cluster_ids, up.added)
+    merged = vm.view.visual.correlograms.copy()
+    vm.on_select(up.added, spikes)
+    ae(vm.view.visual.correlograms, merged)
+
+    vm.view.close()
+
+
+def test_change_bins():
+    # The window duration is kept when the bin size changes.
+    assert _change_bins(20, 51, 'Right') == (40, 23)
+    assert _change_bins(40, 23, 'Left') == (20, 43)
+    assert _change_bins(20, 51, 'Down') == (20, 23)
+    assert _change_bins(20, 51, 'Up') == (20, 99)
+    assert _change_bins(1, 3, 'Left') == (1, 3)
+    assert _change_bins(20, 3, 'Down') == (20, 3)
+    assert _change_bins(20, 51, 'A') is None
+
+
+def test_ccg_set_bins():
+    model = MockModel()
+    clustering = Clustering(model.spike_clusters)
+
+    clusters = [3, 4]
+    spikes = clustering.spikes_in_clusters(clusters)
+
+    def _ccgs(binsize, winsize_bins):
+        vm = CorrelogramViewModel(model, binsize=binsize,
+                                  winsize_bins=winsize_bins)
+        vm.on_open()
+        vm.on_select(clusters, spikes)
+        ccgs = vm.view.visual.correlograms.copy()
+        vm.view.close()
+        return ccgs
+
+    vm = CorrelogramViewModel(model, binsize=20, winsize_bins=51)
+    vm.on_open()
+    vm.on_select(clusters, spikes)
+
+    # Coarser bins and smaller windows are rebinned, the other CCGs are
+    # computed again.
+    for binsize, winsize_bins in ((40, 23), (20, 23), (10, 51), (20, 99)):
+        vm.set_bins(binsize, winsize_bins)
+        ae(vm.view.visual.correlograms, _ccgs(binsize, winsize_bins))
+
+    vm.view.close()
@@ -12,7 +12,13 @@ from ...utils.logging import debug
 from ...plot.ccg import CorrelogramView
 from ...plot.features import FeatureView
 from ...plot.waveforms import WaveformView
-from ...stats.ccg import correlograms, _symmetrize_correlograms
+from ...stats.ccg import (correlograms,
+                          rebin_correlograms,
+                          _can_rebin,
+                          _merge_correlograms,
+                          _symmetrize_correlograms,
+                          )
+from ...utils.array import _unique
 
 
 #------------------------------------------------------------------------------
@@ -43,6 +49,21 @@ def _selected_clusters_colors(n_clusters):
     return colors[:n_clusters, ...] / 255.
 
 
+def _scale_waveforms(waveforms, scale_factor, deferred_scale_factor=None):
+    """Return scaled float32 waveforms.
+
+    The input array is not modified, as it may be kept in a cache.
+
+    """
+    if deferred_scale_factor is not None:
+        scale_factor = scale_factor * deferred_scale_factor
+    if waveforms.dtype == np.float32:
+        return waveforms * scale_factor
+    waveforms = waveforms.astype(np.float32)
+    waveforms *= scale_factor
+    return waveforms
+
+
 class BaseViewModel(object):
     """Used to create views from a model."""
     _view_class = None
@@ -123,11 +144,16 @@ class WaveformViewModel(BaseViewModel):
     def on_select(self, cluster_ids, spikes):
         # Load waveforms.
         debug("Loading {0:d} waveforms...".format(len(spikes)))
-        waveforms = self.model.waveforms[spikes]
+        loader = self.model.waveforms
+        waveforms = loader[spikes]
         debug("Done!")
 
-        waveforms *= self.scale_factor
-        self.view.visual.waveforms = waveforms
+        # Integer waveforms are only scaled here, when they are converted
+        # to floating-point values for the view.
+        deferred = getattr(loader, 'deferred_scale_factor', None)
+        self.view.visual.waveforms = _scale_waveforms(waveforms,
+                                                      self.scale_factor,
+                                                      deferred)
 
         # Load masks.
         masks = self._load_from_store_or_model('masks',
@@ -197,35 +223,126 @@ class FeatureViewModel(BaseViewModel):
         self._update_cluster_colors()
 
 
+def _change_bins(binsize, winsize_bins, key):
+    """Return the bin size and the window of the CCGs after a key press,
+    or None if the key is not used.
+
+    Left and Right halve and double the bin size, keeping the duration of
+    the window. Down and Up halve and double the window.
+
+    """
+    window = (winsize_bins // 2) * binsize
+    if key == 'Left':
+        binsize = max(1, binsize // 2)
+    elif key == 'Right':
+        binsize *= 2
+    elif key == 'Down':
+        window //= 2
+    elif key == 'Up':
+        window *= 2
+    else:
+        return None
+    # At least one bin on each side of the window, and an odd number of
+    # bins on each side for _symmetrize_correlograms().
+    n = max(1, window // binsize)
+    n -= 1 - n % 2
+    return binsize, 2 * n + 1
+
+
 class CorrelogramViewModel(BaseViewModel):
     _view_class = CorrelogramView
     _view_name = 'correlograms'
 
     binsize = None
     winsize_bins = None
+    # The CCGs are computed with this resolution, and rebinned to the
+    # displayed bin size and window.
+    base_binsize = None
+    base_winsize_bins = None
     # n_excerpts = None
     # excerpt_size = None
 
     # _clusters = None
     _spikes = None
+    # Last computed CCGs, as returned by correlograms(), and their
+    # clusters.
+    _ccgs = None
+    _ccgs_clusters = None
+    _ccgs_resolution = None
+    # Optional CorrelogramCache instance: if set, the CCGs are computed on
+    # all spikes of the selected clusters and cached, and the selected
+    # spikes passed to on_select() are ignored.
+    ccg_cache = None
+
+    def _show_ccgs(self, ccgs):
+        # Normalize the symmetrized CCGs.
+        ccgs = ccgs * (1. / float(ccgs.max()))
+        self.view.visual.correlograms = ccgs
+
+    def _base_resolution(self):
+        """Return the bin size and window with which the CCGs are
+        computed."""
+        if (self.base_binsize is not None and
+                _can_rebin(self.base_binsize, self.base_winsize_bins,
+                           self.binsize, self.winsize_bins)):
+            return self.base_binsize, self.base_winsize_bins
+        return self.binsize, self.winsize_bins
+
+    def _update_ccgs(self, ccgs):
+        # Rebinning returns a new array, which is then symmetrized in place.
+        ccgs = rebin_correlograms(ccgs,
+                                  *(self._ccgs_resolution +
+                                    (self.binsize, self.winsize_bins)))
+        self._show_ccgs(_symmetrize_correlograms(ccgs))
+
+    def set_bins(self, binsize=None, winsize_bins=None):
+        """Change the bin size and the window of the CCGs.
+
+        The displayed CCGs are rebinned from the CCGs computed with the base
+        resolution, without going back to the spikes, unless the new
+        resolution cannot be derived from the base resolution.
+
+        """
+        self.binsize = binsize or self.binsize
+        self.winsize_bins = winsize_bins or self.winsize_bins
+        if self._spikes is None:
+            return
+        if (self._ccgs is not None and
+                _can_rebin(*(self._ccgs_resolution +
+                             (self.binsize, self.winsize_bins)))):
+            self._update_ccgs(self._ccgs)
+        else:
+            self.on_select(self.view.cluster_ids, self._spikes)
 
     def on_select(self, cluster_ids, spikes):
         self._spikes = spikes
         self.view.cluster_ids = cluster_ids
+
+        if self.ccg_cache is not None:
+            self._ccgs = self._ccgs_clusters = None
+            binsize, winsize_bins = self._base_resolution()
+            ccgs = self.ccg_cache.correlograms(cluster_ids,
+                                               self.binsize,
+                                               self.winsize_bins,
+                                               base_binsize=binsize,
+                                               base_winsize_bins=winsize_bins)
+            self._show_ccgs(ccgs)
+            self._update_cluster_colors()
+            return
+
         spike_clusters = self.model.spike_clusters[spikes]
         spike_samples = self.model.spike_samples[spikes]
 
-        # Compute the correlograms.
-        ccgs = correlograms(spike_samples,
-                            spike_clusters,
-                            binsize=self.binsize,
-                            winsize_bins=self.winsize_bins,
-                            )
-        ccgs = _symmetrize_correlograms(ccgs)
-
-        # Normalize the CCGs.
-        ccgs = ccgs * (1. / float(ccgs.max()))
-        self.view.visual.correlograms = ccgs
+        # Compute the correlograms with the base resolution.
+        self._ccgs_resolution = self._base_resolution()
+        binsize, winsize_bins = self._ccgs_resolution
+        self._ccgs = correlograms(spike_samples,
+                                  spike_clusters,
+                                  binsize=binsize,
+                                  winsize_bins=winsize_bins,
+                                  )
+        self._ccgs_clusters = _unique(spike_clusters)
+        self._update_ccgs(self._ccgs)
 
         # Cluster colors.
         self._update_cluster_colors()
@@ -233,14 +350,21 @@ class CorrelogramViewModel(BaseViewModel):
     def on_cluster(self, up=None):
         if up is None or up.description not in ('merge', 'assign'):
             return
+        if self._spikes is None:
+            return
 
-        # OPTIM: add the CCGs of the merged clusters
-        # if up.description == 'merge':
-        #     self.view.visual.cluster_ids = up.added
-        #     n = len(up.added)
-        #     self.view.visual.cluster_colors = _selected_clusters_colors(n)
+        # The CCGs of the merged cluster are obtained by summing the CCGs
+        # of the merged clusters. With the CCG cache, this is done by the
+        # cache, and the CCGs are simply requested again below.
+        if (up.description == 'merge' and self.ccg_cache is None and
+                self._ccgs is not None):
+            self._ccgs, self._ccgs_clusters = _merge_correlograms(
+                self._ccgs, self._ccgs_clusters, up.deleted, up.added[0])
+            self.view.cluster_ids = up.added
+            self._update_ccgs(self._ccgs)
+            self._update_cluster_colors()
+            return
 
         # Recompute the CCGs with the already-selected spikes, and the
         # newly-created clusters.
-        if self._spikes is not None:
-            self.on_select(up.added, self._spikes)
+        self.on_select(up.added, self._spikes)
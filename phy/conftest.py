@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""Configuration of the test suite."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import pytest
+
+
+#------------------------------------------------------------------------------
+# Slow tests
+#------------------------------------------------------------------------------
+
+def pytest_addoption(parser):
+    parser.addoption('--runslow', action='store_true', default=False,
+                     help="run the slow tests, like the benchmarks")
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers',
+                            "slow: slow test, only run with --runslow")
+
+
+def pytest_runtest_setup(item):
+    if 'slow' in item.keywords and not item.config.getoption('--runslow'):
+        pytest.skip("slow test, use --runslow to run it")
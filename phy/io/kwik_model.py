@@ -6,6 +6,7 @@
 # Imports
 #------------------------------------------------------------------------------
 
+import json
 import os.path as op
 from random import randint
 import os
@@ -17,9 +18,10 @@ from .base_model import BaseModel
 from ..cluster.manual.cluster_metadata import ClusterMetadata
 from .h5 import open_h5, File
 from ..waveform.loader import WaveformLoader
-from ..waveform.filter import bandpass_filter, apply_filter
+from ..waveform.filter import Filter, apply_filter_chunked
 from ..electrode.mea import MEA
-from ..utils.logging import debug
+from ..utils.logging import debug, info
+from ..utils.cache import LRUCache
 from ..utils.array import (PartialArray,
                            _concatenate_virtual_arrays,
                            _as_array,
@@ -215,30 +217,164 @@ _COLOR_MAP = np.array([[1., 1., 1.],
 
 _KWIK_EXTENSIONS = ('kwik', 'kwx', 'raw.kwd')
 
+# Extension of the sidecar file with the filtered traces, and of the file
+# with the parameters of the filter.
+_FILTERED_EXTENSION = 'filtered.npy'
+_FILTERED_PARAMS_EXTENSION = 'filtered.json'
+
+# Metadata fields defining the filter of the waveforms.
+_FILTER_PARAMS = ('sample_rate', 'filter_low', 'filter_high',
+                  'filter_butter_order')
+
 
 def _kwik_filenames(kwik_path):
     """Return the filenames of the different Kwik files for a given
     experiment."""
     basename, ext = op.splitext(kwik_path)
     return {ext: '{basename}.{ext}'.format(basename=basename, ext=ext)
-            for ext in _KWIK_EXTENSIONS}
+            for ext in _KWIK_EXTENSIONS + (_FILTERED_EXTENSION,
+                                           _FILTERED_PARAMS_EXTENSION)}
+
+
+def _filter_params(metadata):
+    """Return the parameters of the filter of the waveforms."""
+    return {name: float(metadata[name]) for name in _FILTER_PARAMS}
+
+
+def _read_filter_params(path):
+    """Read the filter parameters saved along with the filtered traces,
+    or return None."""
+    if not op.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def _write_filter_params(path, params):
+    with open(path, 'w') as f:
+        json.dump(params, f)
+
+
+def _open_filtered_traces(path, shape, kwd_path=None,
+                          params=None, params_path=None):
+    """Open a memory-mapped sidecar file with filtered traces.
+
+    Return None if the file doesn't exist, doesn't have the expected shape,
+    is older than the .raw.kwd file, or was filtered with other filter
+    parameters than `params`.
+
+    """
+    if not op.exists(path):
+        return None
+    if (params is not None and
+            _read_filter_params(params_path) != params):
+        debug("The filtered traces file {0} was filtered ".format(path) +
+              "with other parameters and will be ignored.")
+        return None
+    if kwd_path is not None and op.exists(kwd_path):
+        if os.stat(path).st_mtime < os.stat(kwd_path).st_mtime:
+            debug("The filtered traces file {0} is ".format(path) +
+                  "older than the raw data and will be ignored.")
+            return None
+    try:
+        traces = np.load(path, mmap_mode='r')
+    except (IOError, ValueError):
+        debug("Unable to open the filtered traces file {0}.".format(path))
+        return None
+    if traces.shape != tuple(shape):
+        debug("The filtered traces file {0} has ".format(path) +
+              "an invalid shape and will be ignored.")
+        return None
+    return traces
+
+
+def _spike_ids(item, n_spikes):
+    """Convert a selection of spikes into an array of spike ids."""
+    if isinstance(item, slice):
+        return np.arange(*item.indices(n_spikes))
+    spikes = np.array(item, dtype=np.int64).ravel()
+    spikes[spikes < 0] += n_spikes
+    if len(spikes) and (spikes.min() < 0 or spikes.max() >= n_spikes):
+        raise IndexError("Invalid spike selection.")
+    return spikes
 
 
 class SpikeLoader(object):
     """Translate selection with spike ids into selection with
-    absolute times."""
-    def __init__(self, waveforms, spike_samples):
+    absolute times.
+
+    If a cache is specified, the waveforms are stored in it with the spike
+    ids as keys, and only the missing waveforms are loaded.
+
+    """
+    def __init__(self, waveforms, spike_samples, cache=None):
         self._spike_samples = spike_samples
         # waveforms is a WaveformLoader instance
         self._waveforms = waveforms
+        self._cache = cache
         self.dtype = waveforms.dtype
+        # Scale factor to apply to integer waveforms.
+        self.deferred_scale_factor = waveforms.deferred_scale_factor
         self.shape = (len(spike_samples),
                       waveforms.n_samples_waveforms,
                       waveforms.n_channels_waveforms)
 
+    @property
+    def uncached(self):
+        """The same loader without the cache, for batch jobs whose
+        waveforms should not evict the cached waveforms."""
+        if self._cache is None:
+            return self
+        return SpikeLoader(self._waveforms, self._spike_samples)
+
     def __getitem__(self, item):
-        times = self._spike_samples[item]
-        return self._waveforms[times]
+        # Slices typically come from batch jobs going through many spikes:
+        # they bypass the cache.
+        if self._cache is None or isinstance(item, slice):
+            times = self._spike_samples[item]
+            return self._waveforms[times]
+
+        spikes = _spike_ids(item, self.shape[0])
+        out = np.empty((len(spikes),) + self.shape[1:], dtype=self.dtype)
+
+        # Take the waveforms found in the cache.
+        missing = []
+        for i, spike in enumerate(spikes):
+            waveform = self._cache.get(spike)
+            if waveform is None:
+                missing.append(i)
+            else:
+                out[i] = waveform
+        if not missing:
+            return out
+
+        # Load the missing waveforms.
+        missing_spikes, idx = np.unique(spikes[missing], return_inverse=True)
+        waveforms = self._waveforms[self._spike_samples[missing_spikes]]
+        out[missing] = waveforms[idx]
+        # Put them in the cache.
+        for spike, waveform in zip(missing_spikes, waveforms):
+            self._cache.set(spike, waveform.copy())
+        return out
+
+    def iter_chunks(self, chunk_size=None):
+        """Iterate over the waveforms of all spikes, chunk by chunk.
+
+        Every chunk is loaded with a few large contiguous reads, and
+        filtered only once. The cache is not used.
+
+        Yields
+        ------
+
+        (i, j, waveforms) : tuple
+            `waveforms` contains the waveforms of the spikes `i:j`.
+
+        """
+        return self._waveforms.iter_chunks(self._spike_samples[:],
+                                           chunk_size=chunk_size)
 
 
 #------------------------------------------------------------------------------
@@ -265,8 +401,13 @@ class KwikModel(BaseModel):
         self._waveforms = None
         self._cluster_metadata = None
         self._traces = None
+        self._filtered_traces = None
         self._recording_offsets = None
         self._waveform_loader = None
+        self._waveforms_cache = None
+        self._waveforms_dtype = np.dtype(np.float32)
+        self._waveforms_n_workers = 1
+        self._filter = None
 
         # Open the experiment.
         self.kwik_path = kwik_path
@@ -327,26 +468,50 @@ class KwikModel(BaseModel):
                 self._kwik.mode = mode
             return False
 
+    def _create_filter(self):
+        """Create the filter used for the waveforms.
+
+        The filter coefficients and initial conditions are computed once
+        for the whole dataset.
+
+        """
+        self._filter = Filter(rate=self._metadata['sample_rate'],
+                              low=self._metadata['filter_low'],
+                              high=self._metadata['filter_high'],
+                              order=self._metadata['filter_butter_order'],
+                              )
+
     def _create_waveform_loader(self):
-        """Create a waveform loader."""
+        """Create a waveform loader.
+
+        If the filtered traces are available, the waveforms are directly
+        loaded from them and no filtering is done on the fly.
+
+        """
         n_samples = (self._metadata['extract_s_before'],
                      self._metadata['extract_s_after'])
         order = self._metadata['filter_butter_order']
-        b_filter = bandpass_filter(rate=self._metadata['sample_rate'],
-                                   low=self._metadata['filter_low'],
-                                   high=self._metadata['filter_high'],
-                                   order=order)
 
-        def filter(x):
-            return apply_filter(x, b_filter)
+        # Terminate the worker threads of the previous loader.
+        if self._waveform_loader is not None:
+            self._waveform_loader.close()
 
-        self._waveform_loader = WaveformLoader(n_samples=n_samples,
-                                               filter=filter,
-                                               filter_margin=order * 3,
-                                               )
+        if self._filtered_traces is not None:
+            self._waveform_loader = WaveformLoader(n_samples=n_samples,
+                                                   dtype=self._waveforms_dtype,
+                                                   )
+        else:
+            self._waveform_loader = WaveformLoader(n_samples=n_samples,
+                                                   filter=self._filter,
+                                                   filter_margin=order * 3,
+                                                   dtype=self._waveforms_dtype,
+                                                   )
+        self._waveform_loader.n_workers = self._waveforms_n_workers
 
     def _update_waveform_loader(self):
-        if self._kwd is not None:
+        if self._filtered_traces is not None:
+            self._waveform_loader.traces = self._filtered_traces
+        elif self._kwd is not None:
             self._waveform_loader.traces = self._traces
         else:
             self._waveform_loader.traces = np.zeros((0, self.n_channels),
@@ -355,6 +520,10 @@ class KwikModel(BaseModel):
         # Update the list of channels for the waveform loader.
         self._waveform_loader.channels = self._channel_order
 
+    def _clear_waveforms_cache(self):
+        if self._waveforms_cache is not None:
+            self._waveforms_cache.clear()
+
     def _create_cluster_metadata(self):
         self._cluster_metadata = ClusterMetadata()
 
@@ -494,6 +663,16 @@ class KwikModel(BaseModel):
             # Virtual concatenation of the arrays.
             self._traces = _concatenate_virtual_arrays(traces)
 
+    def _load_filtered_traces(self):
+        self._filtered_traces = None
+        if self._traces is not None:
+            path = self._filenames[_FILTERED_EXTENSION]
+            self._filtered_traces = _open_filtered_traces(
+                path, self._traces.shape,
+                kwd_path=self._filenames['raw.kwd'],
+                params=_filter_params(self._metadata),
+                params_path=self._filenames[_FILTERED_PARAMS_EXTENSION])
+
     def open(self, kwik_path, channel_group=None, clustering=None):
         """Open a Kwik dataset.
 
@@ -554,12 +733,16 @@ class KwikModel(BaseModel):
         self._load_meta()
 
         # This needs metadata.
-        self._create_waveform_loader()
+        self._create_filter()
 
         self._load_recordings()
 
         # This generates the recording offset.
         self._load_traces()
+        self._load_filtered_traces()
+
+        # This needs metadata and the filtered traces.
+        self._create_waveform_loader()
 
         self._load_channel_groups(channel_group)
 
@@ -591,6 +774,70 @@ class KwikModel(BaseModel):
         if to_close:
             self._kwik.close()
 
+    def filter_traces(self, dtype=None, chunk_size=None, overlap=None):
+        """Filter all traces and save them in a memory-mapped sidecar file.
+
+        The waveforms are then directly loaded from this file, and no
+        filtering is done on the fly anymore. The file is
+        `<basename>.filtered.npy`, in the same folder as the .kwik file.
+        The filter parameters are saved in `<basename>.filtered.json`: the
+        file is ignored if the filter parameters of the dataset change.
+
+        Parameters
+        ----------
+
+        dtype : NumPy dtype (default is float32)
+            The dtype of the filtered traces. Use int16 to save disk space.
+        chunk_size : int or None
+            Number of samples per chunk. By default, one second.
+        overlap : int or None
+            Number of samples shared by consecutive chunks. By default, 5% of
+            the chunk size.
+
+        """
+        if self._traces is None:
+            raise RuntimeError("There are no traces to filter.")
+        if dtype is None:
+            dtype = np.float32
+        if chunk_size is None:
+            chunk_size = int(self.sample_rate)
+        path = self._filenames[_FILTERED_EXTENSION]
+        params_path = self._filenames[_FILTERED_PARAMS_EXTENSION]
+        info("Filtering the traces in {0}...".format(path))
+
+        # Release the current memory-mapped file if needed.
+        self._filtered_traces = None
+        self._create_waveform_loader()
+        self._update_waveform_loader()
+
+        # Write in a temporary file first, so that an interrupted filtering
+        # does not leave an invalid file. The filter parameters are written
+        # last, so that the file is only used once it is complete.
+        if op.exists(params_path):
+            os.remove(params_path)
+        path_tmp = path + '.part'
+        out = np.lib.format.open_memmap(path_tmp, mode='w+',
+                                        dtype=dtype,
+                                        shape=self._traces.shape)
+        apply_filter_chunked(self._traces, out,
+                             filter=self._filter,
+                             chunk_size=chunk_size,
+                             overlap=overlap,
+                             )
+        out.flush()
+        del out
+        if op.exists(path):
+            os.remove(path)
+        os.rename(path_tmp, path)
+        _write_filter_params(params_path, _filter_params(self._metadata))
+        info("Done!")
+
+        # Use the filtered traces from now on.
+        self._load_filtered_traces()
+        self._create_waveform_loader()
+        self._update_waveform_loader()
+        self._clear_waveforms_cache()
+
     # Changing channel group and clustering
     # -------------------------------------------------------------------------
 
@@ -611,6 +858,7 @@ class KwikModel(BaseModel):
 
         # Update the list of channels for the waveform loader.
         self._waveform_loader.channels = self._channel_order
+        self._clear_waveforms_cache()
 
     def _clustering_changed(self, value):
         """Called when the clustering changes."""
@@ -866,6 +1114,16 @@ class KwikModel(BaseModel):
         """
         return self._traces
 
+    @property
+    def filtered_traces(self):
+        """Filtered traces as found in the sidecar file created by
+        `filter_traces()`, or None if this file doesn't exist.
+
+        This object is memory-mapped to the sidecar file.
+
+        """
+        return self._filtered_traces
+
     @property
     def spike_samples(self):
         """Spike samples from the current channel group.
@@ -960,8 +1218,73 @@ class KwikModel(BaseModel):
 
         The shape is '(n_spikes, n_samples, n_channels)'.
 
+        The loaded waveforms are kept in a LRU cache if
+        `waveforms_cache_size` is set.
+
+        """
+        return SpikeLoader(self._waveform_loader, self.spike_samples,
+                           cache=self._waveforms_cache)
+
+    @property
+    def waveforms_cache(self):
+        """LRU cache of the loaded waveforms, with the spike ids as keys.
+
+        This is None if the cache is disabled. The `n_hits` and `n_misses`
+        attributes can be used to tune the cache size.
+
+        """
+        return self._waveforms_cache
+
+    @property
+    def waveforms_dtype(self):
+        """Data type of the loaded waveforms.
+
+        This is float32 by default. With int16, the waveforms cache holds
+        twice as many waveforms, and the waveforms need to be converted to
+        floating-point values by the consumer.
+
         """
-        return SpikeLoader(self._waveform_loader, self.spike_samples)
+        return self._waveforms_dtype
+
+    @waveforms_dtype.setter
+    def waveforms_dtype(self, value):
+        self._waveforms_dtype = np.dtype(value or np.float32)
+        if self._waveform_loader is not None:
+            self._waveform_loader.dtype = self._waveforms_dtype
+        self._clear_waveforms_cache()
+
+    @property
+    def waveforms_n_workers(self):
+        """Number of threads extracting and filtering the waveforms."""
+        return self._waveforms_n_workers
+
+    @waveforms_n_workers.setter
+    def waveforms_n_workers(self, value):
+        self._waveforms_n_workers = value or 1
+        if self._waveform_loader is not None:
+            self._waveform_loader.n_workers = self._waveforms_n_workers
+
+    def cancel_waveforms(self):
+        """Cancel the waveform loading in progress in other threads."""
+        if self._waveform_loader is not None:
+            self._waveform_loader.cancel()
+
+    @property
+    def waveforms_cache_size(self):
+        """Maximum size of the waveforms cache in bytes (0 if the cache is
+        disabled)."""
+        if self._waveforms_cache is None:
+            return 0
+        return self._waveforms_cache.max_size
+
+    @waveforms_cache_size.setter
+    def waveforms_cache_size(self, value):
+        if not value:
+            self._waveforms_cache = None
+        elif self._waveforms_cache is None:
+            self._waveforms_cache = LRUCache(max_size=value)
+        else:
+            self._waveforms_cache.max_size = value
 
     @property
     def spike_clusters(self):
@@ -1019,4 +1342,7 @@ class KwikModel(BaseModel):
             self._kwx.close()
         if self._kwd is not None:
             self._kwd.close()
+        self._filtered_traces = None
+        if self._waveform_loader is not None:
+            self._waveform_loader.close()
         self._kwik.close()
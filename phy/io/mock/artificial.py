@@ -72,7 +72,9 @@ class MockModel(BaseModel):
         self._clustering = 'main'
         nfpc = self.n_features_per_channel
         self._metadata = {'description': 'A mock model.',
-                          'nfeatures_per_channel': nfpc}
+                          'nfeatures_per_channel': nfpc,
+                          'sample_rate': 20000.,
+                          }
         self._cluster_metadata = ClusterMetadata()
 
         @self._cluster_metadata.default
@@ -6,12 +6,15 @@
 # Imports
 #------------------------------------------------------------------------------
 
+import os
+
 import numpy as np
 from numpy.testing import assert_array_equal as ae
 from pytest import raises
 
 from ...electrode.mea import MEA, staggered_positions
 from ...utils.tempdir import TemporaryDirectory
+from ...utils.testing import benchmark
 from ..kwik_model import (KwikModel,
                           _list_channel_groups,
                           _list_channels,
@@ -19,6 +22,7 @@ from ..kwik_model import (KwikModel,
                           _list_clusterings,
                           _concatenate_spikes,
                           )
+from ..h5 import open_h5
 from ..mock.kwik import create_mock_kwik
 
 
@@ -145,6 +149,198 @@ def test_kwik_open_full():
         kwik.close()
 
 
+def test_kwik_filtered_traces():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        nc = _N_CHANNELS - 2
+
+        kwik = KwikModel(filename)
+        assert kwik.filtered_traces is None
+        assert kwik.waveforms[[10, 20]].shape == (2, 40, nc)
+
+        # Filter the whole recording in small chunks.
+        kwik.filter_traces(chunk_size=1000, overlap=400)
+        filtered = kwik.filtered_traces
+        assert filtered.shape == (_N_SAMPLES_TRACES, _N_CHANNELS)
+        assert filtered.dtype == np.float32
+        expected = kwik._filter(kwik.traces[:])
+        k = 500
+        assert np.abs(filtered[k:-k] - expected[k:-k]).max() < 1e-3
+
+        # The waveforms are loaded from the filtered traces.
+        loader = kwik._waveform_loader
+        assert loader.traces is filtered
+        assert loader._filter is None
+        t = int(kwik.spike_samples[10])
+        w = kwik.waveforms[10]
+        assert w.shape == (1, 40, nc)
+        ae(w[0], filtered[t - 15:t + 25, kwik.channel_order])
+        kwik.close()
+
+        # The filtered traces are automatically used when reopening
+        # the dataset.
+        kwik = KwikModel(filename)
+        assert kwik.filtered_traces is not None
+        ae(kwik.waveforms[10], w)
+        kwik.close()
+
+        # The filtered traces are ignored if they are older than the
+        # raw data.
+        path = filename.replace('.kwik', '.raw.kwd')
+        mtime = os.stat(path).st_mtime
+        os.utime(path, (mtime + 10, mtime + 10))
+        kwik = KwikModel(filename)
+        assert kwik.filtered_traces is None
+        os.utime(path, (mtime, mtime))
+        kwik.close()
+
+        # The filtered traces are ignored if the filter parameters have
+        # changed.
+        with open_h5(filename, 'a') as f:
+            f.write_attr('/application_data/spikedetekt', 'filter_high',
+                         5000.)
+        kwik = KwikModel(filename)
+        assert kwik.filtered_traces is None
+        assert kwik._waveform_loader._filter is not None
+        kwik.filter_traces(chunk_size=1000, overlap=400)
+        kwik.close()
+        kwik = KwikModel(filename)
+        assert kwik.filtered_traces is not None
+
+        # They are also ignored without the filter parameters file.
+        kwik.close()
+        os.remove(filename.replace('.kwik', '.filtered.json'))
+        kwik = KwikModel(filename)
+        assert kwik.filtered_traces is None
+
+        # int16 filtered traces.
+        kwik.filter_traces(dtype=np.int16)
+        assert kwik.filtered_traces.dtype == np.int16
+        assert kwik.waveforms[[10, 20]].shape == (2, 40, nc)
+        kwik.close()
+
+
+def test_kwik_waveforms_cache():
+
+    with TemporaryDirectory() as tempdir:
+        # Create the test HDF5 file in the temporary directory.
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=_N_SPIKES,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=_N_SAMPLES_TRACES)
+
+        nc = _N_CHANNELS - 2
+
+        kwik = KwikModel(filename)
+        assert kwik.waveforms_cache is None
+        assert kwik.waveforms_cache_size == 0
+        expected = kwik.waveforms[[10, 20, 30]]
+
+        # Room for 5 waveforms.
+        size = 40 * nc * 4
+        kwik.waveforms_cache_size = 5 * size
+        cache = kwik.waveforms_cache
+        assert kwik.waveforms_cache_size == 5 * size
+
+        ae(kwik.waveforms[[10, 20]], expected[:2])
+        assert cache.n_misses == 2
+        assert cache.n_hits == 0
+        assert sorted(cache.keys()) == [10, 20]
+
+        # Only the missing spike is loaded.
+        ae(kwik.waveforms[[30, 20, 20, 10]], expected[[2, 1, 1, 0]])
+        assert cache.n_misses == 3
+        assert cache.n_hits == 3
+        assert cache.size == 3 * size
+
+        # Other selections.
+        ae(kwik.waveforms[10], expected[:1])
+        ae(kwik.waveforms[-_N_SPIKES + 10], expected[:1])
+        assert kwik.waveforms[[]].shape == (0, 40, nc)
+        with raises(IndexError):
+            kwik.waveforms[_N_SPIKES + 10]
+
+        # Slices bypass the cache.
+        n_misses = cache.n_misses
+        ae(kwik.waveforms[10:40:10], expected)
+        assert cache.n_misses == n_misses
+
+        # The uncached loader does not fill the cache.
+        keys = sorted(cache.keys())
+        ae(kwik.waveforms.uncached[[40, 50]], kwik.waveforms[40:60:10])
+        assert sorted(cache.keys()) == keys
+
+        # Eviction.
+        kwik.waveforms[np.arange(50, 60)]
+        assert len(cache) == 5
+        assert cache.n_evictions > 0
+
+        # Chunk iteration.
+        waveforms = np.concatenate([w for (_, _, w) in
+                                    kwik.waveforms.iter_chunks(7)])
+        assert waveforms.shape == (_N_SPIKES, 40, nc)
+        ae(waveforms, kwik.waveforms[:])
+        # Same with pre-filtered traces.
+        kwik.filter_traces()
+        waveforms = np.concatenate([w for (_, _, w) in
+                                    kwik.waveforms.iter_chunks(7)])
+        ae(waveforms, kwik.waveforms[:])
+
+        # int16 waveforms take half the memory in the cache.
+        w_float = kwik.waveforms[[10, 20]]
+        size_float = cache.size
+        kwik.waveforms_dtype = np.int16
+        assert len(cache) == 0
+        w = kwik.waveforms[[10, 20]]
+        assert w.dtype == np.int16
+        assert kwik.waveforms.deferred_scale_factor is None
+        assert cache.size == size_float // 2
+        ae(w, np.round(w_float))
+        kwik.waveforms_dtype = None
+        assert kwik.waveforms_dtype == np.float32
+
+        # Changing the channel group clears the cache.
+        kwik.channel_group = 1
+        assert len(cache) == 0
+
+        kwik.waveforms_cache_size = 0
+        assert kwik.waveforms_cache is None
+        kwik.close()
+
+
+def test_kwik_waveforms_workers_benchmark():
+
+    with TemporaryDirectory() as tempdir:
+        filename = create_mock_kwik(tempdir,
+                                    n_clusters=_N_CLUSTERS,
+                                    n_spikes=2000,
+                                    n_channels=_N_CHANNELS,
+                                    n_features_per_channel=_N_FETS,
+                                    n_samples_traces=200000)
+
+        kwik = KwikModel(filename)
+        spikes = np.arange(0, 2000, 2)
+        expected = kwik.waveforms[spikes]
+        for n_workers in (1, 2, 4):
+            kwik.waveforms_n_workers = n_workers
+            name = 'Loading {0:d} waveforms with {1:d} threads'.format(
+                len(spikes), n_workers)
+            with benchmark(name):
+                waveforms = kwik.waveforms[spikes]
+            ae(waveforms, expected)
+        kwik.close()
+
+
 def test_kwik_open_no_kwx():
 
     with TemporaryDirectory() as tempdir:
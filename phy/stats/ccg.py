@@ -6,9 +6,12 @@
 # Imports
 #------------------------------------------------------------------------------
 
+import atexit
+from multiprocessing import Pool
+
 import numpy as np
 
-from ..utils.array import _index_of, _unique, _as_array
+from ..utils.array import _index_of, _unique, _as_array, chunk_bounds
 
 
 #------------------------------------------------------------------------------
@@ -35,8 +38,295 @@ def _create_correlograms_array(n_clusters, winsize_bins):
                     dtype=np.int32)
 
 
+def _correlograms_shift(correlograms, spike_samples, spike_clusters_i,
+                        binsize, winsize_bins):
+    """Accumulate the correlograms by looping over the shifts between the
+    two copies of the spike trains."""
+
+    # Shift between the two copies of the spike trains.
+    shift = 1
+
+    # At a given shift, the mask precises which spikes have matching spikes
+    # within the correlogram time window.
+    mask = np.ones_like(spike_samples, dtype=np.bool)
+
+    # The loop continues as long as there is at least one spike with
+    # a matching spike.
+    while mask[:-shift].any():
+        # Number of time samples between spike i and spike i+shift.
+        spike_diff = _diff_shifted(spike_samples, shift)
+
+        # Binarize the delays between spike i and spike i+shift.
+        spike_diff_b = spike_diff // binsize
+
+        # Spikes with no matching spikes are masked.
+        mask[:-shift][spike_diff_b > (winsize_bins//2)] = False
+
+        # Cache the masked spike delays.
+        m = mask[:-shift].copy()
+        d = spike_diff_b[m]
+
+        # # Update the masks given the clusters to update.
+        # m0 = np.in1d(spike_clusters[:-shift], clusters)
+        # m = m & m0
+        # d = spike_diff_b[m]
+        d = spike_diff_b[m]
+
+        # Find the indices in the raveled correlograms array that need
+        # to be incremented, taking into account the spike clusters.
+        indices = np.ravel_multi_index((spike_clusters_i[:-shift][m],
+                                        spike_clusters_i[shift:][m], d),
+                                       correlograms.shape)
+
+        # Increment the matching spikes in the correlograms array.
+        _increment(correlograms.ravel(), indices)
+
+        shift += 1
+
+
+def _spike_blocks(n_pairs, block_size):
+    """Split the spikes into consecutive blocks with at most `block_size`
+    pairs each, given the number of pairs of every spike.
+
+    A spike with more than `block_size` pairs is alone in its block.
+
+    """
+    cum = np.cumsum(n_pairs)
+    n_spikes = len(n_pairs)
+    start = 0
+    while start < n_spikes:
+        offset = cum[start - 1] if start > 0 else 0
+        stop = np.searchsorted(cum, offset + block_size, side='right')
+        stop = max(stop, start + 1)
+        yield start, stop
+        start = stop
+
+
+def _correlograms_searchsorted(correlograms, spike_samples, spike_clusters_i,
+                               binsize, winsize_bins, block_size=None,
+                               n_clusters=None, rows=None, pairs=None,
+                               n_references=None):
+    """Accumulate the correlograms by finding the window of neighbours of
+    every spike with a binary search.
+
+    All pairs of spikes `(i, j)` with `i < j` and a delay smaller than the
+    half window are accumulated in a vectorized way, by blocks of at most
+    `block_size` pairs.
+
+    If `rows` (relative cluster indices) is specified, only the pairs with
+    a reference spike `i` in these clusters are counted, and the
+    correlograms array has a shape `(n_rows, n_clusters, n_bins)`.
+
+    If `pairs` (a `(n_pairs, 2)` array of relative cluster indices) is
+    specified, only these pairs of clusters are counted, and the
+    correlograms array has a shape `(n_pairs, n_bins)`.
+
+    If `n_references` is specified, only the first `n_references` spikes
+    are used as reference spikes `i`.
+
+    """
+    n_spikes = len(spike_samples)
+    if n_clusters is None:
+        n_clusters = correlograms.shape[0]
+    n_bins = winsize_bins // 2 + 1
+    block_size = block_size or 2 ** 20
+
+    # The neighbours of spike i are the spikes i+1 to ends[i]-1.
+    window = (winsize_bins // 2 + 1) * binsize
+    ends = np.searchsorted(spike_samples, spike_samples + np.uint64(window),
+                           side='left')
+    n_pairs = ends - np.arange(1, n_spikes + 1)
+    if n_references is not None:
+        n_pairs[n_references:] = 0
+
+    if rows is not None:
+        # Relative row index of every cluster, or -1.
+        row_index = -np.ones(n_clusters, dtype=np.int64)
+        row_index[rows] = np.arange(len(rows))
+        # Skip the reference spikes that are not in the rows.
+        n_pairs[row_index[spike_clusters_i] < 0] = 0
+    elif pairs is not None:
+        # Sorted keys of the requested pairs of clusters.
+        pair_keys = pairs[:, 0] * n_clusters + pairs[:, 1]
+        pair_order = np.argsort(pair_keys)
+        pair_keys = pair_keys[pair_order]
+        # Skip the reference spikes that do not appear in any pair.
+        is_first = np.zeros(n_clusters, dtype=np.bool)
+        is_first[pairs[:, 0]] = True
+        n_pairs[~is_first[spike_clusters_i]] = 0
+
+    for start, stop in _spike_blocks(n_pairs, block_size):
+        counts = n_pairs[start:stop]
+        n = counts.sum()
+        if n == 0:
+            continue
+        # All pairs (i, j) in the block.
+        i = np.repeat(np.arange(start, stop), counts)
+        first = np.cumsum(counts) - counts
+        j = i + 1 + np.arange(n) - np.repeat(first, counts)
+        # Binarize the delays.
+        d = ((spike_samples[j] - spike_samples[i]) // np.uint64(binsize))
+        d = d.astype(np.int64)
+        # Indices in the raveled correlograms array.
+        ci, cj = spike_clusters_i[i], spike_clusters_i[j]
+        if rows is not None:
+            indices = (row_index[ci] * n_clusters + cj) * n_bins + d
+        elif pairs is not None:
+            keys = ci * n_clusters + cj
+            pos = np.searchsorted(pair_keys, keys)
+            pos[pos == len(pair_keys)] = 0
+            match = pair_keys[pos] == keys
+            indices = pair_order[pos[match]] * n_bins + d[match]
+        else:
+            indices = (ci * n_clusters + cj) * n_bins + d
+        _increment(correlograms.ravel(), indices)
+
+
+def _correlograms_chunk(args):
+    """Compute the partial correlograms of a chunk of spikes.
+
+    This function is called in the worker processes.
+
+    """
+    shape, spike_samples, spike_clusters_i, kwargs = args
+    correlograms = np.zeros(shape, dtype=np.int32)
+    _correlograms_searchsorted(correlograms, spike_samples,
+                               spike_clusters_i, **kwargs)
+    return correlograms
+
+
+def _ccg_chunk_bounds(spike_samples, window, chunk_size):
+    """Split the spikes into time chunks for the CCG computation.
+
+    Yield `(start, keep, stop)` spike indices: the reference spikes of the
+    chunk are `start:keep`, and their neighbours are all within
+    `start:stop`.
+
+    """
+    n_samples = int(spike_samples[-1]) + 1
+    # With an overlap of two windows, the right margin of every chunk
+    # contains all neighbours of the reference spikes of that chunk.
+    for _, s_end, keep_start, keep_end in chunk_bounds(n_samples,
+                                                       chunk_size + 2 * window,
+                                                       overlap=2 * window):
+        start, keep, stop = np.searchsorted(spike_samples,
+                                            np.array([keep_start,
+                                                      keep_end,
+                                                      keep_end + window],
+                                                     dtype=np.uint64),
+                                            side='left')
+        if keep > start:
+            yield start, keep, stop
+
+
+# Pools of worker processes, by number of processes. They are reused
+# across calls since starting the processes takes longer than computing the
+# CCGs of a few hundred thousand spikes.
+_pools = {}
+
+
+def _get_pool(n_processes):
+    """Return a pool of worker processes, started on the first call."""
+    pool = _pools.get(n_processes, None)
+    if pool is None:
+        pool = Pool(n_processes)
+        _pools[n_processes] = pool
+    return pool
+
+
+def _close_pool(n_processes):
+    """Terminate a pool of worker processes."""
+    pool = _pools.pop(n_processes, None)
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+
+
+@atexit.register
+def _close_pools():
+    """Terminate all pools of worker processes."""
+    for n_processes in list(_pools):
+        _close_pool(n_processes)
+
+
+def _correlograms_chunked(correlograms, spike_samples, spike_clusters_i,
+                          binsize, winsize_bins, chunk_size=None,
+                          n_processes=None, **kwargs):
+    """Accumulate the correlograms by splitting the spike train into time
+    chunks, possibly in parallel.
+
+    Every spike is a reference spike in exactly one chunk. The chunks
+    overlap so that they also contain the neighbours of their reference
+    spikes. The partial correlograms of the chunks are summed, and the
+    result is exactly the same as with `_correlograms_searchsorted()`.
+
+    Parameters
+    ----------
+
+    chunk_size : int
+        Number of time samples of reference spikes in every chunk. By
+        default, there are about one million spikes per chunk, and at
+        least one chunk per process.
+    n_processes : int
+        Number of worker processes. By default, the chunks are processed
+        in the current process. The worker processes are started on the
+        first call and reused by the next calls.
+
+    """
+    n_spikes = len(spike_samples)
+    if n_spikes == 0:
+        return
+    window = (winsize_bins // 2 + 1) * binsize
+    if chunk_size is None:
+        n_samples = int(spike_samples[-1]) + 1
+        n_chunks = max(n_processes or 1, -(-n_spikes // 2 ** 20))
+        chunk_size = -(-n_samples // n_chunks)
+    chunk_size = max(int(chunk_size), 1)
+    kwargs.update(binsize=binsize, winsize_bins=winsize_bins)
+    kwargs.setdefault('n_clusters', correlograms.shape[0])
+
+    def _chunks():
+        for start, keep, stop in _ccg_chunk_bounds(spike_samples, window,
+                                                   chunk_size):
+            chunk_kwargs = dict(kwargs, n_references=keep - start)
+            yield (correlograms.shape,
+                   spike_samples[start:stop],
+                   spike_clusters_i[start:stop],
+                   chunk_kwargs)
+
+    chunks = list(_chunks())
+    # No need for worker processes with a single chunk.
+    if n_processes is None or n_processes <= 1 or len(chunks) <= 1:
+        for args in chunks:
+            correlograms += _correlograms_chunk(args)
+        return
+
+    pool = _get_pool(n_processes)
+    try:
+        for partial in pool.imap_unordered(_correlograms_chunk, chunks):
+            correlograms += partial
+    except BaseException:
+        # Do not reuse a pool with pending tasks.
+        _close_pool(n_processes)
+        raise
+
+
+def _relative_cluster_index(clusters, lookup):
+    """Return the indices of some clusters in a sorted lookup array, or
+    -1 for the clusters that are not in the lookup array."""
+    clusters = np.asarray(clusters, dtype=np.int64)
+    if len(lookup) == 0:
+        return -np.ones(clusters.shape, dtype=np.int64)
+    pos = np.searchsorted(lookup, clusters)
+    pos[pos == len(lookup)] = 0
+    return np.where(lookup[pos] == clusters, pos, -1)
+
+
 def correlograms(spike_samples, spike_clusters,
-                 binsize=None, winsize_bins=None):
+                 binsize=None, winsize_bins=None,
+                 method=None, block_size=None,
+                 rows=None, pairs=None,
+                 chunk_size=None, n_processes=None):
     """Compute all pairwise cross-correlograms among the clusters appearing
     in 'spike_clusters'.
 
@@ -44,20 +334,54 @@ def correlograms(spike_samples, spike_clusters,
     ----------
 
     spike_samples : array-like
-        Spike times in samples (integers).
+        Sorted spike times in samples (integers).
     spike_clusters : array-like
         Spike-cluster mapping.
     binsize : int
         Number of time samples in one bin.
     winsize_bins : int (odd number)
         Number of bins in the window.
+    method : str
+        The algorithm used to find the pairs of spikes:
+
+        * `'searchsorted'` (default): find the neighbours of every spike
+          with a binary search, and accumulate all pairs in a vectorized
+          way, by blocks of spikes.
+        * `'shift'`: loop over the shifts between the two copies of the
+          spike trains. This is slow with bursty spike trains.
+
+        Both methods return exactly the same correlograms.
+    block_size : int
+        Maximum number of pairs of spikes processed at once with the
+        `'searchsorted'` method.
+    rows : array-like
+        If specified, only compute the CCGs `c[a, :]` with a cluster `a`
+        in `rows`: only the reference spikes of these clusters are
+        counted.
+    pairs : array-like
+        If specified, a list of pairs of clusters `(a, b)`: only compute
+        the CCGs `c[a, b]`.
+    chunk_size : int
+        If specified, the spike train is split into time chunks of
+        `chunk_size` samples with the `'searchsorted'` method, so that the
+        memory usage is bounded.
+    n_processes : int
+        If specified, the chunks are processed in parallel in a pool of
+        `n_processes` processes. The partial CCGs are summed, so that
+        the result is exact.
 
     Returns
     -------
 
     correlograms : array
         A (n_clusters, n_clusters, winsize_samples) array with all pairwise
-        CCGs.
+        CCGs. This is a (n_rows, n_clusters, winsize_samples) array if
+        `rows` is specified, and a (n_pairs, winsize_samples) array if
+        `pairs` is specified. The clusters are the sorted unique clusters
+        of `spike_clusters`.
+
+    Note that `c[a, b]` only contains the delays `t_b - t_a >= 0`: the
+    symmetrized CCG of two clusters requires both `c[a, b]` and `c[b, a]`.
 
     Notes
     -----
@@ -68,9 +392,6 @@ def correlograms(spike_samples, spike_clusters,
         winsize_bins = 2 * ((winsize_samples // 2) // binsize) + 1
         assert winsize_bins % 2 == 1
 
-    For performance reasons, it is recommended to compute the CCGs on a subset
-    with only a few thousands or tens of thousands of spikes.
-
     """
 
     spike_clusters = _as_array(spike_clusters)
@@ -91,60 +412,221 @@ def correlograms(spike_samples, spike_clusters,
     # Like spike_clusters, but with 0..n_clusters-1 indices.
     spike_clusters_i = _index_of(spike_clusters, clusters)
 
-    # Shift between the two copies of the spike trains.
-    shift = 1
+    if method not in (None, 'searchsorted', 'shift'):
+        raise ValueError("The method should be 'searchsorted' or 'shift'.")
 
-    # At a given shift, the mask precises which spikes have matching spikes
-    # within the correlogram time window.
-    mask = np.ones_like(spike_samples, dtype=np.bool)
+    chunked = dict(chunk_size=chunk_size, n_processes=n_processes)
+
+    if rows is not None or pairs is not None:
+        return _correlograms_subset(spike_samples, spike_clusters_i,
+                                    clusters, binsize, winsize_bins,
+                                    method=method, block_size=block_size,
+                                    rows=rows, pairs=pairs, **chunked)
 
     correlograms = _create_correlograms_array(n_clusters, winsize_bins)
 
-    # The loop continues as long as there is at least one spike with
-    # a matching spike.
-    while mask[:-shift].any():
-        # Number of time samples between spike i and spike i+shift.
-        spike_diff = _diff_shifted(spike_samples, shift)
+    if method == 'shift':
+        _correlograms_shift(correlograms, spike_samples,
+                            spike_clusters_i, binsize, winsize_bins)
+    else:
+        _searchsorted_engine(**chunked)(correlograms, spike_samples,
+                                        spike_clusters_i, binsize,
+                                        winsize_bins, block_size=block_size)
 
-        # Binarize the delays between spike i and spike i+shift.
-        spike_diff_b = spike_diff // binsize
+    # Remove ACG peaks.
+    correlograms[np.arange(n_clusters),
+                 np.arange(n_clusters),
+                 0] = 0
 
-        # Spikes with no matching spikes are masked.
-        mask[:-shift][spike_diff_b > (winsize_bins//2)] = False
+    return correlograms
 
-        # Cache the masked spike delays.
-        m = mask[:-shift].copy()
-        d = spike_diff_b[m]
 
-        # # Update the masks given the clusters to update.
-        # m0 = np.in1d(spike_clusters[:-shift], clusters)
-        # m = m & m0
-        # d = spike_diff_b[m]
-        d = spike_diff_b[m]
+def _searchsorted_engine(chunk_size=None, n_processes=None):
+    """Return the function accumulating the CCGs with the `'searchsorted'`
+    method, possibly by time chunks."""
+    if chunk_size is None and n_processes is None:
+        return _correlograms_searchsorted
 
-        # Find the indices in the raveled correlograms array that need
-        # to be incremented, taking into account the spike clusters.
-        indices = np.ravel_multi_index((spike_clusters_i[:-shift][m],
-                                        spike_clusters_i[shift:][m], d),
-                                       correlograms.shape)
+    def engine(*args, **kwargs):
+        return _correlograms_chunked(*args, chunk_size=chunk_size,
+                                     n_processes=n_processes, **kwargs)
+    return engine
 
-        # Increment the matching spikes in the correlograms array.
-        _increment(correlograms.ravel(), indices)
 
-        shift += 1
+def _correlograms_subset(spike_samples, spike_clusters_i, clusters,
+                         binsize, winsize_bins, method=None, block_size=None,
+                         rows=None, pairs=None,
+                         chunk_size=None, n_processes=None):
+    """Compute the CCGs of some rows or pairs of clusters only.
 
-    # Remove ACG peaks.
-    correlograms[np.arange(n_clusters),
-                 np.arange(n_clusters),
-                 0] = 0
+    Requested clusters that do not appear in `clusters` get empty CCGs.
 
-    return correlograms
+    """
+    n_clusters = len(clusters)
+    n_bins = winsize_bins // 2 + 1
+    kwargs = dict(block_size=block_size, n_clusters=n_clusters)
+    engine = _searchsorted_engine(chunk_size=chunk_size,
+                                  n_processes=n_processes)
+
+    if method == 'shift':
+        full = _create_correlograms_array(n_clusters, winsize_bins)
+        _correlograms_shift(full, spike_samples, spike_clusters_i,
+                            binsize, winsize_bins)
+
+    if rows is not None:
+        rows_i = _relative_cluster_index(rows, clusters)
+        valid = rows_i >= 0
+        # Only compute the unique existing rows.
+        unique, inverse = np.unique(rows_i[valid], return_inverse=True)
+        if method == 'shift':
+            tmp = full[unique]
+        else:
+            tmp = np.zeros((len(unique), n_clusters, n_bins), dtype=np.int32)
+            engine(tmp, spike_samples, spike_clusters_i,
+                   binsize, winsize_bins, rows=unique, **kwargs)
+        out = np.zeros((len(rows_i), n_clusters, n_bins), dtype=np.int32)
+        out[valid] = tmp[inverse]
+        # Remove ACG peaks.
+        idx = np.nonzero(valid)[0]
+        out[idx, rows_i[idx], 0] = 0
+        return out
+
+    pairs = np.asarray(pairs, dtype=np.int64).reshape((-1, 2))
+    pairs_i = np.c_[_relative_cluster_index(pairs[:, 0], clusters),
+                    _relative_cluster_index(pairs[:, 1], clusters)]
+    valid = np.all(pairs_i >= 0, axis=1)
+    # Only compute the unique existing pairs.
+    keys = pairs_i[valid, 0] * n_clusters + pairs_i[valid, 1]
+    unique, inverse = np.unique(keys, return_inverse=True)
+    unique_pairs = np.c_[unique // n_clusters, unique % n_clusters]
+    if method == 'shift':
+        tmp = full[unique_pairs[:, 0], unique_pairs[:, 1]]
+    else:
+        tmp = np.zeros((len(unique), n_bins), dtype=np.int32)
+        engine(tmp, spike_samples, spike_clusters_i,
+               binsize, winsize_bins, pairs=unique_pairs, **kwargs)
+    out = np.zeros((len(pairs_i), n_bins), dtype=np.int32)
+    out[valid] = tmp[inverse]
+    # Remove ACG peaks.
+    out[valid & (pairs[:, 0] == pairs[:, 1]), 0] = 0
+    return out
 
 
 #------------------------------------------------------------------------------
 # Helper functions for CCG data structures
 #------------------------------------------------------------------------------
 
+def _merge_correlograms(correlograms, clusters, merged, new_cluster):
+    """Update the CCGs after a merge, without recomputing them.
+
+    Parameters
+    ----------
+
+    correlograms : array
+        A (n_clusters, n_clusters, n_bins) array as returned by
+        `correlograms()`.
+    clusters : array-like
+        The sorted clusters of the CCGs.
+    merged : array-like
+        The clusters that are merged.
+    new_cluster : int
+        The id of the merged cluster.
+
+    Returns
+    -------
+
+    (correlograms, clusters) : tuple
+        The CCGs of the new clusters, and the sorted new clusters.
+
+    Notes
+    -----
+
+    The CCGs of the merged cluster are the sums of the CCGs of the merged
+    clusters, and its ACG also includes the CCGs between the merged
+    clusters. The result is identical to a full recomputation with the
+    same spikes.
+
+    """
+    clusters = np.asarray(clusters)
+    is_merged = np.in1d(clusters, merged)
+    if not np.any(is_merged):
+        return correlograms, clusters
+    new_clusters = np.unique(np.r_[clusters[~is_merged], new_cluster])
+    # Index of every old cluster in the new clusters.
+    new_index = np.searchsorted(new_clusters,
+                                np.where(is_merged, new_cluster, clusters))
+    n_new = len(new_clusters)
+    out = np.zeros((n_new, n_new, correlograms.shape[2]),
+                   dtype=correlograms.dtype)
+    np.add.at(out, (new_index[:, np.newaxis], new_index[np.newaxis, :]),
+              correlograms)
+    # Remove the ACG peak of the merged cluster.
+    i = np.searchsorted(new_clusters, new_cluster)
+    out[i, i, 0] = 0
+    return out, new_clusters
+
+
+def _can_rebin(binsize, winsize_bins, new_binsize, new_winsize_bins):
+    """Return whether CCGs can be derived from CCGs computed with a finer
+    bin size and a larger window."""
+    if new_binsize % binsize != 0:
+        return False
+    factor = new_binsize // binsize
+    return (new_winsize_bins // 2 + 1) * factor <= winsize_bins // 2 + 1
+
+
+def _rebin(correlograms, factor, n_bins):
+    """Sum groups of `factor` consecutive bins along the last axis, and
+    keep the first `n_bins` new bins."""
+    correlograms = correlograms[..., :n_bins * factor]
+    shape = correlograms.shape[:-1] + (n_bins, factor)
+    return correlograms.reshape(shape).sum(axis=-1).astype(np.int32)
+
+
+def rebin_correlograms(correlograms, binsize, winsize_bins,
+                       new_binsize, new_winsize_bins):
+    """Derive CCGs with a coarser bin size or a smaller window from CCGs
+    computed at a finer resolution, without going back to the spikes.
+
+    Parameters
+    ----------
+
+    correlograms : array
+        A (n_clusters, n_clusters, n_bins) array as returned by
+        `correlograms()` with `binsize` and `winsize_bins`.
+    binsize : int
+        The bin size of `correlograms`.
+    winsize_bins : int
+        The window size (in bins) of `correlograms`.
+    new_binsize : int
+        The new bin size, a multiple of `binsize`.
+    new_winsize_bins : int
+        The new window size, in new bins. The new window must not be larger
+        than the original window.
+
+    Returns
+    -------
+
+    correlograms : array
+        The CCGs that `correlograms()` would return with `new_binsize` and
+        `new_winsize_bins`.
+
+    """
+    if not _can_rebin(binsize, winsize_bins, new_binsize, new_winsize_bins):
+        raise ValueError("The CCGs with a bin size of {0:d} and a window of "
+                         "{1:d} bins cannot be derived from the CCGs with a "
+                         "bin size of {2:d} and a window of {3:d} bins."
+                         "".format(new_binsize, new_winsize_bins,
+                                   binsize, winsize_bins))
+    n_clusters = correlograms.shape[0]
+    out = _rebin(correlograms, new_binsize // binsize,
+                 new_winsize_bins // 2 + 1)
+    # Remove ACG peaks: the new first bin also contains the delays that
+    # were in the next original bins.
+    out[np.arange(n_clusters), np.arange(n_clusters), 0] = 0
+    return out
+
+
 def _symmetrize_correlograms(correlograms):
     """Return the symmetrized version of the CCG arrays."""
 
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""Cluster quality metrics."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+
+from ..utils.array import _index_of, _unique, _as_array
+
+
+#------------------------------------------------------------------------------
+# Cluster metrics
+#------------------------------------------------------------------------------
+
+def _sort_by_cluster(spike_samples, spike_clusters_i):
+    """Sort the spikes by cluster, and by time within every cluster.
+
+    If the spike samples are sorted, a stable sort on the clusters is
+    enough.
+
+    """
+    if np.all(spike_samples[1:] >= spike_samples[:-1]):
+        order = np.argsort(spike_clusters_i, kind='mergesort')
+    else:
+        order = np.lexsort((spike_samples, spike_clusters_i))
+    return (spike_samples[order].astype(np.int64),
+            spike_clusters_i[order].astype(np.int64))
+
+
+def _refractory_violations(samples, clusters_i, n_clusters,
+                           refractory_period):
+    """Count the pairs of spikes closer than the refractory period in every
+    cluster, with spikes sorted by cluster and time."""
+    if len(samples) == 0:
+        return np.zeros(n_clusters, dtype=np.int64)
+    # Spikes of different clusters are further apart than the refractory
+    # period on this combined time axis.
+    offset = samples.max() + refractory_period + 1
+    keys = clusters_i * offset + samples
+    ends = np.searchsorted(keys, keys + refractory_period, side='left')
+    n_pairs = ends - np.arange(1, len(keys) + 1)
+    return np.bincount(clusters_i, weights=n_pairs,
+                       minlength=n_clusters).astype(np.int64)
+
+
+def _isi_histograms(samples, clusters_i, n_clusters, binsize, n_bins):
+    """Compute the ISI histograms of all clusters, with spikes sorted by
+    cluster and time."""
+    same = clusters_i[1:] == clusters_i[:-1]
+    isi = (samples[1:] - samples[:-1])[same]
+    bins = np.floor(isi / float(binsize)).astype(np.int64)
+    keep = bins < n_bins
+    indices = clusters_i[1:][same][keep] * n_bins + bins[keep]
+    hist = np.bincount(indices, minlength=n_clusters * n_bins)
+    return hist.reshape((n_clusters, n_bins))
+
+
+def refractory_violations(spike_samples, spike_clusters, refractory_period):
+    """Count the refractory period violations of all clusters.
+
+    Parameters
+    ----------
+
+    spike_samples : array-like
+        Spike times in samples (integers), sorted or not.
+    spike_clusters : array-like
+        Spike-cluster mapping.
+    refractory_period : int
+        Refractory period, in samples.
+
+    Returns
+    -------
+
+    violations : array
+        The number of pairs of spikes with a delay strictly smaller than the
+        refractory period, for every cluster in `_unique(spike_clusters)`.
+        This is the total count in the first bins of the ACGs, peak
+        included.
+
+    """
+    spike_clusters = _as_array(spike_clusters)
+    clusters = _unique(spike_clusters)
+    samples, clusters_i = _sort_by_cluster(_as_array(spike_samples),
+                                           _index_of(spike_clusters,
+                                                     clusters))
+    return _refractory_violations(samples, clusters_i, len(clusters),
+                                  int(np.ceil(refractory_period)))
+
+
+def isi_histograms(spike_samples, spike_clusters, binsize, n_bins):
+    """Compute the inter-spike interval histograms of all clusters.
+
+    Parameters
+    ----------
+
+    spike_samples : array-like
+        Spike times in samples (integers), sorted or not.
+    spike_clusters : array-like
+        Spike-cluster mapping.
+    binsize : float
+        Bin size, in samples.
+    n_bins : int
+        Number of bins. Longer intervals are discarded.
+
+    Returns
+    -------
+
+    histograms : array
+        A `(n_clusters, n_bins)` array.
+
+    """
+    spike_clusters = _as_array(spike_clusters)
+    clusters = _unique(spike_clusters)
+    samples, clusters_i = _sort_by_cluster(_as_array(spike_samples),
+                                           _index_of(spike_clusters,
+                                                     clusters))
+    return _isi_histograms(samples, clusters_i, len(clusters),
+                           binsize, n_bins)
+
+
+def cluster_metrics(spike_samples, spike_clusters, sample_rate,
+                    duration=None,
+                    refractory_period=.002,
+                    isi_binsize=.001,
+                    isi_n_bins=50,
+                    ):
+    """Compute the quality metrics of all clusters at once.
+
+    Parameters
+    ----------
+
+    spike_samples : array-like
+        Spike times in samples (integers), sorted or not.
+    spike_clusters : array-like
+        Spike-cluster mapping.
+    sample_rate : float
+        The sample rate.
+    duration : float
+        Duration of the recording, in seconds. By default, this is the time
+        of the last spike.
+    refractory_period : float
+        Refractory period, in seconds.
+    isi_binsize : float
+        Bin size of the ISI histograms, in seconds.
+    isi_n_bins : int
+        Number of bins of the ISI histograms.
+
+    Returns
+    -------
+
+    metrics : dict
+        A dictionary with the following arrays, with one row per cluster:
+
+        * `clusters`: the sorted clusters.
+        * `n_spikes`: the number of spikes.
+        * `firing_rates`: the firing rates, in spikes per second.
+        * `refractory_violations`: the number of pairs of spikes closer than
+          the refractory period.
+        * `isi_histograms`: the `(n_clusters, isi_n_bins)` ISI histograms.
+
+    """
+    spike_samples = _as_array(spike_samples)
+    spike_clusters = _as_array(spike_clusters)
+    assert spike_samples.shape == spike_clusters.shape
+    sample_rate = float(sample_rate)
+
+    clusters = _unique(spike_clusters)
+    n_clusters = len(clusters)
+    spike_clusters_i = _index_of(spike_clusters, clusters)
+
+    if duration is None:
+        duration = (int(spike_samples.max()) + 1 if len(spike_samples)
+                    else 1) / sample_rate
+    n_spikes = np.bincount(spike_clusters_i, minlength=n_clusters)
+
+    # The spikes are sorted once for all metrics.
+    samples, clusters_i = _sort_by_cluster(spike_samples, spike_clusters_i)
+    refractory = int(np.ceil(refractory_period * sample_rate))
+    violations = _refractory_violations(samples, clusters_i, n_clusters,
+                                        refractory)
+    isi = _isi_histograms(samples, clusters_i, n_clusters,
+                          isi_binsize * sample_rate, isi_n_bins)
+
+    return {'clusters': clusters,
+            'n_spikes': n_spikes,
+            'firing_rates': n_spikes / float(duration),
+            'refractory_violations': violations,
+            'isi_histograms': isi,
+            }
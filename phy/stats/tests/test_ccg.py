@@ -8,12 +8,18 @@
 
 import numpy as np
 from numpy.testing import assert_array_equal as ae
-from pytest import raises
+from pytest import raises, mark
 
+from ...utils.testing import benchmark
 from ..ccg import (_increment,
                    _diff_shifted,
+                   _spike_blocks,
                    correlograms,
+                   _merge_correlograms,
+                   rebin_correlograms,
                    _symmetrize_correlograms,
+                   _pools,
+                   _close_pools,
                    )
 
 
@@ -176,3 +182,194 @@ def test_symmetrize_correlograms():
     assert np.all(sym[np.arange(3), np.arange(3), 25] == 0)
 
     ae(sym[0, 1, :], sym[1, 0, ::-1])
+
+
+def test_spike_blocks():
+    n_pairs = [3, 0, 2, 5, 1, 1]
+    assert list(_spike_blocks(n_pairs, 5)) == [(0, 3), (3, 4), (4, 6)]
+    assert list(_spike_blocks(n_pairs, 1)) == [(0, 1), (1, 2), (2, 3),
+                                               (3, 4), (4, 5), (5, 6)]
+    assert list(_spike_blocks(n_pairs, 100)) == [(0, 6)]
+    assert list(_spike_blocks([], 10)) == []
+
+
+def test_ccg_methods():
+    binsize, winsize_bins = _ccg_params()
+
+    # Random spike trains, with bursts and identical spike times.
+    spike_samples, spike_clusters = _random_data(5)
+    bursts = np.repeat(spike_samples[::100], 20)
+    spike_samples = np.sort(np.r_[spike_samples, bursts]).astype(np.uint64)
+    spike_clusters = np.random.randint(0, 5, len(spike_samples))
+
+    c_shift = correlograms(spike_samples, spike_clusters,
+                           binsize=binsize, winsize_bins=winsize_bins,
+                           method='shift')
+    for block_size in (None, 1, 1000):
+        c = correlograms(spike_samples, spike_clusters,
+                         binsize=binsize, winsize_bins=winsize_bins,
+                         block_size=block_size)
+        ae(c, c_shift)
+
+    # int64 spike samples.
+    c = correlograms(spike_samples.astype(np.int64), spike_clusters,
+                     binsize=binsize, winsize_bins=winsize_bins)
+    ae(c, c_shift)
+
+    with raises(ValueError):
+        correlograms(spike_samples, spike_clusters,
+                     binsize=binsize, winsize_bins=winsize_bins,
+                     method='unknown')
+
+
+def test_ccg_rows_pairs():
+    binsize, winsize_bins = _ccg_params()
+    spike_samples, spike_clusters = _random_data(6)
+    # Cluster 1 is empty.
+    spike_clusters[spike_clusters == 1] = 0
+    clusters = [0, 2, 3, 4, 5]
+
+    def _ccg(**kwargs):
+        return correlograms(spike_samples, spike_clusters,
+                            binsize=binsize, winsize_bins=winsize_bins,
+                            **kwargs)
+
+    full = _ccg()
+    for method in ('searchsorted', 'shift'):
+        # Rows.
+        c = _ccg(rows=[4, 0], method=method)
+        assert c.shape == (2, 5, 26)
+        ae(c, full[[3, 0]])
+
+        # Missing and repeated rows.
+        c = _ccg(rows=[2, 1, 2, 7], method=method)
+        ae(c[[0, 2]], full[[1, 1]])
+        ae(c[[1, 3]], 0)
+
+        # Pairs.
+        pairs = [(0, 3), (3, 0), (5, 5), (1, 2), (0, 3)]
+        c = _ccg(pairs=pairs, method=method)
+        assert c.shape == (5, 26)
+        for k, (a, b) in enumerate(pairs):
+            if a in clusters and b in clusters:
+                ae(c[k], full[clusters.index(a), clusters.index(b)])
+            else:
+                ae(c[k], 0)
+        assert _ccg(pairs=[], method=method).shape == (0, 26)
+
+
+def test_ccg_chunked():
+    binsize, winsize_bins = _ccg_params()
+    spike_samples, spike_clusters = _random_data(5)
+    # Some spikes exactly at the chunk boundaries.
+    spike_samples[100:110] = spike_samples[100]
+    n_samples = int(spike_samples[-1])
+
+    def _ccg(**kwargs):
+        return correlograms(spike_samples, spike_clusters,
+                            binsize=binsize, winsize_bins=winsize_bins,
+                            **kwargs)
+
+    full = _ccg()
+
+    # The overlapping spikes are not counted twice.
+    for chunk_size in (10000, 65537, int(spike_samples[100]), n_samples,
+                       2 * n_samples):
+        ae(_ccg(chunk_size=chunk_size), full)
+    ae(_ccg(rows=[3, 1], chunk_size=1000), full[[3, 1]])
+    ae(_ccg(pairs=[(0, 2), (4, 4)], chunk_size=1000), full[[0, 4], [2, 4]])
+
+    # Worker processes, started once.
+    ae(_ccg(n_processes=2), full)
+    pool = _pools[2]
+    ae(_ccg(n_processes=2, chunk_size=5000, pairs=[(1, 0)]), full[[1], [0]])
+    assert _pools[2] is pool
+    _close_pools()
+    assert not _pools
+
+    # A single chunk is computed in the current process.
+    ae(_ccg(n_processes=2, chunk_size=2 * n_samples), full)
+    assert not _pools
+
+
+def test_rebin_correlograms():
+    spike_samples, spike_clusters = _random_data(4)
+
+    def _ccg(binsize, winsize_bins):
+        return correlograms(spike_samples, spike_clusters,
+                            binsize=binsize, winsize_bins=winsize_bins)
+
+    base = _ccg(5, 2 * 103 + 1)
+    for binsize, winsize_bins in ((5, 2 * 103 + 1), (5, 2 * 11 + 1),
+                                  (10, 2 * 51 + 1), (20, 2 * 25 + 1),
+                                  (15, 2 * 33 + 1), (100, 2 * 3 + 1)):
+        ae(rebin_correlograms(base, 5, 2 * 103 + 1, binsize, winsize_bins),
+           _ccg(binsize, winsize_bins))
+
+    # The bin size must be a multiple of the base bin size.
+    with raises(ValueError):
+        rebin_correlograms(base, 5, 2 * 103 + 1, 12, 2 * 25 + 1)
+    # The window cannot be larger.
+    with raises(ValueError):
+        rebin_correlograms(base, 5, 2 * 103 + 1, 20, 2 * 27 + 1)
+
+
+def test_merge_correlograms():
+    binsize, winsize_bins = _ccg_params()
+    spike_samples, spike_clusters = _random_data(6)
+    spike_clusters = spike_clusters.copy()
+
+    def _ccg():
+        return correlograms(spike_samples, spike_clusters,
+                            binsize=binsize, winsize_bins=winsize_bins)
+
+    ccgs, clusters = _ccg(), np.arange(6)
+
+    # Merge clusters: 1, 3 -> 6, then 6, 0, 5 -> 7.
+    for merged, new in (([1, 3], 6), ([6, 0, 5], 7)):
+        ccgs, clusters = _merge_correlograms(ccgs, clusters, merged, new)
+        spike_clusters[np.in1d(spike_clusters, merged)] = new
+        ae(clusters, np.unique(spike_clusters))
+        ae(ccgs, _ccg())
+
+    # Merging clusters which are not in the CCGs does nothing.
+    ccgs_1, clusters_1 = _merge_correlograms(ccgs, clusters, [10, 11], 12)
+    ae(ccgs_1, ccgs)
+    ae(clusters_1, clusters)
+
+
+@mark.slow
+def test_ccg_benchmark():
+    binsize, winsize_bins = _ccg_params()
+    sr = 20000
+    for n_spikes in (10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7):
+        # Poisson spike trains at 100 Hz, with 1% of the spikes in
+        # bursts of 100 spikes within 2.5 ms.
+        n_bursts = max(1, n_spikes // 10000)
+        n_poisson = n_spikes - 100 * n_bursts
+        isi = np.random.exponential(scale=.01, size=n_poisson)
+        spike_samples = (np.cumsum(isi) * sr).astype(np.uint64)
+        bursts = np.random.choice(spike_samples, n_bursts)
+        bursts = (bursts[:, np.newaxis] +
+                  np.random.randint(0, 50, (n_bursts, 100)).astype(np.uint64))
+        spike_samples = np.sort(np.r_[spike_samples, bursts.ravel()])
+        spike_clusters = np.random.randint(0, 10, n_spikes)
+
+        name = '{0:d} spikes'.format(n_spikes)
+        with benchmark('Searchsorted CCGs, ' + name):
+            c = correlograms(spike_samples, spike_clusters,
+                             binsize=binsize, winsize_bins=winsize_bins)
+        if n_spikes <= 10 ** 5:
+            with benchmark('Shift CCGs, ' + name):
+                c_shift = correlograms(spike_samples, spike_clusters,
+                                       binsize=binsize,
+                                       winsize_bins=winsize_bins,
+                                       method='shift')
+            ae(c, c_shift)
+        if n_spikes >= 10 ** 6:
+            with benchmark('Chunked CCGs, 4 processes, ' + name):
+                c_chunked = correlograms(spike_samples, spike_clusters,
+                                         binsize=binsize,
+                                         winsize_bins=winsize_bins,
+                                         n_processes=4)
+            ae(c, c_chunked)
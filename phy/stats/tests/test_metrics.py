@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of cluster metrics."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+from pytest import mark
+
+from ...utils.testing import benchmark
+from ..ccg import correlograms
+from ..metrics import (refractory_violations,
+                       isi_histograms,
+                       cluster_metrics,
+                       )
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def _random_data(n_spikes, n_clusters):
+    isi = np.random.exponential(scale=.001, size=n_spikes)
+    spike_samples = (np.cumsum(isi) * 20000).astype(np.uint64)
+    spike_clusters = np.random.randint(0, n_clusters, n_spikes)
+    return spike_samples, spike_clusters
+
+
+def test_refractory_violations():
+    spike_samples = np.array([0, 5, 8, 10, 30, 31, 31, 60], dtype=np.uint64)
+    spike_clusters = np.array([1, 1, 3, 1, 3, 1, 1, 3])
+    # Cluster 1: (0, 5), (5, 10), (31, 31), then (0, 10), then (10, 31) x 2.
+    ae(refractory_violations(spike_samples, spike_clusters, 6), [3, 0])
+    ae(refractory_violations(spike_samples, spike_clusters, 11), [4, 0])
+    ae(refractory_violations(spike_samples, spike_clusters, 23), [6, 1])
+
+    # Same as the first bins of the ACGs, peak included.
+    spike_samples, spike_clusters = _random_data(10000, 5)
+    ccg = correlograms(spike_samples, spike_clusters,
+                       binsize=40, winsize_bins=2 * 10 + 1)
+    # The first bin of the ACGs is removed in correlograms(), so we compare
+    # the second bin.
+    v1 = refractory_violations(spike_samples, spike_clusters, 40)
+    v2 = refractory_violations(spike_samples, spike_clusters, 80)
+    ae(v2 - v1, np.diagonal(ccg[..., 1]))
+
+
+def test_isi_histograms():
+    spike_samples = np.array([0, 5, 8, 10, 30, 31, 31, 60], dtype=np.uint64)
+    spike_clusters = np.array([1, 1, 3, 1, 3, 1, 1, 3])
+    hist = isi_histograms(spike_samples, spike_clusters, 10, 3)
+    # Cluster 1: 5, 5, 20, 0. Cluster 3: 22, 30.
+    ae(hist, [[3, 0, 1], [0, 0, 1]])
+    ae(isi_histograms(spike_samples, spike_clusters, 2.5, 2),
+       [[1, 0], [0, 0]])
+
+    # Unsorted spike samples, for example with several recordings.
+    perm = np.random.permutation(len(spike_samples))
+    ae(isi_histograms(spike_samples[perm], spike_clusters[perm], 10, 3),
+       hist)
+    ae(refractory_violations(spike_samples[perm], spike_clusters[perm], 23),
+       [6, 1])
+
+
+def test_cluster_metrics():
+    spike_samples, spike_clusters = _random_data(10000, 10)
+    # Cluster 4 is empty.
+    spike_clusters[spike_clusters == 4] = 3
+    m = cluster_metrics(spike_samples, spike_clusters, 20000.,
+                        duration=10.,
+                        refractory_period=.002,
+                        isi_binsize=.001, isi_n_bins=20)
+    clusters = m['clusters']
+    ae(clusters, [0, 1, 2, 3, 5, 6, 7, 8, 9])
+    for i, cluster in enumerate(clusters):
+        samples = spike_samples[spike_clusters == cluster].astype(np.int64)
+        assert m['n_spikes'][i] == len(samples)
+        ac(m['firing_rates'][i], len(samples) / 10.)
+        # Brute force.
+        d = samples[np.newaxis, :] - samples[:, np.newaxis]
+        assert m['refractory_violations'][i] == np.sum(np.triu(d < 40, 1))
+        isi = np.diff(samples)
+        ae(m['isi_histograms'][i], np.histogram(isi[isi < 400],
+                                                bins=np.arange(0, 401, 20))[0])
+
+
+@mark.slow
+def test_cluster_metrics_benchmark():
+    for n_spikes, n_clusters in ((10 ** 5, 100), (10 ** 7, 1000)):
+        spike_samples, spike_clusters = _random_data(n_spikes, n_clusters)
+        name = '{0:d} spikes, {1:d} clusters'.format(n_spikes, n_clusters)
+        with benchmark('Cluster metrics, ' + name):
+            m = cluster_metrics(spike_samples, spike_clusters, 20000.)
+        assert m['n_spikes'].sum() == n_spikes
@@ -196,7 +196,12 @@ def _start_stop(item):
 
 class ConcatenatedArrays(object):
     """This object represents a concatenation of several memory-mapped
-    arrays."""
+    arrays.
+
+    A selection in the other dimensions can be passed as a tuple, like
+    `arr[start:stop, columns]`: it is forwarded to the underlying arrays.
+
+    """
     def __init__(self, arrs):
         assert isinstance(arrs, list)
         self.arrs = arrs
@@ -205,6 +210,9 @@ class ConcatenatedArrays(object):
                                       axis=0)
         self.dtype = arrs[0].dtype if arrs else None
         self.shape = (self.offsets[-1],) + arrs[0].shape[1:]
+        # Keep the HDF5 chunk layout of the underlying arrays.
+        if arrs and hasattr(arrs[0], 'chunks'):
+            self.chunks = arrs[0].chunks
 
     def _get_recording(self, index):
         """Return the recording that contains a given index."""
@@ -219,11 +227,17 @@ class ConcatenatedArrays(object):
         return recs[-1]
 
     def __getitem__(self, item):
+        # Selection in the other dimensions.
+        if isinstance(item, tuple):
+            item, other = item[0], item[1:]
+        else:
+            other = ()
         # Get the start and stop indices of the requested item.
         start, stop = _start_stop(item)
         # Return the concatenation of all arrays.
         if start is None and stop is None:
-            return np.concatenate(self.arrs, axis=0)
+            return np.concatenate([arr[(slice(None),) + other]
+                                   for arr in self.arrs], axis=0)
         if start is None:
             start = 0
         if stop is None:
@@ -239,16 +253,17 @@ class ConcatenatedArrays(object):
         stop_rel = stop - self.offsets[rec_stop]
         # Single array case.
         if rec_start == rec_stop:
-            return self.arrs[rec_start][start_rel:stop_rel]
-        chunk_start = self.arrs[rec_start][start_rel:]
-        chunk_stop = self.arrs[rec_stop][:stop_rel]
+            return self.arrs[rec_start][(slice(start_rel, stop_rel),) +
+                                        other]
+        chunk_start = self.arrs[rec_start][(slice(start_rel, None),) + other]
+        chunk_stop = self.arrs[rec_stop][(slice(None, stop_rel),) + other]
         # Concatenate all chunks.
         l = [chunk_start]
         if rec_stop - rec_start >= 2:
             warn("Loading a full virtual array: this might be slow "
                  "and something might be wrong.")
-            l += [self.arrs[r][...] for r in range(rec_start + 1,
-                                                   rec_stop)]
+            l += [self.arrs[r][(slice(None),) + other]
+                  for r in range(rec_start + 1, rec_stop)]
         l += [chunk_stop]
         return np.concatenate(l, axis=0)
 
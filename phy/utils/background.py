@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+"""Background threads with bounded queues."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import sys
+import threading
+
+from ..ext.six import reraise
+from ..ext.six.moves import queue
+
+
+#------------------------------------------------------------------------------
+# Background threads
+#------------------------------------------------------------------------------
+
+# Marks the end of a queue.
+_END = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(q, item, stop):
+    """Put an item in a bounded queue, unless the consumer has stopped."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=.1)
+            return
+        except queue.Full:
+            continue
+    raise _Stopped()
+
+
+def iter_prefetch(iterable, max_size=2):
+    """Iterate over an iterable in a background thread.
+
+    At most `max_size` items are computed ahead of the consumer. Exceptions
+    raised in the background thread are raised again in the consumer.
+
+    """
+    q = queue.Queue(maxsize=max_size)
+    stop = threading.Event()
+
+    def _run():
+        try:
+            for item in iterable:
+                _put(q, (item, None), stop)
+            _put(q, (_END, None), stop)
+        except _Stopped:
+            pass
+        except Exception:
+            try:
+                _put(q, (_END, sys.exc_info()), stop)
+            except _Stopped:
+                pass
+
+    thread = threading.Thread(target=_run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = q.get()
+            if exc_info is not None:
+                reraise(*exc_info)
+            if item is _END:
+                break
+            yield item
+    finally:
+        # Stop the background thread if the consumer stops early.
+        stop.set()
+        thread.join()
+
+
+class BackgroundWorker(object):
+    """Call a function on items in a background thread.
+
+    The items are put in a bounded queue: `put()` blocks when `max_size`
+    items are waiting. The first exception raised by the function is raised
+    again in the next call to `put()` or `close()`.
+
+    """
+    def __init__(self, func, max_size=16):
+        self._func = func
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stop = threading.Event()
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _END or self._stop.is_set():
+                return
+            try:
+                self._func(*item)
+            except Exception:
+                self._exc_info = sys.exc_info()
+                self._stop.set()
+                return
+
+    def _check(self):
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            reraise(*exc_info)
+
+    def put(self, *args):
+        """Call `func(*args)` in the background thread."""
+        self._check()
+        try:
+            _put(self._queue, args, self._stop)
+        except _Stopped:
+            self._thread.join()
+            self._check()
+
+    def close(self):
+        """Wait until all items have been processed."""
+        if self._thread.is_alive():
+            try:
+                _put(self._queue, _END, self._stop)
+            except _Stopped:
+                pass
+            self._thread.join()
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is None:
+            self.close()
+        else:
+            # Do not process the remaining items if there was an error.
+            self._stop.set()
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                self._queue.put_nowait(_END)
+            except queue.Full:
+                pass
+            self._thread.join()
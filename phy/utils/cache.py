@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""Memory-bounded caches."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import sys
+from collections import OrderedDict
+
+
+#------------------------------------------------------------------------------
+# LRU cache
+#------------------------------------------------------------------------------
+
+def _nbytes(value):
+    """Return the approximate size in bytes of an object."""
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    elif isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    elif isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """A dictionary-like cache with a maximum size in bytes and a
+    least-recently-used eviction policy.
+
+    Parameters
+    ----------
+
+    max_size : int or None
+        Maximum total size of the cached values, in bytes. If None, the cache
+        is unbounded.
+    sizeof : function or None
+        A function returning the size in bytes of a value. By default, this
+        is the `nbytes` attribute of NumPy arrays.
+    on_evict : function or None
+        A function `on_evict(key, value)` called when a value is evicted
+        from the cache because of the size limit. A value larger than
+        `max_size` is passed to this function directly, without being
+        cached nor evicting any other value.
+
+    """
+    def __init__(self, max_size=None, sizeof=None, on_evict=None):
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._sizeof = sizeof or _nbytes
+        self._on_evict = on_evict
+        self._max_size = max_size
+        self.size = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset the hit, miss, and eviction counters."""
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+
+    @property
+    def max_size(self):
+        """Maximum total size of the cached values, in bytes."""
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, value):
+        self._max_size = value
+        self._evict()
+
+    def _evict(self):
+        """Evict the least-recently used values until the cache fits in
+        its maximum size."""
+        if self._max_size is None:
+            return
+        while self._data and self.size > self._max_size:
+            key, value = self._data.popitem(last=False)
+            self.size -= self._sizes.pop(key)
+            self.n_evictions += 1
+            if self._on_evict is not None:
+                self._on_evict(key, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        """List of keys, from the least to the most recently used."""
+        return list(self._data.keys())
+
+    def get(self, key, default=None):
+        """Return a value and mark it as the most recently used, or return
+        `default` if it is not in the cache."""
+        if key not in self._data:
+            self.n_misses += 1
+            return default
+        self.n_hits += 1
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def fits(self, value):
+        """Return whether a value is small enough to be cached."""
+        return self._max_size is None or self._sizeof(value) <= self._max_size
+
+    def peek(self, key, default=None):
+        """Return a value without marking it as the most recently used, or
+        return `default` if it is not in the cache."""
+        return self._data.get(key, default)
+
+    def __getitem__(self, key):
+        if key not in self._data:
+            self.n_misses += 1
+            raise KeyError(key)
+        return self.get(key)
+
+    def set(self, key, value):
+        """Add or replace a value in the cache, and evict the least-recently
+        used values if needed."""
+        self.pop(key)
+        size = self._sizeof(value)
+        # A value larger than the cache would evict all other values before
+        # being evicted itself.
+        if self._max_size is not None and size > self._max_size:
+            self.n_evictions += 1
+            if self._on_evict is not None:
+                self._on_evict(key, value)
+            return
+        self._data[key] = value
+        self._sizes[key] = size
+        self.size += size
+        self._evict()
+
+    __setitem__ = set
+
+    def pop(self, key, default=None):
+        """Remove a value from the cache and return it."""
+        if key not in self._data:
+            return default
+        self.size -= self._sizes.pop(key)
+        return self._data.pop(key)
+
+    def __delitem__(self, key):
+        if key not in self._data:
+            raise KeyError(key)
+        self.pop(key)
+
+    def clear(self):
+        """Remove all values from the cache."""
+        self._data.clear()
+        self._sizes.clear()
+        self.size = 0
+
+    def __repr__(self):
+        return ("<LRUCache {0:d} items, {1:d}/{2} bytes, "
+                "{3:d} hits, {4:d} misses>").format(len(self), self.size,
+                                                    self._max_size,
+                                                    self.n_hits,
+                                                    self.n_misses)
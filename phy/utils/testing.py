@@ -9,7 +9,10 @@
 import sys
 import time
 from contextlib import contextmanager
+from timeit import default_timer
+
 from ..ext.six import StringIO
+from .logging import info
 
 
 #------------------------------------------------------------------------------
@@ -27,6 +30,22 @@ def captured_output():
         sys.stdout, sys.stderr = old_out, old_err
 
 
+@contextmanager
+def benchmark(name='', repeats=1):
+    """Measure the execution time of a block of code and log it.
+
+    The yielded dictionary contains the duration in seconds once the block
+    has been executed.
+
+    """
+    out = {}
+    start = default_timer()
+    yield out
+    duration = (default_timer() - start) / float(repeats)
+    out['duration'] = duration
+    info("{0} took {1:.3f} ms.".format(name, duration * 1000.))
+
+
 #------------------------------------------------------------------------------
 # Testing VisPy canvas
 #------------------------------------------------------------------------------
@@ -211,6 +211,11 @@ def test_concatenate_virtual_arrays():
     ae(concat[1:7], _concat(arr1[1:], arr2[:-2]))
     ae(concat[4:7], _concat(arr1[4:], arr2[:-2]))
 
+    # Selection of columns.
+    ae(concat[3:7, 1], _concat(arr1[3:], arr2[:2])[:, 1])
+    ae(concat[3:7, [0, 1]], _concat(arr1[3:], arr2[:2]))
+    ae(concat[6:, :1], arr2[1:, :1])
+
 
 #------------------------------------------------------------------------------
 # Test chunking
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of background threads."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import threading
+
+from pytest import raises
+
+from ..background import iter_prefetch, BackgroundWorker
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_iter_prefetch():
+    threads = []
+
+    def _gen(n):
+        for i in range(n):
+            threads.append(threading.current_thread())
+            yield i
+
+    assert list(iter_prefetch(_gen(10), max_size=3)) == list(range(10))
+    # The items are produced in a background thread.
+    assert threading.current_thread() not in threads
+    assert list(iter_prefetch(_gen(0))) == []
+
+    # Stop early.
+    it = iter_prefetch(_gen(100), max_size=1)
+    assert next(it) == 0
+    it.close()
+
+    # Exceptions are raised in the consumer.
+    def _fail():
+        yield 0
+        raise ValueError()
+
+    it = iter_prefetch(_fail())
+    assert next(it) == 0
+    with raises(ValueError):
+        next(it)
+
+
+def test_background_worker():
+    out = []
+    with BackgroundWorker(lambda x, y: out.append(x + y), max_size=2) as w:
+        for i in range(10):
+            w.put(i, 1)
+    assert out == list(range(1, 11))
+
+    # Exceptions are raised in the producer.
+    def _fail(x):
+        if x == 3:
+            raise ValueError()
+        out.append(x)
+
+    del out[:]
+    w = BackgroundWorker(_fail, max_size=1)
+    with raises(ValueError):
+        for i in range(100):
+            w.put(i)
+        w.close()
+    assert out == [0, 1, 2]
+
+    # Stop processing after an error in the producer.
+    w = BackgroundWorker(lambda x: None)
+    with raises(RuntimeError):
+        with w:
+            w.put(0)
+            raise RuntimeError()
+    assert not w._thread.is_alive()
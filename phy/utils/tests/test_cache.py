@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of cache utility functions."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from pytest import raises
+
+from ..cache import LRUCache, _nbytes
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_nbytes():
+    assert _nbytes(np.zeros(10, dtype=np.int16)) == 20
+    assert _nbytes({'a': np.zeros(3), 'b': np.zeros(2)}) == 40
+    assert _nbytes([np.zeros(3), np.zeros(2, dtype=np.float32)]) == 32
+    assert _nbytes(3) > 0
+
+
+def test_lru_cache():
+    evicted = []
+    cache = LRUCache(max_size=100,
+                     on_evict=lambda key, value: evicted.append(key))
+    assert len(cache) == 0
+    assert cache.get(0) is None
+    assert cache.n_misses == 1
+    with raises(KeyError):
+        cache[0]
+    assert cache.n_misses == 2
+
+    # 40 bytes per item.
+    for i in range(3):
+        cache[i] = np.zeros(5)
+    # The first item has been evicted.
+    assert evicted == [0]
+    assert cache.keys() == [1, 2]
+    assert cache.size == 80
+    assert cache.n_evictions == 1
+    assert 0 not in cache
+
+    # Using 1 makes 2 the least recently used.
+    assert cache[1].shape == (5,)
+    assert cache.n_hits == 1
+    cache[3] = np.zeros(5)
+    assert evicted == [0, 2]
+    assert cache.keys() == [1, 3]
+
+    # Peeking does not change the order nor the statistics.
+    assert cache.peek(3).shape == (5,)
+    assert cache.peek(0) is None
+    assert cache.keys() == [1, 3]
+    assert cache.n_hits == 1
+
+    # Replace a value.
+    cache[1] = np.zeros(2)
+    assert cache.size == 56
+    assert cache.keys() == [3, 1]
+
+    # Delete a value.
+    del cache[3]
+    assert cache.size == 16
+    with raises(KeyError):
+        del cache[3]
+    assert cache.pop(3) is None
+
+    # Shrink the cache.
+    cache[4] = np.zeros(5)
+    cache.max_size = 50
+    assert cache.keys() == [4]
+
+    # A value larger than the cache is not kept, and does not evict the
+    # other values.
+    n_evictions = cache.n_evictions
+    assert not cache.fits(np.zeros(100))
+    cache[5] = np.zeros(100)
+    assert 5 not in cache
+    assert cache.keys() == [4]
+    assert evicted[-1] == 5
+    assert cache.n_evictions == n_evictions + 1
+    assert 'LRUCache' in repr(cache)
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.size == 0
+
+    cache.reset_stats()
+    assert cache.n_hits == cache.n_misses == cache.n_evictions == 0
+
+
+def test_lru_cache_unbounded():
+    cache = LRUCache()
+    for i in range(100):
+        cache[i] = np.zeros(100)
+    assert len(cache) == 100
+    assert cache.size == 80000
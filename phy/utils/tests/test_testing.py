@@ -6,7 +6,7 @@
 # Imports
 #------------------------------------------------------------------------------
 
-from ..testing import captured_output
+from ..testing import captured_output, benchmark
 
 
 #------------------------------------------------------------------------------
@@ -17,3 +17,9 @@ def test_captured_output():
     with captured_output() as (out, err):
         print('Hello world!')
     assert out.getvalue().strip() == 'Hello world!'
+
+
+def test_benchmark():
+    with benchmark('test', repeats=2) as b:
+        sum(range(1000))
+    assert b['duration'] >= 0
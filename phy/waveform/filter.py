@@ -10,7 +10,7 @@ import numpy as np
 from scipy import signal
 
 from ..ext import six
-from ..utils.array import _as_array
+from ..utils.array import _as_array, chunk_bounds
 
 
 #------------------------------------------------------------------------------
@@ -31,3 +31,127 @@ def apply_filter(x, filter=None):
         return x
     b, a = filter
     return signal.filtfilt(b, a, x, axis=0)
+
+
+def _odd_extension(x, n):
+    """Extend an array with an odd extension of `n` samples on both sides
+    along the first axis."""
+    if n <= 0:
+        return x
+    left = 2 * x[:1] - x[n:0:-1]
+    right = 2 * x[-1:] - x[-2:-(n + 2):-1]
+    return np.concatenate((left, x, right), axis=0)
+
+
+class Filter(object):
+    """Butterworth bandpass filter implemented with second-order sections.
+
+    The second-order sections and the steady-state initial conditions are
+    computed once, and the filter can then be applied to arrays of any
+    dimension along any axis, for example a
+    `(n_spikes, n_samples, n_channels)` stack of waveforms along the second
+    axis, or a long `(n_samples, n_channels)` chunk of traces along the
+    first axis.
+
+    Parameters
+    ----------
+
+    rate : float
+        The sample rate.
+    low : float
+        The low cutoff frequency.
+    high : float
+        The high cutoff frequency.
+    order : int
+        The order of the Butterworth filter.
+    causal : bool (default is False)
+        If False, the signal is filtered forward and backward so that there
+        is no phase distortion, like with `scipy.signal.filtfilt()`.
+        If True, a single causal forward pass is done.
+
+    """
+    def __init__(self, rate=None, low=None, high=None, order=None,
+                 causal=False):
+        self.causal = causal
+        self._sos = signal.butter(order,
+                                  (low/(rate/2.), high/(rate/2.)),
+                                  'pass',
+                                  output='sos')
+        self._zi = signal.sosfilt_zi(self._sos)
+        # Same default padding length as in scipy.signal.sosfiltfilt().
+        n_taps = 2 * len(self._sos) + 1
+        n_taps -= min((self._sos[:, 2] == 0).sum(),
+                      (self._sos[:, 5] == 0).sum())
+        self.padlen = 3 * n_taps
+
+    @property
+    def sos(self):
+        """The (n_sections, 6) array of second-order sections."""
+        return self._sos
+
+    def _sosfilt(self, x):
+        """Causal pass along the first axis, with steady-state initial
+        conditions scaled by the first sample."""
+        n_sections = len(self._sos)
+        zi = self._zi.reshape((n_sections, 2) + (1,) * (x.ndim - 1))
+        zi = zi * x[np.newaxis, :1]
+        y, _ = signal.sosfilt(self._sos, x, axis=0, zi=zi)
+        return y
+
+    def __call__(self, x, axis=0):
+        """Filter an array along a given axis."""
+        x = _as_array(x)
+        if x.shape[axis] == 0:
+            return x
+        # Work along the first axis.
+        x = np.swapaxes(x, 0, axis)
+        if self.causal:
+            y = self._sosfilt(x)
+        else:
+            n = x.shape[0]
+            padlen = min(self.padlen, n - 1)
+            y = self._sosfilt(_odd_extension(x, padlen))
+            y = self._sosfilt(y[::-1])[::-1]
+            y = y[padlen:padlen + n]
+        return np.swapaxes(y, 0, axis)
+
+
+def apply_filter_chunked(traces, out, filter=None,
+                         chunk_size=None, overlap=None):
+    """Filter a long (n_samples, n_channels) array chunk by chunk.
+
+    Parameters
+    ----------
+
+    traces : array-like
+        The (possibly memory-mapped) input array.
+    out : array-like
+        The (possibly memory-mapped) output array, with the same shape as
+        `traces`. If the dtype is an integer type, the filtered data is
+        rounded and clipped.
+    filter : function
+        A function filtering a (n_samples, n_channels) array along the
+        first axis.
+    chunk_size : int
+        Number of samples in every chunk, including the overlap.
+    overlap : int
+        Number of samples shared by consecutive chunks. Half of it is
+        discarded on both sides of the chunk edges, to avoid the edge
+        effects of the filter.
+
+    """
+    assert out.shape == traces.shape
+    if overlap is None:
+        overlap = chunk_size // 20
+    n_samples = traces.shape[0]
+    dtype = np.dtype(out.dtype)
+    for s_start, s_end, keep_start, keep_end in chunk_bounds(n_samples,
+                                                             chunk_size,
+                                                             overlap=overlap):
+        chunk = filter(traces[s_start:s_end])
+        chunk = chunk[keep_start - s_start:keep_end - s_start]
+        if dtype.kind in 'iu':
+            info = np.iinfo(dtype)
+            chunk = np.clip(np.round(chunk), info.min, info.max)
+        out[keep_start:keep_end] = chunk
+    return out
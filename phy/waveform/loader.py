@@ -6,10 +6,13 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
 import numpy as np
 
-from ..utils.array import _as_array, _pad
-from ..utils.logging import warn
+from ..utils.array import _as_array
+from ..utils.logging import debug, warn
 
 
 #------------------------------------------------------------------------------
@@ -49,24 +52,167 @@ def _slice(index, n_samples, margin=None):
     return slice(max(0, index - before), index + after, None)
 
 
+def _coalesce_windows(starts, stops, gap=0, max_size=None):
+    """Merge sorted windows that overlap or are separated by less than
+    `gap` samples.
+
+    Parameters
+    ----------
+
+    starts : array-like
+        The (sorted) start of every window.
+    stops : array-like
+        The stop of every window (excluded).
+    gap : int
+        Maximum number of samples between two windows that are merged.
+    max_size : int or None
+        Maximum number of samples in a merged window. A window larger
+        than this size is never split.
+
+    Returns
+    -------
+
+    groups : list
+        A list of tuples `(start, stop, i, j)` where `start` and `stop`
+        are the bounds of the merged window, and `i:j` is the range of the
+        windows belonging to that group.
+
+    """
+    groups = []
+    n = len(starts)
+    if n == 0:
+        return groups
+    i = 0
+    start, stop = starts[0], stops[0]
+    for k in range(1, n):
+        new_stop = max(stop, stops[k])
+        if (starts[k] - stop <= gap and
+                (max_size is None or new_stop - start <= max_size)):
+            stop = new_stop
+        else:
+            groups.append((start, stop, i, k))
+            i = k
+            start, stop = starts[k], stops[k]
+    groups.append((start, stop, i, n))
+    return groups
+
+
+def _channel_read_strategy(channels, n_channels, chunks=None,
+                           hdf5=False):
+    """Choose how to read a subset of channels from the traces.
+
+    Parameters
+    ----------
+
+    channels : array-like or None
+        The channels to load, in the requested order.
+    n_channels : int
+        The total number of channels in the traces.
+    chunks : tuple or None
+        The chunk shape of the HDF5 dataset, if it is chunked.
+    hdf5 : bool
+        Whether the traces are stored in an HDF5 dataset.
+
+    Returns
+    -------
+
+    (strategy, index, rel) : tuple
+        `strategy` is one of:
+
+        * `'all'`: read all channels
+        * `'range'`: read the contiguous range of columns containing all
+          requested channels (HDF5 hyperslab)
+        * `'fancy'`: read only the requested columns
+
+        `index` is the column selection to read from the traces, and `rel`
+        contains the indices of the requested channels in the read columns.
+
+    """
+    if channels is None:
+        return 'all', slice(None), None
+    channels = np.asarray(channels, dtype=np.int64)
+    cols = np.unique(channels)
+    if len(cols) == 0:
+        return 'all', slice(None), channels
+    c0, c1 = cols[0], cols[-1] + 1
+    if c1 - c0 == n_channels:
+        strategy = 'all'
+    elif c1 - c0 == len(cols):
+        strategy = 'range'
+    elif not hdf5:
+        # In-memory and memory-mapped arrays: fancy indexing only copies
+        # the needed columns.
+        strategy = 'fancy'
+    elif chunks is None:
+        # Contiguous HDF5 dataset: full rows are read from disk anyway,
+        # and a single hyperslab is much faster than a point selection.
+        strategy = 'range'
+    else:
+        # Chunked HDF5 dataset: count the number of column chunks
+        # touched by every strategy.
+        cs = chunks[1]
+        n_range = (c1 - 1) // cs - c0 // cs + 1
+        n_fancy = len(np.unique(cols // cs))
+        strategy = 'fancy' if n_fancy < n_range else 'range'
+    if strategy == 'all':
+        index, rel, n_read = slice(None), channels, n_channels
+    elif strategy == 'range':
+        index, rel, n_read = slice(c0, c1), channels - c0, c1 - c0
+    else:
+        index, rel, n_read = cols, np.searchsorted(cols, channels), len(cols)
+    # No need to reorder the columns if they are already in the right order.
+    if len(rel) == n_read and np.all(rel == np.arange(n_read)):
+        rel = None
+    return strategy, index, rel
+
+
+def _is_integer(dtype):
+    return np.issubdtype(dtype, np.integer)
+
+
+def _cast(arr, dtype):
+    """Convert an array to a given dtype, rounding and clipping
+    floating-point values when converting them to integers."""
+    arr = np.asarray(arr)
+    if _is_integer(dtype) and not _is_integer(arr.dtype):
+        iinfo = np.iinfo(dtype)
+        arr = np.clip(np.round(arr), iinfo.min, iinfo.max)
+    return arr.astype(dtype, copy=False)
+
+
 class WaveformLoader(object):
-    """Load waveforms from filtered or unfiltered traces."""
+    """Load waveforms from filtered or unfiltered traces.
+
+    The waveforms are returned as float32 arrays by default. With an
+    integer `dtype` (typically `np.int16`, the dtype of the raw data), the
+    scale factor is not applied and is available in the
+    `deferred_scale_factor` attribute: the consumer applies it at the
+    last step, when converting the waveforms to floating-point values.
+
+    With `n_workers > 1`, the waveforms are extracted and filtered in
+    parallel by a pool of threads: reading HDF5 data and filtering with
+    NumPy and SciPy release the GIL.
+
+    """
 
     def __init__(self, traces=None, offset=0, filter=None,
                  n_samples=None, filter_margin=0,
-                 channels=None, scale_factor=None):
+                 channels=None, scale_factor=None,
+                 read_gap=None, read_max_size=None,
+                 dtype=None, n_workers=None):
+        # List of channels to use when loading the waveforms.
+        self._channels = channels
         # A (possibly memmapped) array-like structure with traces.
         if traces is not None:
             self.traces = traces
         else:
             self._traces = None
-        self.dtype = np.float32
+        # Data type of the loaded waveforms.
+        self.dtype = np.dtype(dtype or np.float32)
         # Scale factor for the loaded waveforms.
         self._scale_factor = scale_factor
         # Offset of the traces: time (in samples) of the first trace sample.
         self._offset = int(offset)
-        # List of channels to use when loading the waveforms.
-        self._channels = channels
         # A filter function that takes a (n_samples, n_channels) array as
         # input.
         self._filter = filter
@@ -81,6 +227,27 @@ class WaveformLoader(object):
         # Number of samples in the extracted raw data chunk.
         self._n_samples_extract = (self.n_samples_waveforms +
                                    sum(self._filter_margin))
+        # Windows separated by less than this number of samples are read
+        # with a single contiguous read. By default, this is the size
+        # of a raw data chunk.
+        if read_gap is None:
+            read_gap = self._n_samples_extract
+        self.read_gap = read_gap
+        # Maximum number of samples in a single contiguous read.
+        if read_max_size is None:
+            read_max_size = 100 * self._n_samples_extract
+        self.read_max_size = read_max_size
+        # Number of reads and number of bytes read during the last call.
+        self._lock = Lock()
+        self._reset_read_stats()
+        # Number of threads extracting and filtering the waveforms.
+        self._pool = None
+        self._n_workers = n_workers or 1
+        # Number of spikes loaded by every thread task. By default, every
+        # worker gets a few tasks.
+        self.worker_chunk_size = None
+        # Incremented when the current loading is cancelled.
+        self._generation = 0
 
     @property
     def traces(self):
@@ -90,6 +257,52 @@ class WaveformLoader(object):
     def traces(self, value):
         self.n_samples_trace, self.n_channels_traces = value.shape
         self._traces = value
+        self._update_read_strategy()
+
+    @property
+    def n_workers(self):
+        """Number of threads extracting and filtering the waveforms."""
+        return self._n_workers
+
+    @n_workers.setter
+    def n_workers(self, value):
+        value = value or 1
+        if value != self._n_workers:
+            self.close()
+        self._n_workers = value
+
+    def close(self):
+        """Terminate the worker threads."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def cancel(self):
+        """Cancel the waveform loading in progress in other threads.
+
+        The pending tasks of the worker threads are skipped, and the
+        corresponding `loader[...]` call raises a `RuntimeError`.
+
+        """
+        self._generation += 1
+
+    @property
+    def scale_factor(self):
+        return self._scale_factor
+
+    @property
+    def deferred_scale_factor(self):
+        """Scale factor that has not been applied to the loaded waveforms,
+        or None."""
+        if _is_integer(self.dtype):
+            return self._scale_factor
+
+    def _scale(self, waveforms):
+        """Apply the scale factor in place, except with integer waveforms
+        where it is deferred."""
+        if self._scale_factor is not None and not _is_integer(self.dtype):
+            waveforms *= self._scale_factor
+        return waveforms
 
     @property
     def channels(self):
@@ -98,6 +311,29 @@ class WaveformLoader(object):
     @channels.setter
     def channels(self, value):
         self._channels = value
+        if self._traces is not None:
+            self._update_read_strategy()
+
+    def _update_read_strategy(self):
+        """Choose how to read the channels from the traces."""
+        (self.read_strategy,
+         self._read_index,
+         self._read_rel) = _channel_read_strategy(
+            self._channels, self.n_channels_traces,
+            chunks=getattr(self._traces, 'chunks', None),
+            hdf5=hasattr(self._traces, 'chunks'))
+        debug("Reading channels from the traces with the "
+              "'{0:s}' strategy.".format(self.read_strategy))
+
+    def _read(self, start, stop):
+        """Read the needed channels of the traces between two samples."""
+        if self.read_strategy == 'all':
+            buffer = self._traces[start:stop]
+        else:
+            buffer = self._traces[start:stop, self._read_index]
+        if self._read_rel is not None:
+            buffer = buffer[:, self._read_rel]
+        return buffer
 
     @property
     def n_channels_waveforms(self):
@@ -106,52 +342,210 @@ class WaveformLoader(object):
         else:
             return self.n_channels_traces
 
-    def _load_at(self, time):
-        """Load a waveform at a given time."""
-        time = int(time)
-        time_o = time - self._offset
+    def _check_time(self, time):
+        """Return the time relative to the traces, and raise a ValueError
+        if it is invalid."""
+        time_o = int(time) - self._offset
         ns = self.n_samples_trace
         if not (0 <= time_o < ns):
             raise ValueError("Invalid time {0:d}/{1:d}.".format(time_o,
                                                                 ns))
-        slice_extract = _slice(time_o,
-                               self.n_samples_before_after,
-                               self._filter_margin)
-        extract = self._traces[slice_extract]
-
-        # Pad the extracted chunk if needed.
-        if slice_extract.start <= 0:
-            extract = _pad(extract, self._n_samples_extract, 'left')
-        elif slice_extract.stop >= ns - 1:
-            extract = _pad(extract, self._n_samples_extract, 'right')
-
-        assert extract.shape[0] == self._n_samples_extract
-
-        # Filter the waveforms.
-        # TODO: do the filtering in a vectorized way for higher performance.
-        if self._filter is not None:
-            waveforms = self._filter(extract)
-        else:
-            waveforms = extract
+        return time_o
+
+    def _reset_read_stats(self):
+        self.n_reads = 0
+        self.n_bytes_read = 0
+
+    def _add_read_stats(self, n_reads, n_bytes):
+        # The reads may happen in several threads.
+        with self._lock:
+            self.n_reads += n_reads
+            self.n_bytes_read += n_bytes
+
+    def _extract_windows(self, times_o):
+        """Extract the raw data chunks of the needed channels at some sorted
+        relative times, including the filter margin.
+
+        Overlapping or close windows are merged into a few large
+        contiguous reads. Every chunk is then copied from these buffers,
+        and padded with zeros at the edges of the traces.
+
+        """
+        ns = self.n_samples_trace
+        n_extract = self._n_samples_extract
+        before = self.n_samples_before_after[0] + self._filter_margin[0]
+        times_o = np.asarray(times_o, dtype=np.int64)
+        starts = times_o - before
+        stops = starts + n_extract
+
+        shape = (len(times_o), n_extract, self.n_channels_waveforms)
+        extracts = np.zeros(shape, dtype=self._traces.dtype)
+
+        n_reads = n_bytes = 0
+        for start, stop, i, j in _coalesce_windows(starts, stops,
+                                                   gap=self.read_gap,
+                                                   max_size=self.read_max_size,
+                                                   ):
+            start_c, stop_c = max(0, start), min(ns, stop)
+            buffer = self._read(start_c, stop_c)
+            n_reads += 1
+            n_bytes += buffer.nbytes
+            # Copy every window from the buffer.
+            for k in range(i, j):
+                a, b = max(starts[k], start_c), min(stops[k], stop_c)
+                extracts[k, a - starts[k]:b - starts[k], :] = \
+                    buffer[a - start_c:b - start_c]
+
+        self._add_read_stats(n_reads, n_bytes)
+        debug("Loaded {0:d} waveforms with {1:d} reads ".format(
+              len(times_o), n_reads) +
+              "({0:.1f} KB).".format(n_bytes / 1024.))
+        return extracts
+
+    def _filter_stack(self, extracts):
+        """Filter a (n_spikes, n_samples_extract, n_channels) stack of raw
+        data chunks with a single call to the filter function.
+
+        Only the needed channels have been read, so only these channels
+        are filtered.
+
+        """
+        if self._filter is None:
+            return extracts
+        n_spikes, n_samples, n_channels = extracts.shape
+        # The filter function works along the first axis of a 2D array:
+        # the spikes are concatenated along the second axis.
+        x = np.transpose(extracts, (1, 0, 2))
+        x = x.reshape((n_samples, n_spikes * n_channels))
+        x = self._filter(x)
+        x = x.reshape((n_samples, n_spikes, n_channels))
+        return np.transpose(x, (1, 0, 2))
+
+    def _load_stack(self, times_o):
+        """Load the waveforms at some sorted and valid relative times.
+
+        Return a (n_spikes, n_samples_waveforms, n_channels_waveforms) array.
+
+        """
+        n_spikes = len(times_o)
+        extracts = self._extract_windows(times_o)
+
+        # Filter all waveforms at once.
+        waveforms = self._filter_stack(extracts)
 
         # Remove the margin.
         margin_before, margin_after = self._filter_margin
         if margin_after > 0:
             assert margin_before >= 0
-            waveforms = waveforms[margin_before:-margin_after, :]
+            waveforms = waveforms[:, margin_before:-margin_after, :]
 
-        # Make a subselection with the specified channels.
-        if self._channels is not None:
-            out = waveforms[..., self._channels]
-        else:
-            out = waveforms
+        assert waveforms.shape == (n_spikes,
+                                   self.n_samples_waveforms,
+                                   self.n_channels_waveforms)
+        return waveforms
+
+    def _load_at(self, time):
+        """Load a waveform at a given time."""
+        time_o = self._check_time(time)
+        self._reset_read_stats()
+        return self._load_stack([time_o])[0, ...]
+
+    def _valid_times(self, times):
+        """Return the indices and relative times of the valid times,
+        and warn about the invalid ones."""
+        times_o = np.asarray(times).astype(np.int64) - self._offset
+        valid = (0 <= times_o) & (times_o < self.n_samples_trace)
+        for time_o in times_o[~valid]:
+            warn("Error while loading waveform: "
+                 "Invalid time {0:d}/{1:d}.".format(int(time_o),
+                                                    self.n_samples_trace))
+        idx = np.nonzero(valid)[0]
+        return idx, times_o[idx]
+
+    def _load_parallel(self, waveforms, idx, times_o):
+        """Load the waveforms at some sorted and valid relative times with
+        the worker threads.
+
+        The spikes are split into chunks which are extracted and filtered
+        in parallel, and written into the preallocated `waveforms` array at
+        the indices `idx`.
+
+        """
+        n = len(times_o)
+        if n == 0:
+            return
+        chunk_size = (self.worker_chunk_size or
+                      int(np.ceil(n / float(4 * self._n_workers))))
+        bounds = [(i, min(i + chunk_size, n))
+                  for i in range(0, n, chunk_size)]
+        generation = self._generation
+
+        def _load_chunk(bounds):
+            # Skip the task if the loading has been cancelled.
+            if self._generation != generation:
+                return False
+            i, j = bounds
+            waveforms[idx[i:j], ...] = _cast(self._load_stack(times_o[i:j]),
+                                             self.dtype)
+            return True
+
+        if self._pool is None:
+            self._pool = ThreadPool(self._n_workers)
+        done = self._pool.map(_load_chunk, bounds)
+        if not all(done) or self._generation != generation:
+            raise RuntimeError("The waveform loading has been cancelled.")
+
+    def iter_chunks(self, times, chunk_size=None):
+        """Iterate over the waveforms at some sorted times, chunk by chunk.
 
-        assert out.shape == (self.n_samples_waveforms,
-                             self.n_channels_waveforms)
-        return out
+        Every chunk of spikes is loaded with a few large contiguous reads
+        of the traces, and filtered with a single call to the filter
+        function. The waveforms are identical to the ones obtained with
+        `loader[times]`.
+
+        Parameters
+        ----------
+
+        times : array-like
+            The sorted times of the waveforms.
+        chunk_size : int or None
+            The number of waveforms in every chunk (1000 by default).
+
+        Yields
+        ------
+
+        (i, j, waveforms) : tuple
+            `waveforms` is a `(j - i, n_samples, n_channels)` array with
+            the waveforms at `times[i:j]`.
+
+        """
+        if isinstance(times, slice):
+            raise NotImplementedError("Indexing with slices is not "
+                                      "implemented yet.")
+        times = np.asarray(times).astype(np.int64)
+        if np.any(np.diff(times) < 0):
+            raise ValueError("The times need to be sorted.")
+        chunk_size = chunk_size or 1000
+        for i in range(0, len(times), chunk_size):
+            j = min(i + chunk_size, len(times))
+            idx, times_o = self._valid_times(times[i:j])
+            shape = (j - i, self.n_samples_waveforms,
+                     self.n_channels_waveforms)
+            waveforms = np.zeros(shape, dtype=self.dtype)
+            self._reset_read_stats()
+            if len(idx):
+                waveforms[idx] = _cast(self._load_stack(times_o),
+                                       self.dtype)
+            yield i, j, self._scale(waveforms)
 
     def __getitem__(self, item):
-        """Load a number of waveforms."""
+        """Load a number of waveforms.
+
+        The requested times are sorted, the raw data chunks are read with
+        a few contiguous reads and stacked in a single array, and this array
+        is filtered at once.
+
+        """
         if isinstance(item, slice):
             raise NotImplementedError("Indexing with slices is not "
                                       "implemented yet.")
@@ -161,16 +555,19 @@ class WaveformLoader(object):
         spikes = _as_array(item)
         n_spikes = len(spikes)
         # Initialize the array.
-        # TODO: int16
         shape = (n_spikes, self.n_samples_waveforms,
                  self.n_channels_waveforms)
-        waveforms = np.empty(shape, dtype=self.dtype)
+        waveforms = np.zeros(shape, dtype=self.dtype)
+        # Sort the requested times for a more local access to the traces.
+        order = np.argsort(spikes, kind='mergesort')
+        # Only keep the valid times.
+        idx, times_o = self._valid_times(spikes[order])
+        idx = order[idx]
         # Load all spikes.
-        for i, time in enumerate(spikes):
-            try:
-                waveforms[i, ...] = self._load_at(time)
-            except ValueError as e:
-                warn("Error while loading waveform: {0}".format(str(e)))
-        if self._scale_factor is not None:
-            waveforms *= self._scale_factor
-        return waveforms
+        self._reset_read_stats()
+        if self._n_workers > 1:
+            self._load_parallel(waveforms, idx, times_o)
+        elif len(idx):
+            waveforms[idx, ...] = _cast(self._load_stack(times_o),
+                                        self.dtype)
+        return self._scale(waveforms)
@@ -9,8 +9,15 @@
 
 import numpy as np
 from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
+from scipy import signal
 
-from ..filter import bandpass_filter, apply_filter
+from ...utils.testing import benchmark
+from ..filter import (bandpass_filter,
+                      apply_filter,
+                      apply_filter_chunked,
+                      Filter,
+                      )
 
 
 #------------------------------------------------------------------------------
@@ -37,3 +44,78 @@ def test_apply_filter():
     assert np.abs(x_filtered[k:-k]).max() <= .1
 
     ae(apply_filter([], filter=filter), [])
+
+
+def test_apply_filter_chunked():
+    rate = 10000.
+    n_samples, n_channels = 10000, 3
+    x = np.random.normal(size=(n_samples, n_channels))
+
+    filter = bandpass_filter(low=500., high=2000., order=3, rate=rate)
+    expected = apply_filter(x, filter=filter)
+
+    def _filter(x):
+        return apply_filter(x, filter=filter)
+
+    # Float output.
+    out = np.zeros_like(x)
+    apply_filter_chunked(x, out, filter=_filter, chunk_size=1000,
+                         overlap=200)
+    k = 200
+    assert np.abs(out[k:-k] - expected[k:-k]).max() < 1e-3
+
+    # Integer output.
+    out = np.zeros((n_samples, n_channels), dtype=np.int16)
+    apply_filter_chunked(x * 1e5, out, filter=_filter, chunk_size=1000,
+                         overlap=200)
+    expected = np.clip(np.round(expected * 1e5), -32768, 32767)
+    assert np.abs(out[k:-k] - expected[k:-k]).max() <= 100
+    assert out.max() == 32767
+
+
+def test_filter_sos():
+    rate = 20000.
+    low, high, order = 500., 9500., 3
+    x = np.random.normal(size=(20, 49, 4))
+
+    filter = Filter(rate=rate, low=low, high=high, order=order)
+    assert filter.sos.shape == (order, 6)
+
+    # Zero-phase filtering of a stack of waveforms along the second axis.
+    y = filter(x, axis=1)
+    assert y.shape == x.shape
+    ac(y, signal.sosfiltfilt(filter.sos, x, axis=1))
+    b, a = bandpass_filter(rate=rate, low=low, high=high, order=order)
+    ac(y, signal.filtfilt(b, a, x, axis=1), atol=1e-10)
+
+    # Long chunk of traces along the first axis.
+    traces = np.random.normal(size=(1000, 4))
+    ac(filter(traces), signal.sosfiltfilt(filter.sos, traces, axis=0))
+
+    # Causal filtering.
+    causal = Filter(rate=rate, low=low, high=high, order=order, causal=True)
+    zi = signal.sosfilt_zi(filter.sos)[:, :, np.newaxis] * traces[:1]
+    ac(causal(traces), signal.sosfilt(filter.sos, traces, axis=0, zi=zi)[0])
+
+    # Short and empty arrays.
+    assert filter(traces[:5]).shape == (5, 4)
+    ae(filter([]), [])
+
+
+def test_filter_benchmark():
+    rate = 20000.
+    low, high, order = 500., 9500., 3
+    n_waveforms, n_samples, n_channels = 1000, 49, 32
+    x = np.random.normal(size=(n_waveforms, n_samples, n_channels))
+
+    b_filter = bandpass_filter(rate=rate, low=low, high=high, order=order)
+    filter = Filter(rate=rate, low=low, high=high, order=order)
+    causal = Filter(rate=rate, low=low, high=high, order=order, causal=True)
+
+    with benchmark('filtfilt on 1000 waveforms'):
+        y_ba = signal.filtfilt(b_filter[0], b_filter[1], x, axis=1)
+    with benchmark('SOS zero-phase filter on 1000 waveforms'):
+        y_sos = filter(x, axis=1)
+    with benchmark('SOS causal filter on 1000 waveforms'):
+        causal(x, axis=1)
+    ac(y_sos, y_ba, atol=1e-10)
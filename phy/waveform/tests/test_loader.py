@@ -8,15 +8,22 @@
 #------------------------------------------------------------------------------
 
 import os
+import os.path as op
 
 import numpy as np
 from numpy.testing import assert_array_equal as ae
+from numpy.testing import assert_allclose as ac
 import numpy.random as npr
-from pytest import raises
+from pytest import raises, mark
 
+from ...io.h5 import open_h5
 from ...io.mock.artificial import artificial_traces
-from ..loader import _slice, WaveformLoader
-from ..filter import bandpass_filter, apply_filter
+from ...utils.array import _pad
+from ...utils.tempdir import TemporaryDirectory
+from ...utils.testing import benchmark
+from ..loader import (_slice, _before_after, _coalesce_windows,
+                      _channel_read_strategy, WaveformLoader)
+from ..filter import bandpass_filter, apply_filter, Filter
 
 
 #------------------------------------------------------------------------------
@@ -27,6 +34,27 @@ def test_slice():
     assert _slice(0, (20, 20)) == slice(0, 20, None)
 
 
+def test_coalesce_windows():
+    assert _coalesce_windows([], []) == []
+    assert _coalesce_windows([0], [10]) == [(0, 10, 0, 1)]
+
+    starts = [0, 5, 12, 30, 31]
+    stops = [10, 15, 22, 40, 41]
+
+    assert _coalesce_windows(starts, stops) == [(0, 22, 0, 3),
+                                                (30, 41, 3, 5)]
+    assert _coalesce_windows(starts, stops, gap=8) == [(0, 41, 0, 5)]
+    assert _coalesce_windows(starts, stops, gap=-6) == [(0, 10, 0, 1),
+                                                        (5, 15, 1, 2),
+                                                        (12, 22, 2, 3),
+                                                        (30, 41, 3, 5)]
+    assert _coalesce_windows(starts, stops, max_size=15) == [(0, 15, 0, 2),
+                                                             (12, 22, 2, 3),
+                                                             (30, 41, 3, 5)]
+    # A window larger than the maximum size is not split.
+    assert _coalesce_windows([0], [10], max_size=5) == [(0, 10, 0, 1)]
+
+
 def test_loader():
     n_samples_trace, n_channels = 10000, 100
     n_samples = 40
@@ -106,10 +134,72 @@ def test_loader_channels():
     assert loader[3].shape == (1, n_samples, 3)
     assert loader[995].shape == (1, n_samples, 3)
 
+    # Slices are not supported.
     with raises(NotImplementedError):
         loader[500:510]
 
 
+def test_channel_read_strategy():
+    def _strategy(*args, **kwargs):
+        return _channel_read_strategy(*args, **kwargs)[0]
+
+    assert _channel_read_strategy(None, 10) == ('all', slice(None), None)
+    assert _strategy([], 10) == 'all'
+    assert _strategy([0, 9, 3], 10) == 'all'
+    assert _strategy([5, 3, 4], 10) == 'range'
+    assert _strategy([2, 7], 10) == 'fancy'
+    assert _strategy([2, 7], 10, hdf5=True) == 'range'
+    assert _strategy([2, 7], 10, chunks=(100, 5), hdf5=True) == 'range'
+    assert _strategy([2, 17], 20, chunks=(100, 5), hdf5=True) == 'fancy'
+
+    strategy, index, rel = _channel_read_strategy([5, 3, 4], 10)
+    assert index == slice(3, 6)
+    ae(rel, [2, 0, 1])
+    strategy, index, rel = _channel_read_strategy([7, 2, 7], 10)
+    ae(index, [2, 7])
+    ae(rel, [1, 0, 1])
+    # No reordering needed.
+    assert _channel_read_strategy([3, 4, 5], 10)[2] is None
+
+
+def test_loader_hdf5_channels():
+    n_samples_trace, n_channels = 2000, 32
+    n_samples = 40
+    channels = [30, 2, 3, 29]
+
+    traces = artificial_traces(n_samples_trace, n_channels).astype(np.int16)
+    times = np.cumsum(npr.randint(low=5, high=2 * n_samples, size=20))
+
+    def my_filter(x):
+        return x * x
+
+    def _loader(traces):
+        return WaveformLoader(traces, n_samples=n_samples,
+                              filter=my_filter, filter_margin=4,
+                              channels=channels)
+
+    expected = _loader(traces)[times]
+    filtered = my_filter(traces[:, channels])
+    ae(expected[3], filtered[times[3] - 20:times[3] + 20])
+
+    with TemporaryDirectory() as tempdir:
+        path = op.join(tempdir, 'traces.h5')
+        with open_h5(path, 'w') as f:
+            f.h5py_file.create_dataset('contiguous', data=traces)
+            f.h5py_file.create_dataset('chunked', data=traces,
+                                       chunks=(256, 8))
+        with open_h5(path) as f:
+            loader = _loader(f.read('/contiguous'))
+            assert loader.read_strategy == 'range'
+            ae(loader[times], expected)
+
+            loader = _loader(f.read('/chunked'))
+            assert loader.read_strategy == 'fancy'
+            ae(loader[times], expected)
+            # Only 4 channels have been read.
+            assert loader.n_bytes_read <= 4 * 2 * n_samples_trace
+
+
 def test_loader_filter():
     n_samples_trace, n_channels = 1000, 100
     n_samples = 40
@@ -133,3 +223,254 @@ def test_loader_filter():
     traces_filtered = my_filter(traces)
     traces_filtered[t - 20:t + 20, :]
     assert np.allclose(waveform_filtered, traces_filtered[t - 20:t + 20, :])
+
+
+def test_loader_int16():
+    n_samples_trace, n_channels = 1000, 10
+    n_samples = 40
+
+    traces = (100 * artificial_traces(n_samples_trace,
+                                      n_channels)).astype(np.int16)
+    times = [100, 50, 500, 200]
+
+    def my_filter(x):
+        return x * .5
+
+    def _loader(scale_factor=.1, **kwargs):
+        return WaveformLoader(traces, n_samples=n_samples,
+                              filter=my_filter, filter_margin=6,
+                              channels=[5, 1, 3], scale_factor=scale_factor,
+                              **kwargs)
+
+    w_float = _loader()[times]
+    assert w_float.dtype == np.float32
+    assert _loader().deferred_scale_factor is None
+
+    loader = _loader(dtype=np.int16)
+    assert loader.deferred_scale_factor == .1
+    w_int = loader[times]
+    assert w_int.dtype == np.int16
+    assert w_int.nbytes == w_float.nbytes // 2
+    # The filtered values are rounded, and the scaling is deferred.
+    ae(w_int, np.round(_loader(scale_factor=None)[times]))
+    ac(w_int * loader.deferred_scale_factor, w_float, atol=.051)
+
+    # Chunk iteration.
+    w_chunks = np.concatenate([w for (_, _, w) in
+                               loader.iter_chunks(sorted(times))])
+    assert w_chunks.dtype == np.int16
+    ae(w_chunks, w_int[np.argsort(times)])
+
+
+def test_loader_batch():
+    n_samples_trace, n_channels = 1000, 10
+    n_samples = 40
+
+    traces = artificial_traces(n_samples_trace, n_channels)
+    b_filter = bandpass_filter(rate=1000,
+                               low=50,
+                               high=200,
+                               order=3)
+
+    loader = WaveformLoader(traces,
+                            n_samples=n_samples,
+                            filter=lambda x: apply_filter(x, b_filter),
+                            filter_margin=9,
+                            channels=[5, 1, 3],
+                            )
+
+    # Unsorted times, with duplicates and edge effects.
+    times = [500, 3, 120, 995, 500, 121]
+    waveforms = loader[times]
+    assert waveforms.shape == (6, n_samples, 3)
+    for i, t in enumerate(times):
+        ac(waveforms[i], loader._load_at(t))
+
+    # Invalid times are ignored.
+    waveforms = loader[[500, 2000, 3]]
+    ac(waveforms[0], loader._load_at(500))
+    ae(waveforms[1], 0)
+    ac(waveforms[2], loader._load_at(3))
+
+    assert loader[[]].shape == (0, n_samples, 3)
+
+
+def test_loader_coalesced_reads():
+    n_samples_trace, n_channels = 1000, 10
+    n_samples = 40
+
+    traces = artificial_traces(n_samples_trace, n_channels)
+    loader = WaveformLoader(traces, n_samples=n_samples)
+
+    # Two bursts of spikes, and edge effects.
+    times = [5, 10, 30, 35, 50, 600, 610, 620, 998]
+
+    def _check():
+        waveforms = loader[times]
+        padded = np.vstack((np.zeros((20, n_channels)),
+                            traces,
+                            np.zeros((20, n_channels))))
+        for i, t in enumerate(times):
+            ac(waveforms[i], padded[t:t + n_samples], rtol=1e-6)
+
+    _check()
+    assert loader.n_reads == 3
+    itemsize = traces.dtype.itemsize
+    assert loader.n_bytes_read == (70 + 60 + 22) * n_channels * itemsize
+
+    # One read per spike.
+    loader.read_gap = -n_samples
+    _check()
+    assert loader.n_reads == len(times)
+
+    # A single read.
+    loader.read_gap = 1000
+    _check()
+    assert loader.n_reads == 1
+
+    # Bounded buffers.
+    loader.read_max_size = 70
+    _check()
+    assert loader.n_reads == 4
+
+
+def test_loader_iter_chunks():
+    n_samples_trace, n_channels = 2000, 10
+    n_samples = 40
+
+    traces = artificial_traces(n_samples_trace, n_channels)
+    times = np.cumsum(npr.randint(low=5, high=2 * n_samples, size=40))
+    # Invalid times at the end.
+    times[-2:] = n_samples_trace + np.arange(2)
+
+    # Without filter, the waveforms are identical to the batch ones.
+    loader = WaveformLoader(traces, n_samples=n_samples, channels=[5, 1, 3],
+                            scale_factor=.5)
+    expected = loader[times]
+    chunks = list(loader.iter_chunks(times, chunk_size=15))
+    assert [(i, j) for (i, j, _) in chunks] == [(0, 15), (15, 30), (30, 40)]
+    ae(np.concatenate([w for (_, _, w) in chunks]), expected)
+    ae(chunks[-1][2][-2:], 0)
+
+    with raises(NotImplementedError):
+        list(loader.iter_chunks(slice(100, 110), chunk_size=4))
+    with raises(ValueError):
+        list(loader.iter_chunks(times[::-1]))
+
+    # With a temporal filter, the waveforms are identical to the batch ones,
+    # including at the edges of the chunks and of the traces.
+    loader = WaveformLoader(traces, n_samples=n_samples,
+                            filter=Filter(rate=1000, low=50, high=200,
+                                          order=3),
+                            filter_margin=10)
+    times = np.concatenate(([3], times[:-2], [n_samples_trace - 3]))
+    waveforms = np.concatenate([w for (_, _, w) in
+                                loader.iter_chunks(times, chunk_size=15)])
+    ae(waveforms, loader[times])
+    # Overlapping windows are read at once.
+    assert loader.n_reads < 12
+
+
+def test_loader_workers():
+    n_samples_trace, n_channels = 5000, 10
+    n_samples = 40
+
+    traces = artificial_traces(n_samples_trace, n_channels)
+    times = npr.randint(low=-10, high=n_samples_trace + 10, size=100)
+    b_filter = bandpass_filter(rate=1000,
+                               low=50,
+                               high=200,
+                               order=3)
+
+    def my_filter(x):
+        return apply_filter(x, b_filter)
+
+    expected = WaveformLoader(traces, n_samples=n_samples, filter=my_filter,
+                              filter_margin=9, channels=[5, 1, 3])[times]
+
+    loader = WaveformLoader(traces, n_samples=n_samples, filter=my_filter,
+                            filter_margin=9, channels=[5, 1, 3],
+                            n_workers=3)
+    assert loader.n_workers == 3
+    ae(loader[times], expected)
+    loader.worker_chunk_size = 7
+    ae(loader[times], expected)
+    assert loader.n_reads >= 100 // 7
+    assert loader[[]].shape == (0, n_samples, 3)
+
+    # Cancel the loading during the filtering of the first chunk.
+    def cancelling_filter(x):
+        loader.cancel()
+        return my_filter(x)
+
+    loader._filter = cancelling_filter
+    with raises(RuntimeError):
+        loader[times]
+    loader._filter = my_filter
+    ae(loader[times], expected)
+
+    loader.n_workers = None
+    assert loader.n_workers == 1
+    ae(loader[times], expected)
+    loader.close()
+
+
+def _load_per_spike(traces, times, n_samples, filter, filter_margin):
+    """Reference implementation extracting, padding and filtering every
+    waveform separately, like WaveformLoader did before the batch
+    extraction."""
+    margin_before, margin_after = _before_after(filter_margin)
+    n_extract = n_samples + filter_margin
+    ns = traces.shape[0]
+    waveforms = []
+    for time in times:
+        s = _slice(time, _before_after(n_samples),
+                   (margin_before, margin_after))
+        extract = traces[s]
+        if s.start <= 0:
+            extract = _pad(extract, n_extract, 'left')
+        elif s.stop >= ns - 1:
+            extract = _pad(extract, n_extract, 'right')
+        waveforms.append(filter(extract)[margin_before:-margin_after])
+    return np.array(waveforms)
+
+
+@mark.slow
+def test_loader_benchmark():
+    n_channels = 8
+    n_samples = 40
+    filter_margin = 9
+
+    b_filter = bandpass_filter(rate=20000,
+                               low=500,
+                               high=9500,
+                               order=3)
+
+    def my_filter(x):
+        return apply_filter(x, b_filter)
+
+    for n_spikes in (100, 1000, 10000):
+        n_samples_trace = 50 * n_spikes
+        traces = artificial_traces(n_samples_trace, n_channels)
+        # No spike at the edges, where the reference implementation
+        # cannot pad all waveforms.
+        times = npr.randint(low=n_samples, high=n_samples_trace - n_samples,
+                            size=n_spikes)
+
+        loader = WaveformLoader(traces,
+                                n_samples=n_samples,
+                                filter=my_filter,
+                                filter_margin=filter_margin,
+                                )
+
+        name = '{0:d} waveforms'.format(n_spikes)
+        with benchmark('Per-spike loop, ' + name):
+            w_loop = _load_per_spike(traces, times, n_samples,
+                                     my_filter, filter_margin)
+        with benchmark('Batch extraction, ' + name):
+            w_batch = loader[times]
+        ac(w_batch, w_loop, rtol=1e-5, atol=1e-5)
+        times = np.sort(times)
+        with benchmark('Chunk iteration, ' + name):
+            for _, _, w in loader.iter_chunks(times, chunk_size=1000):
+                pass